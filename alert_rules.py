@@ -0,0 +1,235 @@
+import csv
+import json
+import os
+import queue
+import re
+import threading
+from time import time
+
+import metrics
+import utils
+from net_guard import TokenBucket
+
+RULE_KINDS = ['changed', 'increased', 'decreased', 'moved', 'above', 'below', 'matches']
+
+
+def to_number(value):
+    try:
+        return float(str(value).replace(',', ''))
+    except ValueError:
+        return None
+
+
+class AlertRule:
+    """One row of alert_rules.csv: name, kind, field, value, sinks, max_alerts, per_minutes.
+    The field can end with '*' to watch every compared field starting with the rest of it. Kinds, checked when the
+    field changed:
+        changed     any change
+        increased   the number grew, decreased: it shrank
+        moved       the number moved more than value percent
+        above       the number rose above value, below: it fell below value
+        matches     the new value matches the regex in value
+    Sinks are separated by ';'. At most max_alerts alerts are sent every per_minutes minutes, more are dropped and
+    counted in the next alert, no max_alerts means no limit"""
+    def __init__(self, name, kind, field, value='', sinks='log', max_alerts='', per_minutes=''):
+        if kind not in RULE_KINDS:
+            raise ValueError(f"Alert rule {name}: unknown kind {kind}, expected one of {RULE_KINDS}")
+        self.name = name
+        self.kind = kind
+        self.field = field
+        self.prefix = field[:-1] if field.endswith('*') else None
+        self.sinks = [sink.strip() for sink in sinks.split(';') if sink.strip()]
+        self.pattern = re.compile(value) if kind == 'matches' else None
+        self.threshold = None
+        if kind in ('moved', 'above', 'below'):
+            self.threshold = to_number(value)
+            if self.threshold is None:
+                raise ValueError(f"Alert rule {name}: {kind} needs a number, got {value!r}")
+        self.bucket = TokenBucket()
+        if max_alerts:
+            max_alerts, per_minutes = to_number(max_alerts), to_number(per_minutes or 1)
+            # A TokenBucket with no rate doesn't limit at all, so a limit of 0 would mean no limit
+            if max_alerts is None or max_alerts < 1 or per_minutes is None or per_minutes <= 0:
+                raise ValueError(f"Alert rule {name}: max_alerts must be at least 1 and per_minutes above 0, "
+                                 f"leave max_alerts empty for no limit")
+            self.bucket = TokenBucket(max_alerts / (per_minutes * 60), int(max_alerts))
+        self.n_suppressed = 0
+
+    def check(self, field, old_value, new_value):
+        """Returns the alert message if the change of the field triggers the rule, else None"""
+        if self.kind == 'changed':
+            return f"{field} changed from {old_value} to {new_value}"
+        if self.kind == 'matches':
+            if self.pattern.search(str(new_value)):
+                return f"{field} is now {new_value}"
+            return None
+
+        old_number, new_number = to_number(old_value), to_number(new_value)
+        if old_number is None or new_number is None:
+            return None
+        if self.kind == 'increased' and new_number > old_number or self.kind == 'decreased' and new_number < old_number:
+            return f"{field} {self.kind} from {old_value} to {new_value}"
+        if self.kind == 'moved' and old_number and abs(new_number - old_number) / abs(old_number) * 100 > self.threshold:
+            return f"{field} moved {(new_number - old_number) / abs(old_number) * 100:+.1f}% from {old_value} to {new_value}"
+        if self.kind == 'above' and old_number <= self.threshold < new_number or \
+                self.kind == 'below' and old_number >= self.threshold > new_number:
+            return f"{field} went {self.kind} {self.threshold:g}: {new_value}"
+        return None
+
+
+def load_rules(path):
+    """Reads the alert rules csv, returns no rules if it doesn't exist"""
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', newline='') as f:
+        rows = [row for row in csv.DictReader(f) if row.get('name')]
+    return [AlertRule(**{key: (value or '').strip() for key, value in row.items() if key}) for row in rows]
+
+
+class AlertEngine:
+    """Evaluates the alert rules on every collected stock. Rules are indexed by the field they watch, so an update only
+    checks the rules of the fields it changed. Fields that are not compared (like the price fields) are not in the
+    stock's diff, the ones a rule watches are compared here. Alerts are handed to the sinks by a background thread,
+    slow sinks get a thread and a bounded queue of their own so they don't hold up the others"""
+    def __init__(self, rules, ignore_fields=()):
+        self.rules = rules
+        self.lock = threading.Lock()
+        self.sinks = dict()
+        self.sink_queues = dict()
+        self.disabled_sinks = set()
+        self.field_rules = dict()
+        self.prefix_rules = []
+        for rule in rules:
+            if rule.prefix is not None:
+                self.prefix_rules.append(rule)
+            else:
+                self.field_rules.setdefault(rule.field, []).append(rule)
+        self.ignored_fields = [field for field in self.field_rules if field in ignore_fields]
+
+        self.alerts = queue.Queue()
+        self.thread = threading.Thread(name="Alert_Sink_Thread", target=self._deliver, daemon=True)
+        self.thread.start()
+
+    def add_sink(self, name, sink, own_thread=False, max_queued=1000):
+        """Sends alerts of the rules naming this sink to sink(alert), replacing the sink with that name.
+        A sink on its own thread drops the alerts coming in while max_queued are waiting for it"""
+        self.sinks[name] = sink
+        if own_thread and name not in self.sink_queues:
+            sink_queue = queue.Queue(max_queued)
+            self.sink_queues[name] = sink_queue
+            threading.Thread(name=f"Alert_Sink_{name}_Thread", target=self._deliver_to, args=(name, sink_queue),
+                             daemon=True).start()
+
+    def set_sink_enabled(self, name, enabled):
+        if enabled:
+            self.disabled_sinks.discard(name)
+        else:
+            self.disabled_sinks.add(name)
+
+    def evaluate(self, stock_name, old_record, new_record, diff):
+        """Checks the rules watching the fields that changed. A stock seen for the first time raises no alerts"""
+        if not self.rules or old_record is None:
+            return
+        for field, old_value, new_value in diff or []:
+            rules = self.field_rules.get(field, [])
+            if self.prefix_rules:
+                rules = rules + [rule for rule in self.prefix_rules if field.startswith(rule.prefix)]
+            self._check(rules, stock_name, field, old_value, new_value)
+        # Rules on fields that are not compared watch them by name only
+        for field in self.ignored_fields:
+            old_value = old_record.get(field, utils.NOT_AVAILABLE_STR)
+            new_value = new_record.get(field, utils.NOT_AVAILABLE_STR)
+            if old_value != new_value and utils.NOT_AVAILABLE_STR not in (old_value, new_value):
+                self._check(self.field_rules[field], stock_name, field, old_value, new_value)
+
+    def _check(self, rules, stock_name, field, old_value, new_value):
+        for rule in rules:
+            message = rule.check(field, old_value, new_value)
+            if message is not None:
+                self._send(rule, stock_name, field, old_value, new_value, message)
+
+    def _send(self, rule, stock_name, field, old_value, new_value, message):
+        if not rule.bucket.try_take():
+            self.lock.acquire()
+            rule.n_suppressed += 1
+            self.lock.release()
+            metrics.REGISTRY.inc('alerts_suppressed')
+            return
+        self.lock.acquire()
+        n_suppressed, rule.n_suppressed = rule.n_suppressed, 0
+        self.lock.release()
+        metrics.REGISTRY.inc('alerts')
+        self.alerts.put((rule.sinks, dict(ts=round(time(), 3), rule=rule.name, stock=stock_name, field=field,
+                                          old_value=old_value, new_value=new_value, message=message,
+                                          suppressed=n_suppressed)))
+
+    def _deliver(self):
+        while True:
+            sink_names, alert = self.alerts.get()
+            for sink_name in sink_names:
+                if sink_name not in self.sinks or sink_name in self.disabled_sinks:
+                    continue
+                sink_queue = self.sink_queues.get(sink_name)
+                if sink_queue is None:
+                    self._call_sink(sink_name, alert)
+                    continue
+                try:
+                    sink_queue.put_nowait(alert)
+                except queue.Full:
+                    metrics.REGISTRY.inc('alerts_dropped')
+
+    def _deliver_to(self, sink_name, sink_queue):
+        while True:
+            alert = sink_queue.get()
+            if sink_name not in self.disabled_sinks:
+                self._call_sink(sink_name, alert)
+
+    def _call_sink(self, sink_name, alert):
+        try:
+            self.sinks[sink_name](alert)
+        except Exception as e:
+            print(f"Alert sink {sink_name} failed: {e}")
+
+    def queue_depth(self):
+        return self.alerts.qsize() + sum(sink_queue.qsize() for sink_queue in list(self.sink_queues.values()))
+
+
+def format_alert(alert):
+    suppressed = f" ({alert['suppressed']} more were dropped)" if alert['suppressed'] else ""
+    return f"Alert {alert['rule']}: {alert['stock']} {alert['message']}{suppressed}"
+
+
+def make_log_sink():
+    return lambda alert: print(format_alert(alert))
+
+
+def make_file_sink(path):
+    """Appends the alerts to a json lines file"""
+    def sink(alert):
+        with open(path, 'a') as f:
+            f.write(json.dumps(alert) + '\n')
+    return sink
+
+
+def make_sound_sink(sound_path, min_interval=2):
+    """Plays the sound, at most once every min_interval seconds however many alerts come in"""
+    last_played = [0]
+
+    def sink(alert):
+        if time() - last_played[0] < min_interval:
+            return
+        last_played[0] = time()
+        from playsound import playsound
+        playsound(sound_path)
+    return sink
+
+
+def make_webhook_sink(url, timeout=5):
+    """POSTs each alert as json to the url"""
+    import urllib.request
+
+    def sink(alert):
+        request = urllib.request.Request(url, data=json.dumps(alert).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'}, method='POST')
+        urllib.request.urlopen(request, timeout=timeout).close()
+    return sink
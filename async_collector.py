@@ -0,0 +1,127 @@
+import asyncio
+
+import aiohttp
+
+import metrics
+import net_guard
+import utils
+
+
+async def get_dict_from_url_async(session, url):
+    guard = net_guard.get_guard(url)
+    if not guard.breaker.allow():
+        return dict()
+    await asyncio.sleep(guard.bucket.reserve())
+    try:
+        with metrics.REGISTRY.time(f"fetch_{utils.get_endpoint_name(url)}"):
+            async with session.get(url) as response:
+                if response.status >= 400:
+                    if net_guard.is_host_failure(response.status):
+                        guard.breaker.record_failure()
+                    return dict()
+                body = await response.read()
+    except Exception as e:
+        guard.breaker.record_failure()
+        return dict()
+    guard.breaker.record_success()
+    try:
+        d = utils.loads_json(body)
+    except Exception as e:
+        return dict()
+    return d
+
+
+async def get_news_dict_async(session, stock_name, base_url=utils.OTC_API_URL, source='dns'):
+    news_dict = await get_dict_from_url_async(session, utils.get_news_url(stock_name, source, base_url))
+    if not news_dict:
+        source = utils.get_other_news_source(source)
+        news_dict = await get_dict_from_url_async(session, utils.get_news_url(stock_name, source, base_url))
+    return news_dict, source if news_dict else None
+
+
+async def get_cached(value):
+    return value
+
+
+async def get_raw_stock_data_async(session, stock_name, base_url=utils.OTC_API_URL, cache=None):
+    """Same as utils.get_raw_stock_data but fires the profile, inside-trade and news requests concurrently"""
+    if cache is None:
+        company_dict, prices_dict, (news_dict, _) = await asyncio.gather(
+            get_dict_from_url_async(session, utils.get_profile_url(stock_name, base_url)),
+            get_dict_from_url_async(session, utils.get_prices_url(stock_name, base_url)),
+            get_news_dict_async(session, stock_name, base_url))
+        if not company_dict:
+            return dict()
+        return utils.merge_raw_stock_data(company_dict, prices_dict, news_dict)
+
+    cached_company_dict = cache.get(stock_name, 'profile')
+    cached_news_dict = cache.get(stock_name, 'news')
+    news_source = cache.get(stock_name, 'news_source') or 'dns'
+    prices_dict, company_dict, (news_dict, news_source) = await asyncio.gather(
+        get_dict_from_url_async(session, utils.get_prices_url(stock_name, base_url)),
+        get_cached(cached_company_dict) if cached_company_dict is not None
+        else get_dict_from_url_async(session, utils.get_profile_url(stock_name, base_url)),
+        get_cached((cached_news_dict, None)) if cached_news_dict is not None
+        else get_news_dict_async(session, stock_name, base_url, news_source))
+
+    # The profile came from the cache but the price moved, query it again
+    if cache.tick_changed(stock_name, prices_dict) and cached_company_dict is not None:
+        company_dict = await get_dict_from_url_async(session, utils.get_profile_url(stock_name, base_url))
+    if not company_dict:
+        return dict()
+
+    if company_dict is not cached_company_dict:
+        cache.put(stock_name, 'profile', company_dict)
+    # No answer from either news source is usually a passing failure, it is asked again next time
+    if cached_news_dict is None and news_dict:
+        cache.put(stock_name, 'news', news_dict)
+        if news_source:
+            cache.put(stock_name, 'news_source', news_source)
+
+    return utils.merge_raw_stock_data(company_dict, prices_dict, news_dict)
+
+
+async def get_stock_data_async(session, stock_name, base_url=utils.OTC_API_URL, cache=None, projection=None):
+    data = await get_raw_stock_data_async(session, stock_name, base_url, cache)
+    if not data:
+        return None
+    return utils.parse_raw_stock_data(data, projection)
+
+
+class AsyncCollector:
+    """Drains the monitor's task queue from a single event loop, with up to max_concurrency stocks in flight over one
+    pooled keep-alive session. Runs in place of the data_collection_worker threads."""
+    def __init__(self, monitor, max_concurrency=20, request_timeout=30):
+        self.monitor = monitor
+        self.max_concurrency = max_concurrency
+        self.request_timeout = request_timeout
+
+    def run(self):
+        asyncio.run(self._collect())
+
+    async def _collect(self):
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(total=self.request_timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            workers = [self._worker(session, f"Async_Worker_{i}") for i in range(self.max_concurrency)]
+            await asyncio.gather(*workers)
+
+    async def _worker(self, session, name):
+        loop = asyncio.get_running_loop()
+        while True:
+            task = self.monitor.retry_queue.pop_ready() or self.monitor.task_queue.pop()
+            if task is None:
+                wait = self.monitor.retry_queue.time_to_next()
+                if wait is None:
+                    # Stocks still in the pipeline may come back as retries
+                    if self.monitor.pipeline.is_idle():
+                        break
+                    wait = 0.1
+                await asyncio.sleep(min(wait, 1))
+                continue
+
+            raw_data = await get_raw_stock_data_async(session, task.name, self.monitor.api_base_url,
+                                                      self.monitor.endpoint_cache)
+
+            # Submitting blocks while the pipeline is full, keep it off the event loop
+            await loop.run_in_executor(None, self.monitor.pipeline.submit, task, raw_data, name)
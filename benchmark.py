@@ -0,0 +1,215 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+from os.path import join as pjoin
+from time import sleep, time
+
+import numpy as np
+import psutil
+
+import async_collector
+import utils
+from mock_otc_server import MockOTCBackend, start_server
+from stock_monitor import StockMonitor, add_monitor_arguments
+
+
+class ResourceSampler:
+    """Samples the peak resident memory of this process and its children in the background"""
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak_rss = 0
+        self.running = True
+        self.thread = threading.Thread(name="Resource_Sampler", target=self._sample, daemon=True)
+        self.thread.start()
+
+    def _sample(self):
+        while self.running:
+            rss = self.process.memory_info().rss
+            for child in self.process.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.Error:
+                    pass
+            self.peak_rss = max(self.peak_rss, rss)
+            sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        return self.peak_rss
+
+
+class LatencyRecorder:
+    """Wraps the sync and async url fetchers to record the latency of every request"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.get_dict_from_url = utils.get_dict_from_url
+        self.get_dict_from_url_async = async_collector.get_dict_from_url_async
+
+    def install(self):
+        def get_dict_from_url(url):
+            start = time()
+            d = self.get_dict_from_url(url)
+            self._record(time() - start)
+            return d
+
+        async def get_dict_from_url_async(session, url):
+            start = time()
+            d = await self.get_dict_from_url_async(session, url)
+            self._record(time() - start)
+            return d
+
+        utils.get_dict_from_url = get_dict_from_url
+        async_collector.get_dict_from_url_async = get_dict_from_url_async
+
+    def uninstall(self):
+        utils.get_dict_from_url = self.get_dict_from_url
+        async_collector.get_dict_from_url_async = self.get_dict_from_url_async
+
+    def _record(self, latency):
+        self.lock.acquire()
+        self.latencies.append(latency)
+        self.lock.release()
+
+    def pop_percentiles(self):
+        self.lock.acquire()
+        latencies, self.latencies = self.latencies, []
+        self.lock.release()
+        if not latencies:
+            return dict()
+        p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+        return {'requests': len(latencies), 'latency_p50_ms': p50, 'latency_p95_ms': p95, 'latency_p99_ms': p99}
+
+
+def get_bytes_written():
+    try:
+        return psutil.Process().io_counters().write_bytes
+    except (AttributeError, psutil.Error):
+        return None
+
+
+def get_dir_size(path):
+    return sum(os.path.getsize(pjoin(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def run_benchmark(n_stocks, args, recorder):
+    """Runs a cold and a warm cycle over a synthetic universe of n_stocks and returns their measurements"""
+    work_dir = tempfile.mkdtemp(prefix='stock_monitor_bench_')
+    backend = MockOTCBackend(args.latency_ms, args.error_rate, args.change_rate)
+    server, base_url = start_server(backend)
+
+    stock_names_path = pjoin(work_dir, 'stock_names.csv')
+    with open(stock_names_path, 'w') as f:
+        f.write('\n'.join(f"S{i:05d}" for i in range(n_stocks)))
+
+    monitor_args = add_monitor_arguments(argparse.ArgumentParser()).parse_args([
+        '--output_dir', pjoin(work_dir, 'outputs'), '--stock_names_path', stock_names_path,
+        '--api_base_url', base_url, '--no_screenshots', '--requests_per_second', '0',
+        '--max_concurrency', str(args.concurrency), '--retry_base_seconds', '0.5', '--retry_max_seconds', '2',
+        '--processes', str(args.processes), '--threads_per_process', str(args.concurrency),
+    ] + ([] if args.render_plots else ['--lazy_plots']) + (['--threads_fetch'] if args.threads else []))
+
+    results = []
+    sampler = ResourceSampler()
+    monitor = StockMonitor(monitor_args)
+    # The alert rules are still evaluated, their alerts are not printed or played
+    for sink_name in ('log', 'sound'):
+        monitor.alerts.set_sink_enabled(sink_name, False)
+    for cycle_name in ['cold', 'warm']:
+        monitor.scheduler.reset()
+        bytes_before = get_bytes_written()
+        requests_before = backend.n_requests
+        start = time()
+        monitor.run_cycle(args.concurrency)
+        duration = time() - start
+        _, bad_reads = monitor.get_status()
+        bytes_written = get_bytes_written()
+        result = {'n_stocks': n_stocks, 'cycle': cycle_name, 'seconds': duration,
+                  'stocks_per_sec': n_stocks / duration, 'bad_reads': bad_reads,
+                  'requests_per_stock': (backend.n_requests - requests_before) / n_stocks,
+                  'disk_bytes_written': bytes_written - bytes_before if bytes_written is not None else None}
+        result.update(recorder.pop_percentiles())
+        results.append(result)
+        monitor.reinit_state()
+
+    monitor.terminate()
+    peak_rss = sampler.stop()
+    output_size = get_dir_size(pjoin(work_dir, 'outputs'))
+    for result in results:
+        result['peak_rss_mb'] = peak_rss / 2 ** 20
+        result['output_dir_bytes'] = output_size
+
+    server.shutdown()
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Prints the measurements that got worse than the baseline by more than tolerance. Returns their number"""
+    baseline = {(r['n_stocks'], r['cycle']): r for r in baseline}
+    checks = [('stocks_per_sec', -1), ('latency_p95_ms', 1), ('peak_rss_mb', 1), ('disk_bytes_written', 1)]
+    n_regressions = 0
+    for result in results:
+        base = baseline.get((result['n_stocks'], result['cycle']))
+        if base is None:
+            continue
+        for key, direction in checks:
+            if not result.get(key) or not base.get(key):
+                continue
+            change = (result[key] - base[key]) / base[key]
+            if change * direction > tolerance:
+                print(f"REGRESSION {result['n_stocks']} stocks {result['cycle']}: {key} {base[key]:.1f} -> {result[key]:.1f} ({change:+.0%})")
+                n_regressions += 1
+    return n_regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark StockMonitor cycles against a local mock OTC backend')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 50000])
+    parser.add_argument('--latency_ms', type=float, default=20)
+    parser.add_argument('--error_rate', type=float, default=0.01)
+    parser.add_argument('--change_rate', type=float, default=0.05)
+    parser.add_argument('--concurrency', type=int, default=20, help='asyncio concurrency, or number of threads with --threads')
+    parser.add_argument('--threads', action='store_true', help='Use the data collection threads instead of asyncio')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='Collect in this many processes with --concurrency threads each. '
+                             'Request latencies are not recorded inside the collector processes')
+    parser.add_argument('--render_plots', action='store_true')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=None, help='Results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    recorder = LatencyRecorder()
+    recorder.install()
+    results = []
+    for n_stocks in args.sizes:
+        for result in run_benchmark(n_stocks, args, recorder):
+            print(f"{result['n_stocks']:>6} stocks {result['cycle']}: {result['stocks_per_sec']:.1f} stocks/sec, "
+                  f"p50 {result.get('latency_p50_ms', 0):.1f}ms, p95 {result.get('latency_p95_ms', 0):.1f}ms, "
+                  f"p99 {result.get('latency_p99_ms', 0):.1f}ms, peak RSS {result['peak_rss_mb']:.0f}MB, "
+                  f"written {result['disk_bytes_written']} bytes")
+            results.append(result)
+    recorder.uninstall()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            n_regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        print(f"{n_regressions} regressions against {args.baseline}")
+        if n_regressions:
+            exit(1)
+
+
+if __name__ == '__main__':
+    import multiprocessing
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,173 @@
+import argparse
+import csv
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from os.path import join as pjoin
+
+import metrics
+import utils
+
+
+class ChangeJournal:
+    """Append-only journal of all field changes as (stock, timestamp, field, from, to) records in one SQLite database
+    indexed by stock and time. Changes are buffered and committed as one group at the end of each cycle."""
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.pending = []
+
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS changes (stock TEXT, ts REAL, field TEXT, from_value TEXT, to_value TEXT);
+            CREATE INDEX IF NOT EXISTS changes_stock_ts ON changes (stock, ts);
+            CREATE INDEX IF NOT EXISTS changes_ts ON changes (ts);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        ''')
+        self.connection.commit()
+
+    def append(self, stock_name, diff, timestamp=None):
+        """Buffers the (field, from, to) rows of a stock's diff until the next commit"""
+        ts = (timestamp or datetime.now()).timestamp()
+        self.lock.acquire()
+        self.pending.extend((stock_name, ts, field, from_value, to_value) for field, from_value, to_value in diff)
+        self.lock.release()
+
+    def commit(self):
+        self.lock.acquire()
+        pending, self.pending = self.pending, []
+        if pending:
+            with metrics.REGISTRY.time('persist_changes'):
+                self.connection.executemany('INSERT INTO changes VALUES (?, ?, ?, ?, ?)', pending)
+                self.connection.commit()
+        self.lock.release()
+        return len(pending)
+
+    def replay(self, changes):
+        """Commits the (stock, date, diff) changes of an interrupted cycle that were not committed before it stopped.
+        A stock's changes are committed together, so ones already in the journal are found by their stock and time"""
+        self.lock.acquire()
+        rows = []
+        for stock_name, timestamp, diff in changes:
+            ts = timestamp.timestamp()
+            if self.connection.execute('SELECT 1 FROM changes WHERE stock = ? AND ts = ? LIMIT 1',
+                                       (stock_name, ts)).fetchone() is None:
+                rows.extend((stock_name, ts, field, from_value, to_value) for field, from_value, to_value in diff)
+        self.connection.executemany('INSERT INTO changes VALUES (?, ?, ?, ?, ?)', rows)
+        self.connection.commit()
+        self.lock.release()
+        return len(rows)
+
+    def query(self, stock_name=None, since=None, until=None, field=None, limit=None):
+        """Returns the committed changes matching the given filters as (stock, date, field, from, to), newest first"""
+        conditions, params = [], []
+        if stock_name is not None:
+            conditions.append('stock = ?')
+            params.append(stock_name)
+        if since is not None:
+            conditions.append('ts >= ?')
+            params.append(since.timestamp())
+        if until is not None:
+            conditions.append('ts < ?')
+            params.append(until.timestamp())
+        if field is not None:
+            conditions.append('field = ?')
+            params.append(field)
+        sql = 'SELECT stock, ts, field, from_value, to_value FROM changes'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY ts DESC'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+
+        self.lock.acquire()
+        rows = self.connection.execute(sql, params).fetchall()
+        self.lock.release()
+        return [(stock, datetime.fromtimestamp(ts), field, from_value, to_value) for stock, ts, field, from_value, to_value in rows]
+
+    def changed_stocks(self, since=None):
+        """Returns the names of the stocks that changed since the given date"""
+        self.lock.acquire()
+        rows = self.connection.execute('SELECT DISTINCT stock FROM changes WHERE ts >= ?',
+                                       (since.timestamp() if since else 0,)).fetchall()
+        self.lock.release()
+        return [row[0] for row in rows]
+
+    def change_counts(self, since=None):
+        """Returns a dictionary of stock name to the number of cycles it changed in since the given date"""
+        self.lock.acquire()
+        rows = self.connection.execute('SELECT stock, COUNT(DISTINCT ts) FROM changes WHERE ts >= ? GROUP BY stock',
+                                       (since.timestamp() if since else 0,)).fetchall()
+        self.lock.release()
+        return dict(rows)
+
+    def compact(self, retention_days):
+        """Drops changes older than retention_days and reclaims their space"""
+        if not retention_days:
+            return 0
+        min_ts = (datetime.now() - timedelta(days=retention_days)).timestamp()
+        self.lock.acquire()
+        n_deleted = self.connection.execute('DELETE FROM changes WHERE ts < ?', (min_ts,)).rowcount
+        self.connection.commit()
+        if n_deleted:
+            self.connection.execute('VACUUM')
+        self.lock.release()
+        return n_deleted
+
+    def import_logs(self, stocks_dir):
+        """One time import of the per change csv files in outputs/stocks/<name>/change_logs"""
+        self.lock.acquire()
+        imported = self.connection.execute("SELECT value FROM meta WHERE key = 'logs_imported'").fetchone()
+        self.lock.release()
+        if imported or not os.path.exists(stocks_dir):
+            return
+
+        n_imported = 0
+        for entry in os.scandir(stocks_dir):
+            logs_dir = pjoin(entry.path, 'change_logs')
+            if not entry.is_dir() or not os.path.exists(logs_dir):
+                continue
+            for log_entry in os.scandir(logs_dir):
+                try:
+                    timestamp = datetime.strptime(os.path.splitext(log_entry.name)[0], '%Y-%m-%d_%H-%M-%S')
+                except ValueError:
+                    continue
+                self.append(entry.name, read_change_log(log_entry.path), timestamp)
+                n_imported += 1
+        self.commit()
+
+        self.lock.acquire()
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('logs_imported', ?)", (utils.get_time_str(),))
+        self.connection.commit()
+        self.lock.release()
+        print(f"Imported {n_imported} change logs into the change journal")
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+def read_change_log(path):
+    """Reads the (field, from, to) rows of a change log csv. Older logs also have a leading row index column"""
+    with open(path, 'r', newline='') as f:
+        rows = list(csv.reader(f))[1:]
+    return [tuple(row[-3:]) for row in rows if len(row) >= 3]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the change journal')
+    parser.add_argument('db_path', help='Path to the changes.db of a monitor output directory')
+    parser.add_argument('--stock', default=None)
+    parser.add_argument('--field', default=None)
+    parser.add_argument('--days', type=float, default=None, help='Only show changes from the last given days')
+    parser.add_argument('--limit', type=int, default=100)
+    args = parser.parse_args()
+
+    journal = ChangeJournal(args.db_path)
+    since = datetime.now() - timedelta(days=args.days) if args.days else None
+    for stock, date, field, from_value, to_value in journal.query(args.stock, since, field=args.field, limit=args.limit):
+        print(f"{str(date).split('.')[0]} {stock}: {field}: {from_value} -> {to_value}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+import argparse
+import hmac
+import ipaddress
+import json
+import os
+import socket
+import threading
+import urllib.error
+import urllib.request
+from time import time
+
+import metrics
+import net_guard
+import utils
+from endpoint_cache import EndpointCache
+from field_projection import FieldProjection
+
+
+class Coordinator:
+    """Hands out the monitor's due stocks to worker nodes over HTTP and merges what they collect into the monitor,
+    which keeps being the only writer of the output directory.
+    Stocks are leased to a node for lease_seconds. Nodes renew their leases with heartbeats that count the stocks they
+    collected, a heartbeat without progress doesn't renew them. The stocks of a node that stopped sending heartbeats or
+    whose collect threads are stuck are put back in the task queue for other nodes.
+    Requests must carry the token, which is required when listening on another interface than loopback."""
+    def __init__(self, monitor, host='127.0.0.1', port=8700, lease_seconds=60, token=''):
+        if not token and not is_loopback(host):
+            raise ValueError(f"A coordinator token is required to accept nodes on {host}")
+        self.monitor = monitor
+        self.lease_seconds = lease_seconds
+        self.token = token
+        self.lock = threading.Lock()
+        self.leases = dict()
+        self.nodes = dict()
+        self.progress = dict()
+        self.reporting = 0
+
+        from http.server import ThreadingHTTPServer
+        self.server = ThreadingHTTPServer((host, port), make_coordinator_handler(self))
+        self.server.daemon_threads = True
+        threading.Thread(name="Coordinator_Server", target=self.server.serve_forever, daemon=True).start()
+        self.stop_event = threading.Event()
+        self.reaper_thread = threading.Thread(name="Lease_Reaper_Thread", target=self._reap_leases, daemon=True)
+        self.reaper_thread.start()
+        metrics.REGISTRY.set_gauge('leases', 'active', lambda: len(self.leases))
+
+    def lease(self, node, max_stocks):
+        """Returns the names of up to max_stocks stocks for the node to collect"""
+        tasks = []
+        while len(tasks) < max_stocks:
+            task = self.monitor.retry_queue.pop_ready() or self.monitor.task_queue.pop()
+            if task is None:
+                break
+            tasks.append(task)
+
+        now = time()
+        self.lock.acquire()
+        self.nodes[node] = now
+        for task in tasks:
+            self.leases[task.name] = (node, now + self.lease_seconds)
+        self.lock.release()
+        return [task.name for task in tasks]
+
+    def heartbeat(self, node, collected=None):
+        """Renews the node's leases, unless it reports it collected no stock since its last heartbeat"""
+        now = time()
+        self.lock.acquire()
+        self.nodes[node] = now
+        if collected is not None:
+            if self.progress.get(node) == collected:
+                self.lock.release()
+                return
+            self.progress[node] = collected
+        for stock_name, (lease_node, expiry) in self.leases.items():
+            if lease_node == node:
+                self.leases[stock_name] = (node, now + self.lease_seconds)
+        self.lock.release()
+
+    def report(self, node, results):
+        """Merges the results of a node. Results of stocks the node no longer holds a lease on are dropped"""
+        for result in results:
+            stock_name = result['stock']
+            self.lock.acquire()
+            lease = self.leases.get(stock_name)
+            owned = lease is not None and lease[0] == node
+            if owned:
+                del self.leases[stock_name]
+                self.reporting += 1
+            self.lock.release()
+            if not owned:
+                metrics.REGISTRY.inc('stale_results')
+                continue
+
+            task = self.monitor.stocks[stock_name]
+            if result.get('values') is None:
+                self.monitor.handle_bad_read(task, node, result.get('paused_for', 0))
+            else:
+                new_data = utils.StockRecord(result['fields'], result['values'])
+                update_plots = self.monitor.diff_stock_data(task, new_data)
+                self.monitor.pipeline.submit_parsed(task, new_data, update_plots)
+
+            self.lock.acquire()
+            self.reporting -= 1
+            self.lock.release()
+        self.heartbeat(node)
+        self.monitor.retry_queue.wake()
+
+    def is_authorized(self, token):
+        return not self.token or hmac.compare_digest(token.encode('utf-8'), self.token.encode('utf-8'))
+
+    def is_idle(self):
+        self.lock.acquire()
+        idle = not self.leases and not self.reporting
+        self.lock.release()
+        return idle
+
+    def collect(self):
+        """Waits until the nodes collected all the due stocks. Runs once per cycle in place of the fetchers"""
+        monitor = self.monitor
+        while not (monitor.task_queue.is_empty() and monitor.retry_queue.is_empty() and self.is_idle()
+                   and monitor.pipeline.is_idle()):
+            monitor.retry_queue.wait(1)
+
+    def _reap_leases(self):
+        while not self.stop_event.wait(1):
+            now = time()
+            self.lock.acquire()
+            expired = [stock_name for stock_name, (node, expiry) in self.leases.items() if expiry < now]
+            for stock_name in expired:
+                del self.leases[stock_name]
+            self.lock.release()
+
+            for stock_name in expired:
+                self.monitor.task_queue.push(self.monitor.stocks[stock_name])
+            if expired:
+                metrics.REGISTRY.inc('leases_expired', len(expired))
+                print(f"Reassigning {len(expired)} stocks whose node stopped sending heartbeats")
+                self.monitor.retry_queue.wake()
+
+    def get_status(self):
+        self.lock.acquire()
+        status = dict(leases=len(self.leases),
+                      nodes={node: round(time() - last_seen, 1) for node, last_seen in self.nodes.items()})
+        self.lock.release()
+        return status
+
+    def terminate(self):
+        self.stop_event.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_coordinator_handler(coordinator):
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if not coordinator.is_authorized(self.headers.get(TOKEN_HEADER, '')):
+                self.send_error(403)
+                return
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if self.path == '/lease':
+                projection = coordinator.monitor.field_projection
+                response = dict(stocks=coordinator.lease(request['node'], request.get('max', 10)),
+                                lease_seconds=coordinator.lease_seconds,
+                                ignore_patterns=projection.ignore_patterns, keep_fields=projection.keep_fields)
+            elif self.path == '/heartbeat':
+                coordinator.heartbeat(request['node'], request.get('collected'))
+                response = dict()
+            elif self.path == '/results':
+                coordinator.report(request['node'], request['results'])
+                response = dict()
+            else:
+                self.send_error(404)
+                return
+            self.send_json(response)
+
+        def do_GET(self):
+            if not coordinator.is_authorized(self.headers.get(TOKEN_HEADER, '')):
+                self.send_error(403)
+                return
+            if self.path != '/status':
+                self.send_error(404)
+                return
+            self.send_json(coordinator.get_status())
+
+        def send_json(self, response):
+            body = json.dumps(response).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+TOKEN_HEADER = 'X-Coordinator-Token'
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+class ClusterWorker:
+    """A node that leases stocks from a coordinator, collects them and reports the parsed records back"""
+    def __init__(self, coordinator_url, node_name, n_threads=8, batch_size=10, api_base_url=utils.OTC_API_URL,
+                 cache=None, token=''):
+        self.coordinator_url = coordinator_url.rstrip('/')
+        self.token = token
+        self.node_name = node_name
+        self.n_threads = n_threads
+        self.batch_size = batch_size
+        self.api_base_url = api_base_url
+        self.cache = cache
+        self.lease_seconds = 60
+        self.projection = None
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.n_collected = 0
+
+    def post(self, path, request):
+        data = json.dumps(dict(request, node=self.node_name)).encode('utf-8')
+        req = urllib.request.Request(self.coordinator_url + path, data,
+                                     {'Content-Type': 'application/json', TOKEN_HEADER: self.token})
+        with urllib.request.urlopen(req, timeout=30) as response:
+            return json.loads(response.read())
+
+    def run(self):
+        threads = [threading.Thread(name=f"Node_Thread_{x}", target=self._collect) for x in range(self.n_threads)]
+        threads.append(threading.Thread(name="Heartbeat_Thread", target=self._send_heartbeats))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _collect(self):
+        while not self.stop_event.is_set():
+            try:
+                response = self.post('/lease', dict(max=self.batch_size))
+            except (urllib.error.URLError, OSError) as e:
+                print(f"{self.node_name}: Coordinator unreachable: {e}")
+                self.stop_event.wait(5)
+                continue
+            self.lease_seconds = response['lease_seconds']
+            if self.projection is None:
+                # Only the fields the coordinator compares or uses are sent back
+                self.projection = FieldProjection(response['ignore_patterns'], response['keep_fields'])
+            if not response['stocks']:
+                self.stop_event.wait(1)
+                continue
+
+            results = []
+            for stock_name in response['stocks']:
+                raw_data = utils.get_raw_stock_data(stock_name, self.api_base_url, self.cache)
+                new_data = utils.parse_raw_stock_data(raw_data, self.projection) if raw_data else None
+                if new_data is None:
+                    results.append(dict(stock=stock_name, paused_for=net_guard.paused_for(self.api_base_url)))
+                else:
+                    results.append(dict(stock=stock_name, fields=new_data.fields, values=new_data.values))
+                self.lock.acquire()
+                self.n_collected += 1
+                self.lock.release()
+            try:
+                self.post('/results', dict(results=results))
+            except (urllib.error.URLError, OSError) as e:
+                # The leases will expire and the stocks are given to another node
+                print(f"{self.node_name}: Failed reporting {len(results)} stocks: {e}")
+
+    def _send_heartbeats(self):
+        while not self.stop_event.wait(self.lease_seconds / 3):
+            try:
+                self.post('/heartbeat', dict(collected=self.n_collected))
+            except (urllib.error.URLError, OSError) as e:
+                print(f"{self.node_name}: Heartbeat failed: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Collect stocks for a coordinator '
+                                                 '(python headless.py --coordinator_port PORT)')
+    parser.add_argument('--coordinator_url', required=True, help='e.g http://192.168.1.10:8700')
+    parser.add_argument('--node_name', default=f"{socket.gethostname()}-{os.getpid()}")
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--batch_size', type=int, default=10, help='Stocks leased at once by each thread')
+    parser.add_argument('--api_base_url', default=utils.OTC_API_URL)
+    parser.add_argument('--token', default=os.environ.get('COORDINATOR_TOKEN', ''),
+                        help='The coordinator token, COORDINATOR_TOKEN by default')
+    parser.add_argument('--profile_ttl_minutes', type=float, default=60)
+    parser.add_argument('--news_ttl_minutes', type=float, default=30)
+    parser.add_argument('--news_source_ttl_minutes', type=float, default=24 * 60)
+    parser.add_argument('--requests_per_second', type=float, default=20)
+    parser.add_argument('--request_burst', type=int, default=40)
+    args = parser.parse_args()
+
+    net_guard.configure(args.requests_per_second, args.request_burst)
+    cache = EndpointCache({'profile': args.profile_ttl_minutes * 60, 'news': args.news_ttl_minutes * 60,
+                           'news_source': args.news_source_ttl_minutes * 60})
+    worker = ClusterWorker(args.coordinator_url, args.node_name, args.threads, args.batch_size, args.api_base_url,
+                           cache, args.token)
+    print(f"{args.node_name}: Collecting for {args.coordinator_url}")
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+if __name__ == '__main__':
+    main()
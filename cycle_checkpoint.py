@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+from datetime import datetime
+from time import time
+
+import utils
+
+
+class CycleCheckpoint:
+    """Append-only journal of the progress of the running cycle, one json line per event: the stocks the cycle started
+    with, then every stock that was collected with its new record and diff, or that couldn't be read.
+    Lines are written as they happen and synced to disk at most every sync_seconds. The file is removed once the cycle
+    was committed, so a file left behind belongs to a cycle that was interrupted and can be resumed."""
+    def __init__(self, path, sync_seconds=1.0):
+        self.path = path
+        self.sync_seconds = sync_seconds
+        self.lock = threading.Lock()
+        self.file = None
+        self.layout_ids = dict()
+        self.last_sync = 0
+
+    def load(self):
+        """Returns the interrupted cycle as a dictionary with the 'stocks' it started with, the 'done' stocks as
+        (stock, record, date, diff) and the 'bad' stocks, or None if there is none"""
+        if not os.path.exists(self.path):
+            return None
+        cycle, layouts, done, bad = None, dict(), [], []
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line may have been cut by the crash
+                    break
+                if 'cycle' in entry:
+                    cycle = entry
+                elif 'fields' in entry:
+                    layouts[entry['layout']] = entry['fields']
+                elif entry.get('bad'):
+                    bad.append(entry['stock'])
+                else:
+                    record = utils.StockRecord(layouts[entry['layout']], entry['values'])
+                    done.append((entry['stock'], record, datetime.fromtimestamp(entry['date']), entry['diff']))
+        if cycle is None:
+            return None
+        return dict(stocks=cycle['stocks'], done=done, bad=bad)
+
+    def start_cycle(self, stock_names):
+        """Starts a new checkpoint for a cycle over the given stocks"""
+        self.lock.acquire()
+        self._close()
+        self.file = open(self.path, 'w')
+        self._write({'cycle': time(), 'stocks': stock_names})
+        self._sync()
+        self.lock.release()
+
+    def resume_cycle(self):
+        """Keeps appending to the checkpoint of the interrupted cycle"""
+        self.lock.acquire()
+        self._close()
+        self.file = open(self.path, 'a')
+        self.lock.release()
+
+    def record(self, stock_name, record, modification_date, diff):
+        self.lock.acquire()
+        if self.file is not None:
+            layout_id = self.layout_ids.get(record.fields)
+            if layout_id is None:
+                layout_id = self.layout_ids[record.fields] = len(self.layout_ids)
+                self._write({'layout': layout_id, 'fields': record.fields})
+            self._write({'stock': stock_name, 'date': modification_date.timestamp(), 'layout': layout_id,
+                         'values': record.values, 'diff': diff})
+        self.lock.release()
+
+    def record_bad(self, stock_name):
+        self.lock.acquire()
+        if self.file is not None:
+            self._write({'stock': stock_name, 'bad': True})
+        self.lock.release()
+
+    def clear(self):
+        """Drops the checkpoint of a cycle whose results were all committed"""
+        self.lock.acquire()
+        self._close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.lock.release()
+
+    def close(self):
+        """Syncs and closes the checkpoint but keeps it, the cycle is resumed on the next start"""
+        self.lock.acquire()
+        self._close()
+        self.lock.release()
+
+    def _write(self, entry):
+        self.file.write(json.dumps(entry) + '\n')
+        # Flushed on every line so nothing is lost if only the process dies, synced periodically for power loss
+        self.file.flush()
+        if time() - self.last_sync > self.sync_seconds:
+            self._sync()
+
+    def _sync(self):
+        os.fsync(self.file.fileno())
+        self.last_sync = time()
+
+    def _close(self):
+        if self.file is not None:
+            self._sync()
+            self.file.close()
+            self.file = None
+            self.layout_ids = dict()
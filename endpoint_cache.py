@@ -0,0 +1,44 @@
+import threading
+from time import time
+
+
+class EndpointCache:
+    """Keeps the slow changing endpoints of each stock (company profile, last news and the news source that answers)
+    so they are only queried again once their time to live is over. Prices are never cached."""
+    def __init__(self, ttls, refresh_profile_on_tick=True):
+        self.ttls = ttls
+        self.refresh_profile_on_tick = refresh_profile_on_tick
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.ticks = dict()
+
+    def get(self, stock_name, endpoint):
+        """Returns a copy of the cached value or None if it is missing or expired"""
+        self.lock.acquire()
+        entry = self.entries.get((stock_name, endpoint))
+        self.lock.release()
+        if entry is None or time() - entry[0] > self.ttls[endpoint]:
+            return None
+        value = entry[1]
+        return dict(value) if type(value) == dict else value
+
+    def put(self, stock_name, endpoint, value):
+        self.lock.acquire()
+        self.entries[(stock_name, endpoint)] = (time(), dict(value) if type(value) == dict else value)
+        self.lock.release()
+
+    def invalidate(self, stock_name, endpoint):
+        self.lock.acquire()
+        self.entries.pop((stock_name, endpoint), None)
+        self.lock.release()
+
+    def tick_changed(self, stock_name, prices_dict):
+        """Records the current price tick of the stock and tells if the profile should be forced to refresh"""
+        if not prices_dict or not self.refresh_profile_on_tick:
+            return False
+        tick = (prices_dict.get('lastSale'), prices_dict.get('tickName'))
+        self.lock.acquire()
+        last_tick = self.ticks.get(stock_name)
+        self.ticks[stock_name] = tick
+        self.lock.release()
+        return last_tick is not None and last_tick != tick
@@ -0,0 +1,51 @@
+class FieldProjection:
+    """Flattens a raw stock dictionary like utils.flatten_dict, but only into the fields that are compared or used.
+    A field is dropped if it is ignored, unless it is one of keep_fields (plotted or price fields). Ignore patterns
+    ending with '*' ignore every field starting with the rest of the pattern, whole sub dictionaries and lists under
+    such a prefix are skipped without being walked. Decisions are computed once per flattened key."""
+    def __init__(self, ignore_patterns, keep_fields=(), sep='_'):
+        self.ignore_patterns = sorted(set(ignore_patterns))
+        self.keep_fields = sorted(set(keep_fields))
+        self.sep = sep
+        self.exact = frozenset(p for p in self.ignore_patterns if p and not p.endswith('*'))
+        self.prefixes = tuple(p[:-1] for p in self.ignore_patterns if p.endswith('*'))
+        self.keep = frozenset(self.keep_fields)
+        # Fields that are kept in the records but must not be compared
+        self.compare_ignore = self.exact | frozenset(f for f in self.keep if f.startswith(self.prefixes))
+        self.kept_keys = dict()
+        self.pruned_paths = dict()
+
+    def __reduce__(self):
+        return FieldProjection, (self.ignore_patterns, self.keep_fields, self.sep)
+
+    def flatten(self, d):
+        """Returns the kept (key, value) pairs, in the same order as flatten_dict"""
+        items = []
+        self._flatten(d.items(), '', items)
+        return items
+
+    def _flatten(self, pairs, parent_key, items):
+        for k, v in pairs:
+            key = parent_key + self.sep + k if parent_key else k
+            if type(v) == list:
+                if not self._is_pruned(key):
+                    self._flatten(((str(i), x) for i, x in enumerate(v)), key, items)
+            elif type(v) == dict:
+                if not self._is_pruned(key):
+                    self._flatten(v.items(), key, items)
+            elif self._is_kept(key):
+                items.append((key, v))
+
+    def _is_kept(self, key):
+        kept = self.kept_keys.get(key)
+        if kept is None:
+            kept = self.kept_keys[key] = key in self.keep or not (key in self.exact or key.startswith(self.prefixes))
+        return kept
+
+    def _is_pruned(self, path):
+        pruned = self.pruned_paths.get(path)
+        if pruned is None:
+            sub_prefix = path + self.sep
+            pruned = self.pruned_paths[path] = (sub_prefix.startswith(self.prefixes) and
+                                                not any(f.startswith(sub_prefix) for f in self.keep))
+        return pruned
@@ -6,9 +6,11 @@ import datetime
 
 import utils
 import os
-from pathlib import Path
 
-from utils import get_img_data, dump_stocks_plot
+from functools import partial
+
+from image_cache import ImageCache
+from price_chart import PriceChartService, SORT_ORDERS
 
 
 def t_print(x, end=None):
@@ -37,7 +39,9 @@ def get_run_layout(stock_names):
                         title_location=sg.TITLE_LOCATION_TOP),
                ],
               [debug_col_1, debug_col_2],
-              [sg.Text(f"Next run in N/A", key='time_to_next_run', size=(15, 1)), sg.Drop([0, 1, 5, 10, 30, 60], key='wait_time', default_value=30),
+              [sg.Frame("Screener", [[sg.Input(key='screen_query', size=(50, 1)), sg.Button('Screen', key='screen')]],
+                        title_location=sg.TITLE_LOCATION_TOP)],
+              [sg.Text(f"Next run in N/A", key='time_to_next_run', size=(15, 1)), sg.Drop([0, 1, 5, 10, 30, 60], key='wait_time', default_value=1),
                sg.Text(f"Data collecting threads:", size=(17, 1)), sg.Drop([1, 2, 3, 4, 5], key='n_threads', default_value=2),
                # sg.Text(f"Bad reads: 0", key='bad_reads', size=(17, 1)),
                ],
@@ -45,7 +49,7 @@ def get_run_layout(stock_names):
               [sg.Text('Progress:'),
                sg.ProgressBar(len(stock_names), size=(20, 20), orientation='h', key='PROGRESS_BAR'),
                sg.Text('', key='PROGRESS_TXT', size=(20, 1))],
-              [sg.Checkbox('Sound-Alarm', True, key='alarm')],
+              [sg.Checkbox('Sound-Alarm', True, key='alarm', enable_events=True)],
               [sg.Button('Run'), sg.Button('Exit')]
               ]
 
@@ -60,6 +64,8 @@ def manage_monitor(monitor):
     # --------------------- Read arguments ---------------------
     # --------------------- Run ---------------------
     layout = get_run_layout(monitor.stock_names)
+    price_charts = PriceChartService(monitor.output_dir, monitor.price_table)
+    image_cache = ImageCache()
 
     window = sg.Window('StockMonitor', layout, finalize=True)
     window.read(timeout=1)
@@ -72,10 +78,14 @@ def manage_monitor(monitor):
 
         # --------------------- Handle gui requests ---------------------
 
+        if event in ('list_box1', 'show1') and values['list_box1']:
+            prefetch_neighbour_stocks(window['list_box1'].get_list_values(), values['list_box1'][0], monitor,
+                                      image_cache)
         if event == 'show1':
-            show_stock_images(values['list_box1'][0], monitor.output_dir)
+            show_stock_images(values['list_box1'][0], monitor.output_dir, monitor.plot_renderer,
+                              monitor.screenshot_store, image_cache)
         if event == 'show2':
-            show_price_changes(values['list_box2'], monitor.output_dir)
+            show_price_changes(values['list_box2'], price_charts, image_cache)
         for i in range(1, 3):
             if event == f'filter{i}':
                 window[f'list_box{i}'].update(
@@ -84,6 +94,10 @@ def manage_monitor(monitor):
             window['list_box2'].set_value(monitor.stock_names)
         if event == f'clr2':
             window['list_box2'].set_value([])
+        if event == 'alarm':
+            monitor.alerts.set_sink_enabled('sound', values['alarm'])
+        if event == 'screen' and values['screen_query']:
+            screen_stocks(monitor, values['screen_query'], window)
         if event in (sg.WIN_CLOSED, 'Exit'):
             break
 
@@ -91,21 +105,22 @@ def manage_monitor(monitor):
         # Initiate data collecting thread
         if event == 'Run' or time() - timer > 60 * values['wait_time']:
             if not monitor.collecting_data:
-                t_print(f"Starting data collection {values['n_threads']} threads")
-                monitor.init_dc_threads(values['n_threads'])
-            else:
+                n_due = monitor.init_dc_threads(values['n_threads'])
+                run_start = time()
+                if n_due:
+                    t_print(f"Starting data collection of {n_due} due stocks {values['n_threads']} threads")
+                else:
+                    timer = time()
+            elif event == 'Run':
                 t_print("Already running")
         if monitor.collecting_data:
-            window['PROGRESS_BAR'].update_bar(monitor.progress)
-            window['PROGRESS_TXT'].update(f"{monitor.progress}/{len(monitor.stock_names)}  ({monitor.progress / (time() - timer):.1f} stocks/sec)")
+            window['PROGRESS_BAR'].update_bar(monitor.progress, monitor.cycle_size)
+            window['PROGRESS_TXT'].update(f"{monitor.progress}/{monitor.cycle_size}  ({monitor.progress / (time() - run_start):.1f} stocks/sec)")
             new_changes = monitor.query_changes()
             if new_changes:
                 monitor.add_screenshot_tasks(new_changes)
                 new_changes = '\n'.join(new_changes)
                 window['status'].update(f"{new_changes}\n" + window['status'].get())
-                if values['alarm']:
-                    from playsound import playsound
-                    playsound(os.path.join('icons', 'icq-uh-oh.mp3'))
 
             # if not monitor.queue:
             if monitor.is_all_tasks_done():
@@ -115,9 +130,9 @@ def manage_monitor(monitor):
                 t_print(f"Data collection Done: \n"
                         f"   - {monitor.num_bad_data_reads} stocks were not read\n"
                         f"   - {len(monitor.changes_list)} stocks changed "
-                        f"   - Speed: ({len(monitor.stock_names) / (time() - timer):.1f} stocks/sec)")
+                        f"   - Speed: ({monitor.cycle_size / (time() - run_start):.1f} stocks/sec)")
                 window['status'].update(f"########################\n" + window['status'].get())
-                monitor._update_changes_log()
+                monitor.finish_cycle()
                 monitor.reinit_state()
                 timer = time()
 
@@ -125,18 +140,47 @@ def manage_monitor(monitor):
     window.close()
 
 
-def show_price_changes(stock_name_list, output_dir):
-    """Dump a plot of price changes of chosen stocks"""
+def screen_stocks(monitor, expression, window):
+    """Selects the stocks matching a screener expression in the prices list"""
+    try:
+        matches = monitor.screen(expression)
+    except ValueError as e:
+        t_print(f"Screener: {e}")
+        return
+    stock_names = matches['stock'].tolist()
+    t_print(f"Screener: {len(stock_names)} stocks match {expression}")
+    window['list_box2'].update(stock_names)
+    window['list_box2'].set_value(stock_names)
+
+
+def show_price_changes(stock_name_list, price_charts, image_cache):
+    """Shows the price changes of chosen stocks a page at a time"""
     default_img_path = os.path.join('icons', 'no-img.png')
 
-    layout = [[sg.Image(key='plot', filename=default_img_path)], [sg.Button('Exit')]]
+    layout = [[sg.Image(key='plot', filename=default_img_path)],
+              [sg.Text('Sort by:'), sg.Drop(SORT_ORDERS, key='sort', default_value='move', enable_events=True),
+               sg.Text('Top:'), sg.Drop(['All', 20, 50, 100, 500], key='top_k', default_value='All', enable_events=True),
+               sg.Button('<', key='prev'), sg.Text('', key='page', size=(10, 1)), sg.Button('>', key='next')],
+              [sg.Button('Exit')]]
     window = sg.Window("StockMonitor", layout, modal=True, finalize=True)
 
-    plot_path = dump_stocks_plot(output_dir, stock_name_list)
-    if os.path.exists(plot_path):
-        img_data = get_img_data(plot_path, first=True, maxsize=(1000,1000))
-        window.Element(f"plot").Update(data=img_data)
+    page = 0
+    event, values = None, dict(sort='move', top_k='All')
     while True:
+        if event == 'prev':
+            page = max(0, page - 1)
+        elif event == 'next':
+            page += 1
+        elif event in ('sort', 'top_k'):
+            page = 0
+        top_k = None if values['top_k'] == 'All' else int(values['top_k'])
+        plot_path, n_pages = price_charts.get_chart(stock_name_list, values['sort'], top_k, page)
+        page = min(page, n_pages - 1)
+        img_data = image_cache.get(plot_path, maxsize=(1500, 1000))
+        if img_data is not None:
+            window.Element(f"plot").Update(data=img_data)
+        window['page'].update(f"{page + 1}/{n_pages}")
+
         event, values = window.read()
         if event == "Exit" or event == sg.WIN_CLOSED:
             break
@@ -144,8 +188,9 @@ def show_price_changes(stock_name_list, output_dir):
     window.close()
 
 
-def show_stock_images(stock_name, output_dir):
+def show_stock_images(stock_name, output_dir, plot_renderer, screenshot_store, image_cache):
     """Shows before after images and plot fields graph"""
+    plot_renderer.ensure_rendered(os.path.join(output_dir, "stocks", stock_name))
     default_img_path = os.path.join('icons', 'no-img.png')
 
     img_col1 = sg.Col([
@@ -158,7 +203,7 @@ def show_stock_images(stock_name, output_dir):
     layout = [[img_col1, img_col2], [sg.Button('Exit')]]
     window = sg.Window("StockMonitor", layout, modal=True, finalize=True)
 
-    try_load_stock_images(output_dir, window, stock_name)
+    try_load_stock_images(output_dir, window, stock_name, screenshot_store, image_cache)
 
     while True:
         event, values = window.read()
@@ -168,28 +213,44 @@ def show_stock_images(stock_name, output_dir):
     window.close()
 
 
-def try_load_stock_images(output_dir, window, stock_name):
+def get_stock_images(output_dir, stock_name, screenshot_store):
+    """Returns the (name, path, time, maxsize) of the images shown for a stock"""
+    plot_path = os.path.join(output_dir, "stocks", stock_name, 'special_fields.png')
     image_paths = [
-        ('Stock-graph', os.path.join(output_dir, "stocks", stock_name, 'special_fields.png'), None, (350, 350))
+        ('Stock-graph', plot_path, os.path.getmtime(plot_path) if os.path.exists(plot_path) else None, (350, 350))
     ]
-    overview_images_dir = os.path.join(output_dir, "stocks", stock_name, "status_images", 'overview')
-    if os.path.exists(overview_images_dir):
-        img_paths = sorted(Path(overview_images_dir).iterdir(), key=os.path.getmtime)
-        before_last_img_path = last_img_path = None
-        if len(img_paths) >= 1:
-            last_img_path = img_paths[-1]
-        if len(img_paths) > 1:
-            before_last_img_path = img_paths[-2]
-
-        image_paths += [
-            ('before-last image', before_last_img_path, (0, 275, 1050, 600), (500, 150)),
-            ('Last image', last_img_path, (0, 275, 1050, 600), (500, 150)),
-        ]
-
-    for i, (name, img_path, crop, maxsize) in enumerate(image_paths):
-        if img_path and os.path.exists(img_path):
-            # window.Element(f"status_image_{i}").Update(filename=img_path)
-            img_data = get_img_data(img_path, first=True, crop=crop, maxsize=maxsize)
+    # The screenshot store keeps the thumbnails already cropped
+    last_images = [None, None] + screenshot_store.latest(stock_name, 'overview', 2)
+    for name, last_image in zip(['before-last image', 'Last image'], last_images[-2:]):
+        thumbnail_path, capture_time = (last_image[1], last_image[2]) if last_image else (None, None)
+        image_paths.append((name, thumbnail_path, capture_time, (500, 150)))
+    return image_paths
+
+
+def try_load_stock_images(output_dir, window, stock_name, screenshot_store, image_cache):
+    for i, (name, img_path, img_time, maxsize) in enumerate(get_stock_images(output_dir, stock_name, screenshot_store)):
+        img_data = image_cache.get(img_path, maxsize=maxsize) if img_path else None
+        if img_data is not None:
             window.Element(f"status_image_{i}").Update(data=img_data)
-            date_str = str(datetime.datetime.fromtimestamp(os.path.getmtime(img_path))).split('.')[0]
+            date_str = str(datetime.datetime.fromtimestamp(img_time)).split('.')[0]
             window.Element(f"Frame_{i}").Update(f"{name}: {date_str}")
+
+
+def load_stock_images(stock_name, monitor):
+    """Renders the stock's plot if needed and returns its images for prefetching"""
+    monitor.plot_renderer.ensure_rendered(os.path.join(monitor.output_dir, "stocks", stock_name))
+    images = get_stock_images(monitor.output_dir, stock_name, monitor.screenshot_store)
+    return [(img_path, maxsize, None) for name, img_path, img_time, maxsize in images if img_path]
+
+
+def prefetch_neighbour_stocks(stock_names, stock_name, monitor, image_cache, n_neighbours=2):
+    """Prepares the images of the stocks around the selected one in the list so moving to them is instant"""
+    if stock_name not in stock_names:
+        return
+    i = stock_names.index(stock_name)
+    image_cache.cancel_prefetch()
+    # Closest first
+    neighbours = sorted(range(max(0, i - n_neighbours), min(len(stock_names), i + n_neighbours + 1)),
+                        key=lambda j: abs(j - i))
+    for j in neighbours:
+        image_cache.prefetch(stock_names[j], partial(load_stock_images, stock_names[j], monitor))
@@ -0,0 +1,132 @@
+import argparse
+import json
+import signal
+import sys
+import threading
+from time import time
+
+import metrics
+from stock_monitor import StockMonitor, add_monitor_arguments
+
+
+def log_event(event, **fields):
+    """Prints a structured log line"""
+    print(json.dumps(dict(ts=round(time(), 3), event=event, **fields)), flush=True)
+
+
+class HeadlessRunner:
+    """Drives a StockMonitor without a GUI: collects the due stocks, reports progress and changes, and checks for due
+    stocks again at least every interval_seconds until stopped. The stocks matching each screener expression are
+    logged after every cycle"""
+    def __init__(self, monitor, n_threads=2, interval_seconds=60, progress_seconds=10, screens=()):
+        self.monitor = monitor
+        self.screens = list(screens)
+        self.n_threads = n_threads
+        self.interval_seconds = interval_seconds
+        self.progress_seconds = progress_seconds
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(name="Headless_Scheduler", target=self._run)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def join(self):
+        # Join with a timeout so the main thread keeps handling signals
+        while self.thread.is_alive():
+            self.thread.join(0.5)
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            run_start = time()
+            n_due = self.monitor.init_dc_threads(self.n_threads)
+            if n_due:
+                log_event('cycle_started', stocks=n_due)
+                self._watch_cycle(run_start)
+
+            next_due = self.monitor.scheduler.next_due_time()
+            wait = self.interval_seconds if next_due is None else min(self.interval_seconds, max(0, next_due - time()))
+            self.stop_event.wait(max(wait, 1))
+
+    def _watch_cycle(self, run_start):
+        last_report = time()
+        while not self.monitor.is_all_tasks_done():
+            if self.stop_event.wait(0.5):
+                # Drop what was not collected yet, the scheduler still has those stocks due
+                self.monitor.task_queue.clear()
+                self.monitor.retry_queue.clear()
+                break
+            self._report_changes()
+            if time() - last_report > self.progress_seconds:
+                progress, bad_reads = self.monitor.get_status()
+                log_event('progress', done=progress, total=self.monitor.cycle_size, bad_reads=bad_reads,
+                          stocks_per_sec=round(progress / (time() - run_start), 2))
+                last_report = time()
+
+        self.monitor.join_dc_threads()
+        self._report_changes()
+        progress, bad_reads = self.monitor.get_status()
+        log_event('cycle_done', done=progress, total=self.monitor.cycle_size, bad_reads=bad_reads,
+                  changed=len(self.monitor.changes_list), seconds=round(time() - run_start, 2),
+                  stocks_per_sec=round(progress / (time() - run_start), 2))
+        self.monitor.finish_cycle()
+        self.monitor.reinit_state()
+        self._report_screens()
+
+    def _report_screens(self):
+        for expression in self.screens:
+            start = time()
+            try:
+                matches = self.monitor.screen(expression)
+            except ValueError as e:
+                log_event('screen_error', query=expression, error=str(e))
+                continue
+            log_event('screen', query=expression, stocks=matches['stock'].tolist(),
+                      milliseconds=round((time() - start) * 1000, 2))
+
+    def _report_changes(self):
+        new_changes = self.monitor.query_changes()
+        if new_changes:
+            self.monitor.add_screenshot_tasks(new_changes)
+            log_event('changes', stocks=new_changes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Monitor OTC Markets stocks for changes without a GUI')
+    add_monitor_arguments(parser)
+    parser.add_argument('--n_threads', type=int, default=2, help='Data collecting threads when using --threads_fetch')
+    parser.add_argument('--interval_seconds', type=float, default=60, help='Longest time between checks for due stocks')
+    parser.add_argument('--progress_seconds', type=float, default=10)
+    parser.add_argument('--screen', action='append', default=[], metavar='EXPRESSION',
+                        help="Log the stocks matching a screener expression after each cycle, can be repeated. "
+                             "For example: \"grew(securities_0_outstandingShares) and percentChange > 20\"")
+    args = parser.parse_args()
+
+    monitor = StockMonitor(args)
+    # Alerts are logged as events, there is no one to hear a sound
+    monitor.alerts.add_sink('log', lambda alert: log_event('alert', **{k: v for k, v in alert.items() if k != 'ts'}))
+    monitor.alerts.set_sink_enabled('sound', False)
+    runner = HeadlessRunner(monitor, args.n_threads, args.interval_seconds, args.progress_seconds, args.screen)
+
+    def handle_signal(signum, frame):
+        log_event('stopping', signal=signum)
+        runner.stop()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    log_event('started', stocks=len(monitor.stock_names), output_dir=monitor.output_dir,
+              startup_seconds=metrics.startup_phases())
+    runner.start()
+    runner.join()
+    monitor.terminate()
+    log_event('stopped')
+    sys.exit()
+
+
+if __name__ == '__main__':
+    import multiprocessing
+    multiprocessing.freeze_support()
+    main()
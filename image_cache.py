@@ -0,0 +1,73 @@
+import os
+import threading
+from collections import OrderedDict
+
+from utils import get_img_data
+
+
+class ImageCache:
+    """LRU cache of the PNG bytes the GUI shows, keyed by the image path, its modification time and the size it is
+    shown at, so an image is decoded and thumbnailed again only after it changed. Holds up to max_bytes.
+    Stocks can be prefetched in the background with a loader returning the (path, maxsize, crop) images of a stock."""
+    def __init__(self, max_bytes=64 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+
+        self.prefetch_condition = threading.Condition(threading.Lock())
+        self.prefetch_jobs = OrderedDict()
+        self.prefetch_thread = threading.Thread(name="Image_Prefetch_Thread", target=self._prefetch_worker, daemon=True)
+        self.prefetch_thread.start()
+
+    def get(self, path, maxsize=(200, 200), crop=None):
+        """Returns the PNG bytes of the image shrunk to maxsize, or None if it doesn't exist"""
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        key = (str(path), mtime, maxsize, crop)
+        self.lock.acquire()
+        data = self.entries.get(key)
+        if data is not None:
+            self.entries.move_to_end(key)
+        self.lock.release()
+        if data is not None:
+            return data
+
+        data = get_img_data(path, maxsize=maxsize, first=True, crop=crop)
+        self.lock.acquire()
+        if key not in self.entries:
+            self.entries[key] = data
+            self.n_bytes += len(data)
+        while self.n_bytes > self.max_bytes and len(self.entries) > 1:
+            _, old_data = self.entries.popitem(last=False)
+            self.n_bytes -= len(old_data)
+        self.lock.release()
+        return data
+
+    def prefetch(self, key, loader):
+        """Queues loader() to run in the background and caches the images it returns. Queued keys are not repeated"""
+        self.prefetch_condition.acquire()
+        self.prefetch_jobs[key] = loader
+        self.prefetch_condition.notify()
+        self.prefetch_condition.release()
+
+    def cancel_prefetch(self):
+        """Drops the prefetches that didn't start yet, e.g the neighbours of a stock the user already scrolled past"""
+        self.prefetch_condition.acquire()
+        self.prefetch_jobs.clear()
+        self.prefetch_condition.release()
+
+    def _prefetch_worker(self):
+        while True:
+            self.prefetch_condition.acquire()
+            while not self.prefetch_jobs:
+                self.prefetch_condition.wait()
+            _, loader = self.prefetch_jobs.popitem(last=False)
+            self.prefetch_condition.release()
+            try:
+                for path, maxsize, crop in loader():
+                    self.get(path, maxsize, crop)
+            except Exception as e:
+                print(f"Failed to prefetch images: {e}")
@@ -2,21 +2,17 @@ import argparse
 import sys
 from time import sleep
 
-from gui_driver import manage_monitor
-from stock_monitor import StockMonitor
+import metrics
+from stock_monitor import StockMonitor, add_monitor_arguments
 
 
 def main():
-    parser = argparse.ArgumentParser(description='Process some integers.')
+    parser = argparse.ArgumentParser(description='Monitor OTC Markets stocks for changes')
+    add_monitor_arguments(parser)
     args = parser.parse_args()
-    args.query_freq_minutes = 15
-    args.output_dir = 'outputs'
-    args.stock_names_path = 'csvs\stock_names.csv'
-    args.ignore_fields_path = 'csvs\ignore_fields.csv'
-    args.plot_fields_path = 'csvs\plot_fields.csv'
-    args.chrome_driver = 'chromedriver.exe'
-    args.screenshot_wait_time = 3
 
+    with metrics.REGISTRY.time('import_gui', metric='startup_seconds'):
+        from gui_driver import manage_monitor
     monitor = StockMonitor(args)
 
     manage_monitor(monitor)
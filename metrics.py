@@ -0,0 +1,220 @@
+import json
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+# Taken when the first module of the monitor is imported, the reference of the startup report
+START_TIME = perf_counter()
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def add(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'mean': self.sum / self.count if self.count else 0,
+                'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'], self.counts))}
+
+
+class Timer:
+    def __init__(self, registry, metric, label):
+        self.registry = registry
+        self.metric = metric
+        self.label = label
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.registry.observe(self.metric, self.label, perf_counter() - self.start)
+
+
+class MetricsRegistry:
+    """Histograms, counters and gauges of a running monitor, exportable as JSON or Prometheus text"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = dict()
+        self.counters = dict()
+        self.gauges = dict()
+        # (metric, label, histogram) updated by their owner without the registry lock, read when exported
+        self.owned_histograms = []
+
+    def observe(self, metric, label, seconds):
+        self.lock.acquire()
+        histogram = self.histograms.get((metric, label))
+        if histogram is None:
+            histogram = self.histograms[(metric, label)] = Histogram()
+        histogram.observe(seconds)
+        self.lock.release()
+
+    def time(self, label, metric='stage_seconds'):
+        """Context manager timing a stage into the stage_seconds histogram"""
+        return Timer(self, metric, label)
+
+    def inc(self, counter, n=1):
+        self.lock.acquire()
+        self.counters[counter] = self.counters.get(counter, 0) + n
+        self.lock.release()
+
+    def add_histogram(self, metric, label, histogram):
+        """Exports a histogram its owner updates under its own lock"""
+        self.lock.acquire()
+        self.owned_histograms.append((metric, label, histogram))
+        self.lock.release()
+
+    def get_histograms(self):
+        """All the histograms by (metric, label), the owned ones with the same metric and label added up.
+        Must be called with the lock held"""
+        histograms = dict(self.histograms)
+        for metric, label, histogram in self.owned_histograms:
+            total = Histogram()
+            for h in (histograms.get((metric, label)), histogram):
+                if h is not None:
+                    total.add(h)
+            histograms[(metric, label)] = total
+        return histograms
+
+    def set_gauge(self, metric, label, get_value):
+        """Registers a callable that is read whenever the metrics are exported"""
+        self.lock.acquire()
+        self.gauges[(metric, label)] = get_value
+        self.lock.release()
+
+    def to_dict(self):
+        self.lock.acquire()
+        histograms = {f"{metric}[{label}]": h.to_dict() for (metric, label), h in self.get_histograms().items()}
+        counters = dict(self.counters)
+        gauges = list(self.gauges.items())
+        self.lock.release()
+        return {'histograms': histograms, 'counters': counters,
+                'gauges': {f"{metric}[{label}]": get_value() for (metric, label), get_value in gauges}}
+
+    def to_prometheus(self):
+        label_names = {'stage_seconds': 'stage', 'lock_wait_seconds': 'lock', 'queue_depth': 'queue',
+                       'startup_seconds': 'phase'}
+        lines = []
+
+        def describe(name, kind, metric):
+            lines.append(f"# HELP {name} {METRIC_HELP.get(metric, metric.replace('_', ' ').capitalize())}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        self.lock.acquire()
+        last_metric = None
+        for (metric, label), h in sorted(self.get_histograms().items()):
+            name = f"stock_monitor_{metric}"
+            if metric != last_metric:
+                describe(name, 'histogram', metric)
+                last_metric = metric
+            label_str = f'{label_names.get(metric, "label")}="{label}"'
+            cumulative = 0
+            for bucket, count in zip([str(b) for b in BUCKETS] + ['+Inf'], h.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{label_str},le="{bucket}"}} {cumulative}')
+            lines.append(f'{name}_sum{{{label_str}}} {h.sum}')
+            lines.append(f'{name}_count{{{label_str}}} {h.count}')
+        for counter, value in sorted(self.counters.items()):
+            describe(f'stock_monitor_{counter}_total', 'counter', counter)
+            lines.append(f'stock_monitor_{counter}_total {value}')
+        gauges = sorted(self.gauges.items())
+        self.lock.release()
+        for (metric, label), get_value in gauges:
+            if metric != last_metric:
+                describe(f'stock_monitor_{metric}', 'gauge', metric)
+                last_metric = metric
+            lines.append(f'stock_monitor_{metric}{{{label_names.get(metric, "label")}="{label}"}} {get_value()}')
+        return '\n'.join(lines) + '\n'
+
+
+METRIC_HELP = {'stage_seconds': 'Seconds spent in each stage of collecting a stock',
+               'lock_wait_seconds': 'Seconds waited to acquire each instrumented lock',
+               'startup_seconds': 'Seconds taken by each startup phase',
+               'queue_depth': 'Items waiting in each queue'}
+
+REGISTRY = MetricsRegistry()
+
+
+def startup_phases(registry=REGISTRY):
+    """Seconds of each startup phase in the order they ran, and the total since launch"""
+    registry.lock.acquire()
+    phases = {label: round(h.sum, 3) for (metric, label), h in registry.get_histograms().items()
+              if metric == 'startup_seconds'}
+    registry.lock.release()
+    phases['total'] = round(perf_counter() - START_TIME, 3)
+    return phases
+
+
+def startup_report(registry=REGISTRY):
+    phases = startup_phases(registry)
+    total = phases.pop('total')
+    return f"Started in {total:.2f}s (" + ', '.join(f"{label} {seconds:.2f}s" for label, seconds in phases.items()) + ")"
+
+
+class InstrumentedLock:
+    """threading.Lock that records how long callers waited to acquire it. The waits go to a histogram of this lock,
+    updated while holding it, so measuring a hot lock doesn't make its callers contend for the registry lock"""
+    def __init__(self, name, registry=REGISTRY):
+        self.name = name
+        self.lock = threading.Lock()
+        self.waits = Histogram()
+        registry.add_histogram('lock_wait_seconds', name, self.waits)
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired:
+            self.waits.observe(perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+def start_metrics_server(port, registry=REGISTRY):
+    """Serves /metrics as Prometheus text and /metrics.json on localhost"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics.json':
+                body, content_type = json.dumps(registry.to_dict()).encode('utf-8'), 'application/json'
+            elif self.path == '/metrics':
+                body, content_type = registry.to_prometheus().encode('utf-8'), 'text/plain; version=0.0.4'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    threading.Thread(name="Metrics_Server", target=server.serve_forever, daemon=True).start()
+    return server
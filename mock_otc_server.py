@@ -0,0 +1,138 @@
+import argparse
+import json
+import random
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import urlparse
+
+
+class MockOTCBackend:
+    """Synthetic stand-in for the backend.otcmarkets.com endpoints used by the monitor.
+    Each request waits latency_ms, fails with a 500 with probability error_rate, and each profile or price request
+    changes the stock's data with probability change_rate. Some stocks only answer on the external news source."""
+    def __init__(self, latency_ms=0, error_rate=0.0, change_rate=0.0, seed=0):
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.change_rate = change_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.versions = dict()
+        self.n_requests = 0
+
+    def _get_version(self, stock_name):
+        self.lock.acquire()
+        self.n_requests += 1
+        version = self.versions.get(stock_name, 0)
+        if self.random.random() < self.change_rate:
+            version += 1
+            self.versions[stock_name] = version
+        failed = self.random.random() < self.error_rate
+        self.lock.release()
+        return version, failed
+
+    def get_profile(self, stock_name, version):
+        base = zlib.crc32(stock_name.encode())
+        return {
+            "name": f"{stock_name} Corp",
+            "estimatedMarketCap": base % 100000 + version,
+            "estimatedMarketCapAsOfDate": 1600000000000 + version,
+            "website": f"www.{stock_name.lower()}.com",
+            "isCaveatEmptor": version % 7 == 3,
+            "securities": [{
+                "symbol": stock_name,
+                "authorizedShares": 10 ** 9 + 1000 * (version // 2),
+                "outstandingShares": base % 10 ** 8 + 100 * version,
+                "restrictedShares": base % 10 ** 6,
+                "unrestrictedShares": base % 10 ** 7,
+                "transferAgents": [{"name": "Agent " + str(base % 13)}],
+            }],
+            "officers": [{"name": f"Officer {i}", "title": "Director"} for i in range(base % 4)],
+        }
+
+    def get_prices(self, stock_name, version):
+        rng = random.Random(f"{stock_name}-{version}")
+        last_sale = round(rng.uniform(0.0001, 2), 4)
+        percent_change = round(rng.uniform(-50, 50), 2)
+        return {"lastSale": last_sale, "change": round(last_sale * percent_change / 100, 4),
+                "percentChange": percent_change, "tickName": rng.choice(["Up", "Down"])}
+
+    def get_news(self, stock_name, source, version):
+        uses_dns = zlib.crc32(stock_name.encode()) % 4 != 0
+        if (source == 'dns') != uses_dns:
+            return None
+        return {"totalRecords": 1, "records": [{"title": f"{stock_name} news update {version // 3}"}]}
+
+    def handle(self, path):
+        """Returns the http status and json document of a request path"""
+        parts = urlparse(path).path.strip('/').split('/')
+        if self.latency_ms:
+            sleep(self.latency_ms / 1000)
+        if len(parts) >= 5 and parts[1:4] == ['company', 'profile', 'full']:
+            stock_name, endpoint = parts[4], 'profile'
+        elif len(parts) >= 5 and parts[1:4] == ['stock', 'trade', 'inside']:
+            stock_name, endpoint = parts[4], 'prices'
+        elif len(parts) >= 5 and parts[1] == 'company' and parts[4] == 'news':
+            stock_name, endpoint = parts[2], parts[3]
+        else:
+            return 404, None
+
+        version, failed = self._get_version(stock_name)
+        if failed:
+            return 500, None
+        if endpoint == 'profile':
+            return 200, self.get_profile(stock_name, version)
+        if endpoint == 'prices':
+            return 200, self.get_prices(stock_name, version)
+        news = self.get_news(stock_name, endpoint, version)
+        return (200, news) if news else (404, None)
+
+
+def make_handler(backend):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Headers and body are separate writes, without this each keep-alive response waits on a delayed ACK
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            status, doc = backend.handle(self.path)
+            body = json.dumps(doc).encode('utf-8') if doc is not None else b''
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_server(backend, port=0):
+    """Serves the backend on a background thread. Returns the server and its api base url"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(backend))
+    server.daemon_threads = True
+    threading.Thread(name="Mock_OTC_Server", target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/otcapi"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the OTC markets backend')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency_ms', type=float, default=50)
+    parser.add_argument('--error_rate', type=float, default=0.01)
+    parser.add_argument('--change_rate', type=float, default=0.05)
+    args = parser.parse_args()
+
+    server, base_url = start_server(MockOTCBackend(args.latency_ms, args.error_rate, args.change_rate), args.port)
+    print(f"Serving on {base_url} (run the monitor with --api_base_url {base_url})")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
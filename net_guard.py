@@ -0,0 +1,183 @@
+import heapq
+import itertools
+import random
+import threading
+from time import time
+from urllib.parse import urlparse
+
+
+class TokenBucket:
+    """Allows rate_per_second requests on average with bursts of up to burst requests. A rate of 0 means no limit"""
+    def __init__(self, rate_per_second=0, burst=1):
+        self.rate_per_second = rate_per_second
+        self.burst = max(1, burst)
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.last_refill = time()
+
+    def reserve(self):
+        """Takes a token and returns how many seconds the caller should wait before using it"""
+        if not self.rate_per_second:
+            return 0
+        self.lock.acquire()
+        now = time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate_per_second)
+        self.last_refill = now
+        self.tokens -= 1
+        wait = 0 if self.tokens >= 0 else -self.tokens / self.rate_per_second
+        self.lock.release()
+        return wait
+
+    def try_take(self):
+        """Takes a token if one is available now, without waiting for one"""
+        if not self.rate_per_second:
+            return True
+        self.lock.acquire()
+        now = time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate_per_second)
+        self.last_refill = now
+        taken = self.tokens >= 1
+        if taken:
+            self.tokens -= 1
+        self.lock.release()
+        return taken
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures and rejects requests for cooldown_seconds.
+    After the cool down requests are let through again and the first failure reopens it"""
+    def __init__(self, failure_threshold=5, cooldown_seconds=60):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        self.lock.acquire()
+        allowed = self.opened_at is None or time() - self.opened_at > self.cooldown_seconds
+        self.lock.release()
+        return allowed
+
+    def time_to_allow(self):
+        """Seconds until requests are let through again, 0 if they are now"""
+        self.lock.acquire()
+        wait = 0 if self.opened_at is None else max(0, self.opened_at + self.cooldown_seconds - time())
+        self.lock.release()
+        return wait
+
+    def record_success(self):
+        self.lock.acquire()
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.lock.release()
+
+    def record_failure(self):
+        self.lock.acquire()
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold or self.opened_at is not None:
+            if self.opened_at is None:
+                print(f"Pausing requests for {self.cooldown_seconds} seconds after {self.consecutive_failures} consecutive failures")
+            self.opened_at = time()
+        self.lock.release()
+
+
+class HostGuard:
+    def __init__(self, rate_per_second, burst, failure_threshold, cooldown_seconds):
+        self.bucket = TokenBucket(rate_per_second, burst)
+        self.breaker = CircuitBreaker(failure_threshold, cooldown_seconds)
+
+
+_settings = dict(rate_per_second=0, burst=1, failure_threshold=5, cooldown_seconds=60)
+_guards = dict()
+_guards_lock = threading.Lock()
+
+
+def configure(rate_per_second=0, burst=1, failure_threshold=5, cooldown_seconds=60):
+    """Sets the limits of all hosts. Every fetch path goes through the same per host guard"""
+    _guards_lock.acquire()
+    _settings.update(rate_per_second=rate_per_second, burst=burst, failure_threshold=failure_threshold,
+                     cooldown_seconds=cooldown_seconds)
+    _guards.clear()
+    _guards_lock.release()
+
+
+def get_guard(url):
+    host = urlparse(url).netloc
+    _guards_lock.acquire()
+    guard = _guards.get(host)
+    if guard is None:
+        guard = _guards[host] = HostGuard(**_settings)
+    _guards_lock.release()
+    return guard
+
+
+def paused_for(url):
+    """Seconds until the host's breaker lets requests through again. Reads failing meanwhile were never tried"""
+    return get_guard(url).breaker.time_to_allow()
+
+
+def is_host_failure(status_code):
+    """Server errors and throttling count against the host, missing pages (e.g an unused news source) don't"""
+    return status_code is None or status_code >= 500 or status_code == 429
+
+
+class RetryQueue:
+    """Holds tasks until their retry time. Delays grow exponentially with the attempt number and are jittered so
+    failed stocks don't come back all at once"""
+    def __init__(self, base_delay=5, max_delay=300):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        self.heap = []
+        self.counter = itertools.count()
+
+    def push(self, task, attempt, min_delay=0):
+        """Retries the task after the backoff of its attempt, counted from min_delay"""
+        delay = min_delay + min(self.max_delay, self.base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+        self.condition.acquire()
+        heapq.heappush(self.heap, (time() + delay, next(self.counter), task))
+        self.condition.notify_all()
+        self.condition.release()
+        return delay
+
+    def pop_ready(self):
+        """Returns a task whose retry time has come or None"""
+        self.condition.acquire()
+        task = heapq.heappop(self.heap)[2] if self.heap and self.heap[0][0] <= time() else None
+        self.condition.release()
+        return task
+
+    def time_to_next(self):
+        """Seconds until the next retry is due, or None if nothing is waiting"""
+        self.condition.acquire()
+        wait = max(0, self.heap[0][0] - time()) if self.heap else None
+        self.condition.release()
+        return wait
+
+    def wait(self, timeout):
+        """Blocks until the given timeout passes or a new task is pushed"""
+        self.condition.acquire()
+        self.condition.wait(timeout)
+        self.condition.release()
+
+    def wake(self):
+        """Wakes up the waiting threads so they can check for more work"""
+        self.condition.acquire()
+        self.condition.notify_all()
+        self.condition.release()
+
+    def size(self):
+        return len(self.heap)
+
+    def is_empty(self):
+        self.condition.acquire()
+        res = not bool(self.heap)
+        self.condition.release()
+        return res
+
+    def clear(self):
+        self.condition.acquire()
+        self.heap = []
+        self.condition.notify_all()
+        self.condition.release()
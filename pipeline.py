@@ -0,0 +1,103 @@
+import queue
+import threading
+
+import metrics
+import utils
+
+
+class CollectionPipeline:
+    """Processes fetched stock data in stages, each with its own worker threads:
+    parse/diff -> persist -> render/notify.
+    The stages are connected by bounded queues so a slow disk or renderer blocks the fetchers only once the queues
+    are full, until then fetching goes on at full speed."""
+    def __init__(self, monitor, parse_workers=1, persist_workers=1, notify_workers=1, queue_size=100):
+        self.monitor = monitor
+        self.parse_queue = queue.Queue(queue_size)
+        self.persist_queue = queue.Queue(queue_size)
+        self.notify_queue = queue.Queue(queue_size)
+        self.in_flight = 0
+        self.in_flight_lock = threading.Lock()
+
+        self.stages = []
+        for stage_name, stage, stage_queue, n_workers in [('Parse', self._parse, self.parse_queue, parse_workers),
+                                                          ('Persist', self._persist, self.persist_queue, persist_workers),
+                                                          ('Notify', self._notify, self.notify_queue, notify_workers)]:
+            metrics.REGISTRY.set_gauge('queue_depth', stage_name.lower(), stage_queue.qsize)
+            threads = []
+            for x in range(n_workers):
+                t = threading.Thread(name=f"{stage_name}_Thread_{x}", target=stage_worker,
+                                     args=(stage, stage_queue, self._fail))
+                t.start()
+                threads.append(t)
+            self.stages.append((stage_queue, threads))
+
+    def submit(self, task, raw_data, worker_name, screenshot_sites=False):
+        """Hands the raw data of a fetched stock to the pipeline. Blocks while the parse stage is full"""
+        self.in_flight_lock.acquire()
+        self.in_flight += 1
+        self.in_flight_lock.release()
+        self.parse_queue.put((task, raw_data, worker_name, screenshot_sites))
+
+    def submit_parsed(self, task, new_data, update_plots, screenshot_sites=False):
+        """Hands a stock that was already parsed and diffed elsewhere to the persist stage"""
+        self.in_flight_lock.acquire()
+        self.in_flight += 1
+        self.in_flight_lock.release()
+        self.persist_queue.put((task, new_data, update_plots, screenshot_sites))
+
+    def is_idle(self):
+        return self.in_flight == 0
+
+    def _finish(self):
+        self.in_flight_lock.acquire()
+        self.in_flight -= 1
+        idle = self.in_flight == 0
+        self.in_flight_lock.release()
+        if idle:
+            # Fetchers waiting for the pipeline to empty before exiting
+            self.monitor.retry_queue.wake()
+
+    def _fail(self, stage, item, error):
+        """A stage failed on a stock: it is counted as a bad read and leaves the pipeline so the cycle can finish"""
+        task = item[0]
+        print(f"{stage.__name__.strip('_').capitalize()} stage failed on {task.name}: {error!r}")
+        metrics.REGISTRY.inc('stage_errors')
+        self.monitor.report_bad_data_read()
+        self._finish()
+
+    def _parse(self, task, raw_data, worker_name, screenshot_sites):
+        new_data = utils.parse_raw_stock_data(raw_data, self.monitor.field_projection) if raw_data else None
+        if new_data is None:
+            self.monitor.handle_bad_read(task, worker_name)
+            self._finish()
+            return
+
+        update_plots = self.monitor.diff_stock_data(task, new_data)
+        self.persist_queue.put((task, new_data, update_plots, screenshot_sites))
+
+    def _persist(self, task, new_data, update_plots, screenshot_sites):
+        self.monitor.persist_stock_data(task, new_data, update_plots)
+        self.notify_queue.put((task, update_plots, screenshot_sites))
+
+    def _notify(self, task, update_plots, screenshot_sites):
+        self.monitor.notify_stock_data(task, update_plots, screenshot_sites)
+        self._finish()
+
+    def terminate(self):
+        """Lets the queued stocks through and stops the workers, stage after stage"""
+        for stage_queue, threads in self.stages:
+            for t in threads:
+                stage_queue.put(None)
+            for t in threads:
+                t.join()
+
+
+def stage_worker(stage, stage_queue, on_error):
+    while True:
+        item = stage_queue.get()
+        if item is None:
+            break
+        try:
+            stage(*item)
+        except Exception as e:
+            on_error(stage, item, e)
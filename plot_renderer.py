@@ -0,0 +1,235 @@
+import threading
+from collections import OrderedDict
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+from time import perf_counter
+
+import metrics
+import utils
+
+
+def plot_render_worker(jobs, done):
+    """Long lived renderer process, matplotlib is imported once and kept warm between jobs"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot
+
+    while True:
+        dir_path = jobs.recv()
+        if dir_path is None:
+            break
+        try:
+            utils.plot_series(dir_path)
+        except Exception as e:
+            print(f"Failed to render plot of {dir_path}: {e}")
+        done.send(dir_path)
+
+
+class PlotRenderer:
+    """Renders the special fields plots on a pool of long lived processes.
+    Requests for a stock that is still waiting in the queue are coalesced into one render. When lazy, requests only
+    mark the plot as stale and it is rendered when ensure_rendered is called before showing it.
+    The processes are started when the first plot is rendered. A process that dies is started again on the next job and
+    the plot it was rendering is rendered once more, then left stale."""
+    def __init__(self, n_processes=2, lazy=False):
+        self.lazy = lazy
+        self.lock = threading.Lock()
+        self.queued = OrderedDict()
+        self.in_flight = dict()
+        self.dispatch_times = dict()
+        self.stale = set()
+        self.retried = set()
+        self.has_work = threading.Condition(self.lock)
+
+        self.n_processes = n_processes
+        # Spawned, the processes are started from a worker thread while other threads may hold locks
+        self.context = get_context('spawn')
+        # Wakes the done thread up to also wait on a worker that was just started
+        self.wakeup_receiver, self.wakeup_sender = self.context.Pipe(duplex=False)
+        # (process, jobs pipe, done pipe) of each worker, started on its first job. Each worker has its own pipes so
+        # one that dies can't take the others down with it
+        self.workers = [None] * n_processes
+        self.free_workers = list(range(n_processes))
+        self.assigned = dict()
+
+        self.running = True
+        self.dispatch_thread = threading.Thread(name="Plot_Dispatch_Thread", target=self._dispatch, daemon=True)
+        self.dispatch_thread.start()
+        self.done_thread = threading.Thread(name="Plot_Done_Thread", target=self._collect_done, daemon=True)
+        self.done_thread.start()
+
+    def request(self, dir_path):
+        if self.lazy:
+            self.lock.acquire()
+            self.stale.add(dir_path)
+            self.lock.release()
+            return
+        self._submit(dir_path)
+
+    def ensure_rendered(self, dir_path, timeout=10):
+        """Renders the plot now if it is stale or waits for a pending render of it"""
+        self.lock.acquire()
+        if dir_path in self.stale:
+            self.lock.release()
+            event = self._submit(dir_path)
+        else:
+            event = self.queued.get(dir_path) or self.in_flight.get(dir_path)
+            self.lock.release()
+        if event is not None:
+            event.wait(timeout)
+
+    def _submit(self, dir_path):
+        self.lock.acquire()
+        self.stale.discard(dir_path)
+        event = self.queued.get(dir_path)
+        if event is None:
+            event = threading.Event()
+            self.queued[dir_path] = event
+            self.has_work.notify()
+        self.lock.release()
+        return event
+
+    def queue_depth(self):
+        return len(self.queued)
+
+    def _next_job(self):
+        # A request arriving while its plot is being rendered stays queued until that render is done
+        return next((p for p in self.queued if p not in self.in_flight), None)
+
+    def _dispatch(self):
+        while True:
+            self.lock.acquire()
+            dir_path = self._next_job()
+            while self.running and (dir_path is None or not self.free_workers):
+                self.has_work.wait()
+                dir_path = self._next_job()
+            if not self.running:
+                self.lock.release()
+                return
+            worker = self.free_workers.pop()
+            if self.workers[worker] is None:
+                self._start_worker(worker)
+            self.in_flight[dir_path] = self.queued.pop(dir_path)
+            self.dispatch_times[dir_path] = perf_counter()
+            self.assigned[worker] = dir_path
+            jobs = self.workers[worker][1]
+            self.lock.release()
+            try:
+                jobs.send(dir_path)
+            except OSError:
+                # The process just died, the done thread sees it and frees the worker
+                pass
+
+    def _start_worker(self, worker):
+        jobs_receiver, jobs = self.context.Pipe(duplex=False)
+        done, done_sender = self.context.Pipe(duplex=False)
+        p = self.context.Process(name=f"Plot_Renderer_{worker}", target=plot_render_worker,
+                                 args=(jobs_receiver, done_sender), daemon=True)
+        p.start()
+        # The process has its own copies of these ends
+        jobs_receiver.close()
+        done_sender.close()
+        self.workers[worker] = (p, jobs, done)
+        self.wakeup_sender.send(worker)
+
+    def _collect_done(self):
+        while True:
+            self.lock.acquire()
+            running = self.running
+            waiting = {self.wakeup_receiver: None}
+            for worker, started in enumerate(self.workers):
+                if started is not None:
+                    p, jobs, done = started
+                    waiting[done] = worker
+                    waiting[p.sentinel] = worker
+            self.lock.release()
+            if not running:
+                return
+
+            for ready in wait(list(waiting)):
+                worker = waiting[ready]
+                if worker is None:
+                    self.wakeup_receiver.recv()
+                    continue
+                started = self.workers[worker]
+                if started is None or ready is not started[2] and ready != started[0].sentinel:
+                    # Reaped already, by the other end of the same process
+                    continue
+                if ready is started[2]:
+                    try:
+                        self._finish(worker, ready.recv())
+                    except EOFError:
+                        self._reap(worker)
+                else:
+                    self._reap(worker)
+
+    def _finish(self, worker, dir_path):
+        self.lock.acquire()
+        if self.assigned.get(worker) == dir_path:
+            del self.assigned[worker]
+            self.free_workers.append(worker)
+        event = self.in_flight.pop(dir_path, None)
+        dispatch_time = self.dispatch_times.pop(dir_path, None)
+        self.retried.discard(dir_path)
+        self.has_work.notify()
+        self.lock.release()
+        if dispatch_time is not None:
+            metrics.REGISTRY.observe('stage_seconds', 'render_plot', perf_counter() - dispatch_time)
+        if event is not None:
+            event.set()
+
+    def _reap(self, worker):
+        """Frees a worker whose process died, it is started again on its next job. The plot it was rendering is
+        queued again, or left stale if it was already being rendered again"""
+        p, jobs, done = self.workers[worker]
+        p.join()
+        # A plot it finished right before dying is still in the pipe
+        while done.poll():
+            try:
+                self._finish(worker, done.recv())
+            except EOFError:
+                break
+        self.lock.acquire()
+        self.workers[worker] = None
+        dir_path = self.assigned.pop(worker, None)
+        event = None
+        if self.running:
+            print(f"Plot renderer {worker} exited with code {p.exitcode}" +
+                  (f" while rendering {dir_path}" if dir_path is not None else ""))
+            metrics.REGISTRY.inc('plot_renderer_restarts')
+        if dir_path is not None:
+            self.free_workers.append(worker)
+            self.dispatch_times.pop(dir_path, None)
+            event = self.in_flight.pop(dir_path, None)
+            if dir_path not in self.retried and self.running:
+                # Rendered again first, unless it was already queued again
+                self.retried.add(dir_path)
+                if dir_path not in self.queued and event is not None:
+                    self.queued[dir_path] = event
+                    self.queued.move_to_end(dir_path, last=False)
+                    event = None
+            else:
+                # Twice in a row, the plot probably takes the process down
+                self.retried.discard(dir_path)
+                self.stale.add(dir_path)
+            self.has_work.notify()
+        self.lock.release()
+        # Whoever waits for a stale plot is released, it is not coming
+        if event is not None:
+            event.set()
+
+    def terminate(self):
+        self.lock.acquire()
+        self.running = False
+        self.has_work.notify_all()
+        workers = [worker for worker in self.workers if worker is not None]
+        self.lock.release()
+        for p, jobs, done in workers:
+            try:
+                jobs.send(None)
+            except OSError:
+                pass
+        for p, jobs, done in workers:
+            p.join()
+        self.wakeup_sender.send(None)
+        self.done_thread.join()
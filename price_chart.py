@@ -0,0 +1,98 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+SORT_ORDERS = ['move', 'name', 'selection']
+
+
+class PriceChartService:
+    """Draws the price change bar charts of selected stocks, page_size stocks per page.
+    Charts are cached per (selection, sorting, top k, page) and drawn again only when the price of one of the selected
+    stocks changed since. Large selections can be limited to the top_k largest moves."""
+    def __init__(self, output_dir, price_table, page_size=60, max_cached=64):
+        self.charts_dir = os.path.join(output_dir, "charts")
+        self.price_table = price_table
+        self.page_size = page_size
+        self.max_cached = max_cached
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        # (version, number of pages) of each (selection, sorting, top k), to clamp the page before looking it up
+        self.page_counts = OrderedDict()
+
+    def get_chart(self, stock_names, sort='move', top_k=None, page=0):
+        """Returns the path of the chart image of the page and the number of pages"""
+        selection_key = hashlib.blake2b('\x1f'.join(stock_names).encode('utf-8'), digest_size=8).hexdigest()
+        pages_key = f"{selection_key}_{sort}_{top_k or 'all'}"
+        version = self.price_table.last_change_version(stock_names)
+
+        self.lock.acquire()
+        page_count = self.page_counts.get(pages_key)
+        if page_count is not None and page_count[0] == version:
+            page = min(page, page_count[1] - 1)
+        key = f"{pages_key}_{page}"
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] == version:
+            self.cache.move_to_end(key)
+            self.lock.release()
+            return cached[1], cached[2]
+        self.lock.release()
+
+        df = self.get_page_frame(stock_names, sort, top_k)
+        n_pages = max(1, -(-len(df) // self.page_size))
+        page = min(page, n_pages - 1)
+        key = f"{pages_key}_{page}"
+        chart_path = os.path.join(self.charts_dir, f"stock_bars_{key}.png")
+        draw_price_chart(df.iloc[page * self.page_size:(page + 1) * self.page_size], chart_path)
+
+        self.lock.acquire()
+        self.cache[key] = (version, chart_path, n_pages)
+        self.cache.move_to_end(key)
+        self.page_counts[pages_key] = (version, n_pages)
+        self.page_counts.move_to_end(pages_key)
+        while len(self.page_counts) > self.max_cached:
+            self.page_counts.popitem(last=False)
+        while len(self.cache) > self.max_cached:
+            old_key, (_, old_path, _) = self.cache.popitem(last=False)
+            if os.path.exists(old_path):
+                os.remove(old_path)
+        self.lock.release()
+        return chart_path, n_pages
+
+    def get_page_frame(self, stock_names, sort, top_k):
+        df = self.price_table.to_dataframe(stock_names)
+        if sort == 'move' or top_k:
+            df = df.reindex(df['percentChange'].abs().sort_values(ascending=False, kind='stable').index)
+        if top_k:
+            df = df.iloc[:top_k]
+        if sort == 'name':
+            df = df.sort_values('stock', kind='stable')
+        elif sort == 'selection' and top_k:
+            df = df.sort_index()
+        return df.reset_index(drop=True)
+
+
+def draw_price_chart(df, chart_path):
+    """One bar per stock, green for a rise and red for a fall, labeled with the last price"""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(max(5, min(len(df) * 0.3, 20)), 5))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+
+    positive = (df["percentChange"] > 0).to_numpy()
+    colors = ['g' if p else 'r' for p in positive]
+    bars = ax.bar(df['stock'], df["percentChange"], color=colors)
+    labels = [f"{last_sale}$" if p else f"{last_sale:.4f}$" for last_sale, p in zip(df['lastSale'], positive)]
+    ax.bar_label(bars, labels=labels, fontsize=7, rotation=90, padding=2)
+
+    lim = (df["percentChange"].abs().max() * 1.2 if len(df) else 0) or 1
+    ax.set_ylim(-lim, lim)
+    ax.yaxis.set_major_formatter(lambda x, pos: f'{x:.0f}%')
+    ax.tick_params(axis='x', labelrotation=45)
+    ax.grid()
+    fig.tight_layout()
+
+    os.makedirs(os.path.dirname(chart_path), exist_ok=True)
+    fig.savefig(chart_path)
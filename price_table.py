@@ -0,0 +1,106 @@
+import csv
+import os
+import threading
+from time import time
+
+import metrics
+import utils
+
+
+class PriceTable:
+    """In-memory table of the last prices of each stock keyed by stock name.
+    Updates are O(1) and the table is written to disk atomically once per cycle, or every checkpoint_minutes if set"""
+    header = ["stock", "lastSale", "change", "percentChange"]
+
+    def __init__(self, csv_path, checkpoint_minutes=0):
+        self.csv_path = csv_path
+        self.checkpoint_minutes = checkpoint_minutes
+        self.lock = metrics.InstrumentedLock('price_table')
+        # Flushes write the same temporary file, they run one at a time and in order
+        self.flush_lock = threading.Lock()
+        self.rows = dict()
+        # Incremented on every price change, row_versions keeps the version of each stock's last change
+        self.version = 0
+        self.row_versions = dict()
+        # dirty is cleared once a flush of all the upserts so far made it to disk
+        self.dirty = False
+        self.n_upserts = 0
+        self.last_flush_time = time()
+        if os.path.exists(csv_path):
+            self.load()
+
+    def load(self):
+        with open(self.csv_path, 'r', newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                if row:
+                    self.rows[row[0]] = row[1:]
+
+    def upsert(self, stock_name, stock_data):
+        if stock_data is None:
+            return
+        values = [stock_data.get(field, utils.NOT_AVAILABLE_STR) for field in self.header[1:]]
+        self.lock.acquire()
+        if self.rows.get(stock_name) != values:
+            self.version += 1
+            self.row_versions[stock_name] = self.version
+        self.rows[stock_name] = values
+        self.n_upserts += 1
+        self.dirty = True
+        checkpoint_due = self.checkpoint_minutes and time() - self.last_flush_time > 60 * self.checkpoint_minutes
+        self.lock.release()
+
+        if checkpoint_due:
+            self.flush()
+
+    def flush(self):
+        """Atomically rewrites the csv file if anything changed since the last flush. If writing fails the table stays
+        dirty and the next flush tries again"""
+        self.flush_lock.acquire()
+        self.lock.acquire()
+        if not self.dirty:
+            self.lock.release()
+            self.flush_lock.release()
+            return
+        rows = [[stock_name] + values for stock_name, values in self.rows.items()]
+        n_upserts = self.n_upserts
+        self.last_flush_time = time()
+        self.lock.release()
+
+        try:
+            with metrics.REGISTRY.time('persist_prices'):
+                tmp_path = self.csv_path + '.tmp'
+                with open(tmp_path, 'w', newline='') as f:
+                    writer = csv.writer(f)
+                    writer.writerow(self.header)
+                    writer.writerows(rows)
+                os.replace(tmp_path, self.csv_path)
+            self.lock.acquire()
+            if self.n_upserts == n_upserts:
+                self.dirty = False
+            self.lock.release()
+        finally:
+            self.flush_lock.release()
+
+    def last_change_version(self, stock_names):
+        """The version of the most recent price change among the given stocks"""
+        self.lock.acquire()
+        version = max((self.row_versions.get(stock_name, 0) for stock_name in stock_names), default=0)
+        self.lock.release()
+        return version
+
+    def to_dataframe(self, stock_names=None):
+        """Returns the prices of the given stocks (all by default) with numeric columns"""
+        import pandas as pd
+        self.lock.acquire()
+        if stock_names is None:
+            rows = [[stock_name] + values for stock_name, values in self.rows.items()]
+        else:
+            rows = [[stock_name] + self.rows[stock_name] for stock_name in stock_names if stock_name in self.rows]
+        self.lock.release()
+
+        df = pd.DataFrame(rows, columns=self.header)
+        for field in self.header[1:]:
+            df[field] = pd.to_numeric(df[field], errors='coerce')
+        return df.dropna(subset=['percentChange']).reset_index(drop=True)
@@ -0,0 +1,93 @@
+import threading
+from time import time
+
+
+class StockSchedule:
+    __slots__ = ('next_due', 'change_rate', 'volatility', 'bad_reads')
+
+    def __init__(self, next_due=0, change_rate=0.0):
+        self.next_due = next_due
+        self.change_rate = change_rate
+        self.volatility = 0.0
+        self.bad_reads = 0
+
+
+class PollingScheduler:
+    """Gives each stock its own polling interval between min_interval_minutes and max_interval_minutes.
+    Stocks that change often or move a lot in price are polled more often, stocks that can't be read are backed off,
+    and all intervals are stretched together when their total rate exceeds budget_per_minute stocks (0 for no budget)."""
+    def __init__(self, stock_names, min_interval_minutes=1, max_interval_minutes=240, budget_per_minute=0,
+                 smoothing=0.3, volatility_scale=20.0):
+        self.min_interval = 60 * min_interval_minutes
+        self.max_interval = 60 * max_interval_minutes
+        self.budget_per_minute = budget_per_minute
+        self.smoothing = smoothing
+        self.volatility_scale = volatility_scale
+        self.lock = threading.Lock()
+        self.schedules = {stock_name: StockSchedule() for stock_name in stock_names}
+        self.stretch = 1.0
+
+    def seed(self, change_counts, last_poll_times, lookback_days=7):
+        """Starts the change rates from the changes of the last lookback_days and schedules each stock relative to
+        the last time it was polled. Like the rates updated on every poll, they are the chance of a change per poll,
+        estimated against the polls a stock that never changes gets in that time"""
+        # Polls at the interval of a stock without activity, the base every stock starts from
+        n_polls = max(1.0, lookback_days * 24 * 60 * 60 / self.max_interval)
+        self.lock.acquire()
+        for stock_name, schedule in self.schedules.items():
+            schedule.change_rate = min(1.0, change_counts.get(stock_name, 0) / n_polls)
+            last_poll_time = last_poll_times.get(stock_name)
+            if last_poll_time is not None:
+                schedule.next_due = last_poll_time + self._get_interval(schedule)
+        self.lock.release()
+
+    def _get_interval(self, schedule):
+        activity = min(1.0, schedule.change_rate + min(1.0, schedule.volatility / self.volatility_scale))
+        # Interpolate geometrically so activity moves the interval evenly between minutes and hours
+        interval = self.max_interval * (self.min_interval / self.max_interval) ** activity
+        interval *= 2 ** min(schedule.bad_reads, 4)
+        return min(self.max_interval, interval) * self.stretch
+
+    def _update_stretch(self):
+        self.stretch = 1.0
+        if self.budget_per_minute:
+            demand = sum(60 / self._get_interval(schedule) for schedule in self.schedules.values())
+            self.stretch = max(1.0, demand / self.budget_per_minute)
+
+    def reset(self):
+        """Makes every stock due now"""
+        self.lock.acquire()
+        for schedule in self.schedules.values():
+            schedule.next_due = 0
+        self.lock.release()
+
+    def due_stocks(self, now=None):
+        """Returns the stocks that are due for polling, most overdue first"""
+        now = now or time()
+        self.lock.acquire()
+        self._update_stretch()
+        due = [(schedule.next_due, stock_name) for stock_name, schedule in self.schedules.items() if schedule.next_due <= now]
+        self.lock.release()
+        return [stock_name for _, stock_name in sorted(due)]
+
+    def next_due_time(self):
+        self.lock.acquire()
+        next_due = min((schedule.next_due for schedule in self.schedules.values()), default=None)
+        self.lock.release()
+        return next_due
+
+    def record_result(self, stock_name, changed=False, bad_read=False, percent_change=None):
+        self.lock.acquire()
+        schedule = self.schedules[stock_name]
+        if bad_read:
+            schedule.bad_reads += 1
+        else:
+            schedule.bad_reads = 0
+            schedule.change_rate += self.smoothing * (float(changed) - schedule.change_rate)
+            try:
+                move = abs(float(percent_change))
+            except (TypeError, ValueError):
+                move = 0.0
+            schedule.volatility += self.smoothing * (move - schedule.volatility)
+        schedule.next_due = time() + self._get_interval(schedule)
+        self.lock.release()
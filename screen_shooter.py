@@ -1,12 +1,13 @@
 from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
 
 
 class ScreenShooter:
-    def __init__(self, wait_time=0):
+    def __init__(self, wait_time=0, driver_path='chromedriver.exe'):
         options = webdriver.ChromeOptions()
         options.add_argument("--log-level=3")
         options.headless = True
-        self.driver = webdriver.Chrome('chromedriver.exe',  options=options)
+        self.driver = webdriver.Chrome(driver_path,  options=options)
         self.driver.set_page_load_timeout(wait_time)
 
     def take_full_screen_screenshot(self, url, save_path):
@@ -22,4 +23,9 @@ class ScreenShooter:
         return 0
 
     def terminate(self):
-        self.driver.close()
\ No newline at end of file
+        self.driver.close()
+
+
+def is_browser_error(e):
+    """The browser or its driver broke, it has to be started again"""
+    return isinstance(e, WebDriverException)
@@ -0,0 +1,86 @@
+import heapq
+import itertools
+import threading
+from collections import OrderedDict
+
+import metrics
+
+
+class ScreenshotQueue:
+    """Queue of (stock, tab) screenshot jobs where a job that is already waiting is never added twice.
+    In 'fifo' order jobs come out in the order they were first requested. In 'priority' order a job requested again
+    while waiting moves ahead of jobs requested fewer times. pop blocks until a job arrives or the queue is closed.
+    A popped job is in flight until done is called with it, a request for it arriving meanwhile waits until then so
+    two browsers never capture the same tab at once."""
+    def __init__(self, order='fifo'):
+        self.order = order
+        self.condition = threading.Condition(metrics.InstrumentedLock('screenshot_queue'))
+        self.jobs = OrderedDict()
+        self.heap = []
+        self.in_flight = set()
+        self.counter = itertools.count()
+        self.closed = False
+
+    def push(self, job):
+        self.condition.acquire()
+        requests = self.jobs.get(job, 0) + 1
+        self.jobs[job] = requests
+        if self.order == 'priority':
+            # Older heap entries of the job are skipped when popped
+            heapq.heappush(self.heap, (-requests, next(self.counter), job))
+        self.condition.notify()
+        self.condition.release()
+
+    def pop(self):
+        """Returns the next job, or None once the queue is closed"""
+        self.condition.acquire()
+        job = None
+        while not self.closed:
+            job = self._next_job()
+            if job is not None:
+                break
+            self.condition.wait()
+        if job is not None:
+            del self.jobs[job]
+            self.in_flight.add(job)
+        self.condition.release()
+        return job
+
+    def done(self, job):
+        self.condition.acquire()
+        self.in_flight.discard(job)
+        if job in self.jobs:
+            self.condition.notify()
+        self.condition.release()
+
+    def _next_job(self):
+        if self.order != 'priority':
+            return next((job for job in self.jobs if job not in self.in_flight), None)
+        job, skipped = None, []
+        while job is None and self.heap:
+            entry = heapq.heappop(self.heap)
+            requests, _, candidate = entry
+            if self.jobs.get(candidate) != -requests:
+                continue
+            if candidate in self.in_flight:
+                skipped.append(entry)
+            else:
+                job = candidate
+        for entry in skipped:
+            heapq.heappush(self.heap, entry)
+        return job
+
+    def size(self):
+        return len(self.jobs)
+
+    def clear(self):
+        self.condition.acquire()
+        self.jobs = OrderedDict()
+        self.heap = []
+        self.condition.release()
+
+    def close(self):
+        self.condition.acquire()
+        self.closed = True
+        self.condition.notify_all()
+        self.condition.release()
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import threading
+from collections import deque
+from os.path import join as pjoin
+from pathlib import Path
+from time import time
+
+import metrics
+
+THUMBNAIL_CROP = (0, 275, 1050, 600)
+THUMBNAIL_SIZE = (500, 150)
+
+
+def perceptual_hash(img, hash_size=8):
+    """Difference hash: one bit per horizontally adjacent pixel pair of a small grayscale version of the image"""
+    small = img.convert('L').resize((hash_size + 1, hash_size))
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def hash_distance(hash1, hash2):
+    return bin(hash1 ^ hash2).count('1')
+
+
+class ScreenshotStore:
+    """Keeps the last max_images distinct captures of each stock tab.
+    Captures are stored under the digest of their content, a capture identical to the previous one is dropped. With a
+    max_distance, one that only looks the same (perceptual hashes at most max_distance bits apart) is dropped too, a
+    whole page hash rarely sees a small text change so this is off by default. Each tab directory has a small index.json of the
+    retained captures, newest last, so retention and latest lookups never scan the directory.
+    The thumbnails shown by the GUI are cropped once when the capture is added."""
+    def __init__(self, stocks_dir, max_images=20, max_distance=None):
+        self.stocks_dir = stocks_dir
+        self.max_images = max_images
+        self.max_distance = max_distance
+        self.lock = metrics.InstrumentedLock('screenshot_store')
+        self.indices = dict()
+
+    def get_tab_dir(self, stock_name, tab_name):
+        return pjoin(self.stocks_dir, stock_name, "status_images", tab_name)
+
+    def get_capture_path(self, stock_name, tab_name):
+        """A temporary path for the browser to write a new capture to"""
+        dirpath = self.get_tab_dir(stock_name, tab_name)
+        os.makedirs(dirpath, exist_ok=True)
+        return pjoin(dirpath, f"capture_{threading.get_ident()}.png")
+
+    def add(self, stock_name, tab_name, capture_path):
+        """Moves a capture into the store. Returns False if it was dropped as a duplicate of the last capture"""
+        from PIL import Image
+        dirpath = self.get_tab_dir(stock_name, tab_name)
+        with metrics.REGISTRY.time('store_screenshot'):
+            with open(capture_path, 'rb') as f:
+                digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+            img = Image.open(capture_path)
+            phash = perceptual_hash(img)
+
+            # The check and the append are one step, so two captures of a tab can't both pass against the same entry
+            self.lock.acquire()
+            try:
+                index = self._get_index(stock_name, tab_name)
+                last = index[-1] if index else None
+                if last is not None and (last['digest'] == digest or self.max_distance is not None and
+                                         hash_distance(last['phash'], phash) <= self.max_distance):
+                    img.close()
+                    os.remove(capture_path)
+                    metrics.REGISTRY.inc('screenshots_deduplicated')
+                    return False
+
+                image_name = f"{digest}.png"
+                thumbnail_name = f"{digest}_thumb.png"
+                if not os.path.exists(pjoin(dirpath, thumbnail_name)):
+                    make_thumbnail(img, pjoin(dirpath, thumbnail_name))
+                img.close()
+                os.replace(capture_path, pjoin(dirpath, image_name))
+
+                index.append(dict(digest=digest, phash=phash, time=time(), image=image_name, thumbnail=thumbnail_name))
+                removed = index.popleft() if len(index) > self.max_images else None
+                if removed is not None and all(entry['digest'] != removed['digest'] for entry in index):
+                    os.remove(pjoin(dirpath, removed['image']))
+                    os.remove(pjoin(dirpath, removed['thumbnail']))
+                self._write_index(dirpath, index)
+            finally:
+                self.lock.release()
+        return True
+
+    def latest(self, stock_name, tab_name, n=2):
+        """Returns the last n captures, oldest first, as (image path, thumbnail path, capture time) tuples"""
+        dirpath = self.get_tab_dir(stock_name, tab_name)
+        self.lock.acquire()
+        index = self._get_index(stock_name, tab_name)
+        entries = list(index)[-n:] if n else []
+        self.lock.release()
+        return [(pjoin(dirpath, entry['image']), pjoin(dirpath, entry['thumbnail']), entry['time']) for entry in entries]
+
+    def _get_index(self, stock_name, tab_name):
+        key = (stock_name, tab_name)
+        index = self.indices.get(key)
+        if index is None:
+            dirpath = self.get_tab_dir(stock_name, tab_name)
+            index_path = pjoin(dirpath, 'index.json')
+            if os.path.exists(index_path):
+                with open(index_path) as f:
+                    index = deque(json.load(f))
+            else:
+                index = self._index_legacy_images(dirpath)
+            self.indices[key] = index
+        return index
+
+    def _index_legacy_images(self, dirpath):
+        """Indexes the time named captures written before the store existed"""
+        from PIL import Image
+        index = deque()
+        if not os.path.exists(dirpath):
+            return index
+        img_paths = [path for path in Path(dirpath).glob('*.png')
+                     if not path.stem.endswith('_thumb') and not path.stem.startswith('capture_')]
+        img_paths = sorted(img_paths, key=os.path.getmtime)
+        for img_path in img_paths[:-self.max_images]:
+            os.remove(img_path)
+        for img_path in img_paths[-self.max_images:]:
+            thumbnail_name = f"{img_path.stem}_thumb.png"
+            img = Image.open(img_path)
+            make_thumbnail(img, pjoin(dirpath, thumbnail_name))
+            index.append(dict(digest=img_path.stem, phash=perceptual_hash(img), time=os.path.getmtime(img_path),
+                              image=img_path.name, thumbnail=thumbnail_name))
+            img.close()
+        if index:
+            self._write_index(dirpath, index)
+        return index
+
+    @staticmethod
+    def _write_index(dirpath, index):
+        tmp_path = pjoin(dirpath, 'index.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(list(index), f)
+        os.replace(tmp_path, pjoin(dirpath, 'index.json'))
+
+
+def make_thumbnail(img, path):
+    thumbnail = img.crop(THUMBNAIL_CROP)
+    thumbnail.thumbnail(THUMBNAIL_SIZE)
+    thumbnail.save(path)
@@ -0,0 +1,143 @@
+import csv
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+
+
+def to_number(value):
+    try:
+        return float(str(value).replace(',', ''))
+    except ValueError:
+        return np.nan
+
+
+class SeriesFile:
+    """Numeric time series of a stock's plot fields in an append only binary file.
+    Each point is a row of float64 values, the timestamp followed by one column per field (NaN when not available).
+    The field names are kept next to it in a small json file. Reads memory map the file so a time range query only
+    touches the rows it returns."""
+    def __init__(self, path):
+        self.path = path
+        self.fields_path = path + '.fields.json'
+
+    def exists(self):
+        return os.path.exists(self.fields_path)
+
+    def get_fields(self):
+        if not self.exists():
+            return None
+        with open(self.fields_path) as f:
+            return json.load(f)
+
+    def append(self, timestamp, fields, values):
+        self.append_rows(fields, np.array([[timestamp] + [to_number(v) for v in values]]))
+
+    def append_rows(self, fields, rows):
+        fields = list(fields)
+        stored_fields = self.get_fields()
+        if stored_fields is None:
+            self._write_fields(fields)
+        elif stored_fields != fields:
+            self._change_fields(stored_fields, fields)
+        with open(self.path, 'ab') as f:
+            f.write(np.ascontiguousarray(rows, dtype=np.float64).tobytes())
+
+    def query(self, start=None, end=None):
+        """Returns the timestamps, field names and a (points, fields) matrix of the points in [start, end]"""
+        fields = self.get_fields()
+        if fields is None or not os.path.exists(self.path):
+            return np.empty(0), fields or [], np.empty((0, len(fields or [])))
+        row_size = 8 * (1 + len(fields))
+        # A row that is being appended right now is not read
+        n_rows = os.path.getsize(self.path) // row_size
+        if n_rows == 0:
+            return np.empty(0), fields, np.empty((0, len(fields)))
+        data = np.memmap(self.path, dtype=np.float64, mode='r', shape=(n_rows, 1 + len(fields)))
+        times = data[:, 0]
+        first = 0 if start is None else np.searchsorted(times, start, side='left')
+        last = n_rows if end is None else np.searchsorted(times, end, side='right')
+        return np.array(times[first:last]), fields, np.array(data[first:last, 1:])
+
+    def _write_fields(self, fields):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.fields_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(fields, f)
+        os.replace(tmp_path, self.fields_path)
+
+    def _change_fields(self, stored_fields, fields):
+        """Rewrites the series with new columns, fields that were removed are dropped"""
+        times, _, values = self.query()
+        new_values = np.full((len(times), len(fields)), np.nan)
+        for i, field in enumerate(fields):
+            if field in stored_fields:
+                new_values[:, i] = values[:, stored_fields.index(field)]
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(np.column_stack([times, new_values]).astype(np.float64).tobytes())
+        os.replace(tmp_path, self.path)
+        self._write_fields(fields)
+
+
+def migrate_csv(csv_path, series):
+    """Moves the points of a special_fields.csv file into the series, the csv is kept renamed to .csv.migrated.
+    The csv is renamed before it is read, so if another process migrates it at the same time only one of them imports
+    it. Returns False if it was already taken"""
+    migrating_path = csv_path + '.migrating'
+    try:
+        os.replace(csv_path, migrating_path)
+    except FileNotFoundError:
+        return False
+    with open(migrating_path, 'r', newline='') as f:
+        rows = [row for row in csv.reader(f) if row]
+    fields = rows[0][1:] if rows else []
+    points = []
+    for row in rows[1:]:
+        try:
+            timestamp = datetime.strptime(row[0], '%Y-%m-%d_%H-%M-%S').timestamp()
+        except ValueError:
+            continue
+        points.append([timestamp] + [to_number(v) for v in row[1:1 + len(fields)]])
+    if points:
+        series.append_rows(fields, np.array(points))
+    os.replace(migrating_path, csv_path + '.migrated')
+    return True
+
+
+def downsample_minmax(times, values, n_points):
+    """Keeps the lowest and highest point of each of n_points / 2 equal sized buckets, in time order"""
+    if len(times) <= n_points:
+        return times, values
+    buckets = np.array_split(np.arange(len(times)), max(1, n_points // 2))
+    indices = []
+    for bucket in buckets:
+        bucket_values = values[bucket]
+        if np.all(np.isnan(bucket_values)):
+            continue
+        indices.extend(sorted({bucket[np.nanargmin(bucket_values)], bucket[np.nanargmax(bucket_values)]}))
+    return times[indices], values[indices]
+
+
+def downsample_lttb(times, values, n_points):
+    """Largest-Triangle-Three-Buckets: keeps the first and last points and from each bucket in between the point
+    forming the largest triangle with the point kept before it and the average of the next bucket"""
+    keep = ~np.isnan(values)
+    times, values = times[keep], values[keep]
+    if len(times) <= n_points or n_points < 3:
+        return times, values
+    buckets = np.array_split(np.arange(1, len(times) - 1), n_points - 2)
+    indices = [0]
+    for i, bucket in enumerate(buckets):
+        next_bucket = buckets[i + 1] if i + 1 < len(buckets) else np.array([len(times) - 1])
+        avg_time, avg_value = times[next_bucket].mean(), values[next_bucket].mean()
+        prev_time, prev_value = times[indices[-1]], values[indices[-1]]
+        areas = np.abs((prev_time - avg_time) * (values[bucket] - prev_value) -
+                       (prev_time - times[bucket]) * (avg_value - prev_value))
+        indices.append(bucket[np.argmax(areas)])
+    indices.append(len(times) - 1)
+    return times[indices], values[indices]
+
+
+DOWNSAMPLERS = {'lttb': downsample_lttb, 'minmax': downsample_minmax}
@@ -0,0 +1,192 @@
+import threading
+import zlib
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+
+import metrics
+import net_guard
+import utils
+from endpoint_cache import EndpointCache
+
+
+def shard_of(stock_name, n_shards):
+    """Stable shard of a stock, the same in every run and process"""
+    return zlib.crc32(stock_name.encode('utf-8')) % n_shards
+
+
+def shard_worker(shard, jobs, results, records, settings):
+    """Collects the stocks of one shard. Fetching, parsing and diffing all happen in this process against the last
+    records of the shard's stocks which it keeps, only the results are sent back to the parent"""
+    net_guard.configure(**settings['net_guard'])
+    cache = EndpointCache(settings['ttls'], settings['refresh_profile_on_tick'])
+    results_lock = threading.Lock()
+
+    def send(result):
+        results_lock.acquire()
+        results.send(result)
+        results_lock.release()
+
+    def collect():
+        while True:
+            stock_name = jobs.get()
+            if stock_name is None:
+                break
+            raw_data = utils.get_raw_stock_data(stock_name, settings['api_base_url'], cache)
+            new_data = utils.parse_raw_stock_data(raw_data, settings['projection']) if raw_data else None
+            if new_data is None:
+                send(('bad', stock_name, net_guard.paused_for(settings['api_base_url'])))
+                continue
+            diff = utils.compare_rows(records.get(stock_name), new_data, settings['ignore_fields'])
+            records[stock_name] = new_data
+            send(('done', stock_name, new_data, diff))
+
+    threads = [threading.Thread(name=f"Shard_{shard}_Thread_{x}", target=collect)
+               for x in range(settings['n_threads'])]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+class ShardPool:
+    """Splits the stocks between n_processes long lived collector processes so parsing and diffing use all cores.
+    Results are handed to the monitor's persist stage as they arrive, each shard sends them on its own pipe so one that
+    dies can't take the others down with it. A shard process that dies is started again with the parent's copy of its
+    records and the stocks it had not finished are sent to it again."""
+    def __init__(self, monitor, n_processes, threads_per_process, settings):
+        self.monitor = monitor
+        self.n_processes = n_processes
+        self.settings = dict(settings, n_threads=threads_per_process)
+        self.lock = threading.Lock()
+        # Spawned, a forked child could inherit a lock some other thread of this process was holding
+        self.context = get_context('spawn')
+        # (process, jobs queue, results pipe) of each shard
+        self.shards = [None] * n_processes
+        self.outstanding = [set() for _ in range(n_processes)]
+        for shard in range(n_processes):
+            self._start_shard(shard)
+
+        self.running = True
+        self.results_thread = threading.Thread(name="Shard_Results_Thread", target=self._collect_results, daemon=True)
+        self.results_thread.start()
+
+    def _start_shard(self, shard):
+        records = {stock_name: task.data for stock_name, task in self.monitor.stocks.items()
+                   if task.data is not None and shard_of(stock_name, self.n_processes) == shard}
+        jobs = self.context.Queue()
+        results, results_sender = self.context.Pipe(duplex=False)
+        p = self.context.Process(name=f"Shard_{shard}", target=shard_worker,
+                    args=(shard, jobs, results_sender, records, self.settings), daemon=True)
+        p.start()
+        # The process has its own copy of this end
+        results_sender.close()
+        self.shards[shard] = (p, jobs, results)
+
+    def dispatch(self, task):
+        shard = shard_of(task.name, self.n_processes)
+        self.lock.acquire()
+        self.outstanding[shard].add(task.name)
+        jobs = self.shards[shard][1]
+        self.lock.release()
+        jobs.put(task.name)
+
+    def n_outstanding(self):
+        self.lock.acquire()
+        n = sum(len(names) for names in self.outstanding)
+        self.lock.release()
+        return n
+
+    def collect(self, worker_name="Shard_Dispatch_Thread"):
+        """Sends the due and retried stocks to their shards until everything was collected. Runs once per cycle"""
+        retry_queue = self.monitor.retry_queue
+        while True:
+            task = retry_queue.pop_ready() or self.monitor.task_queue.pop()
+            if task is None:
+                wait = retry_queue.time_to_next()
+                if wait is None:
+                    if self.n_outstanding() == 0 and self.monitor.pipeline.is_idle():
+                        break
+                    wait = 1
+                retry_queue.wait(wait)
+                continue
+            self.dispatch(task)
+
+    def _collect_results(self):
+        while self.running:
+            self.lock.acquire()
+            waiting = dict()
+            for shard, (p, jobs, results) in enumerate(self.shards):
+                waiting[results] = shard
+                waiting[p.sentinel] = shard
+            self.lock.release()
+
+            for ready in wait(list(waiting), timeout=1):
+                shard = waiting[ready]
+                p, jobs, results = self.shards[shard]
+                if ready is not results and ready != p.sentinel:
+                    # Restarted already, by the other end of the same process
+                    continue
+                if ready is results:
+                    try:
+                        self._handle_result(shard, results.recv())
+                        continue
+                    except EOFError:
+                        pass
+                self._restart_crashed(shard)
+
+    def _handle_result(self, shard, result):
+        status, stock_name = result[:2]
+        self.lock.acquire()
+        outstanding = stock_name in self.outstanding[shard]
+        self.lock.release()
+        if not outstanding:
+            # Sent again after a crash and already collected
+            return
+
+        task = self.monitor.stocks[stock_name]
+        if status == 'bad':
+            self.monitor.handle_bad_read(task, f"Shard_{shard}", result[2])
+        else:
+            new_data, diff = result[2:]
+            update_plots = self.monitor.record_stock_diff(task, new_data, diff)
+            self.monitor.pipeline.submit_parsed(task, new_data, update_plots)
+
+        # Only now, so the dispatcher never sees the stock neither outstanding nor in the pipeline
+        self.lock.acquire()
+        self.outstanding[shard].discard(stock_name)
+        self.lock.release()
+        self.monitor.retry_queue.wake()
+
+    def _restart_crashed(self, shard):
+        p, jobs, results = self.shards[shard]
+        p.join()
+        # Results it sent right before dying are still in the pipe
+        while results.poll():
+            try:
+                self._handle_result(shard, results.recv())
+            except EOFError:
+                break
+        results.close()
+        if not self.running:
+            return
+        print(f"Shard {shard} collector exited with code {p.exitcode}, restarting it")
+        metrics.REGISTRY.inc('shard_restarts')
+        jobs.cancel_join_thread()
+        self.lock.acquire()
+        self._start_shard(shard)
+        names = list(self.outstanding[shard])
+        jobs = self.shards[shard][1]
+        self.lock.release()
+        for stock_name in names:
+            jobs.put(stock_name)
+
+    def terminate(self):
+        self.running = False
+        self.results_thread.join()
+        for p, jobs, results in self.shards:
+            for x in range(self.settings['n_threads']):
+                jobs.put(None)
+        for p, jobs, results in self.shards:
+            p.join(5)
+            if p.is_alive():
+                p.terminate()
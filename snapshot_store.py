@@ -0,0 +1,100 @@
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from os.path import join as pjoin
+
+import metrics
+import utils
+
+
+class SnapshotStore:
+    """Keeps the last collected record of every stock in a single SQLite database.
+    All snapshots are loaded in one read at startup and writes are buffered and committed in batches."""
+    def __init__(self, db_path, batch_size=1000):
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.pending = dict()
+        self.layout_ids = dict()
+
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS layouts (id INTEGER PRIMARY KEY, fields TEXT UNIQUE);
+            CREATE TABLE IF NOT EXISTS snapshots (stock TEXT PRIMARY KEY, layout_id INTEGER, vals TEXT, modified REAL);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        ''')
+        self.connection.commit()
+
+    def load_all(self):
+        """Returns a dictionary of stock name to (record, last modification date)"""
+        self.lock.acquire()
+        layouts = dict()
+        for layout_id, fields in self.connection.execute('SELECT id, fields FROM layouts'):
+            layouts[layout_id] = json.loads(fields)
+            self.layout_ids[tuple(layouts[layout_id])] = layout_id
+        rows = self.connection.execute('SELECT stock, layout_id, vals, modified FROM snapshots').fetchall()
+        self.lock.release()
+
+        snapshots = dict()
+        for stock_name, layout_id, vals, modified in rows:
+            record = utils.StockRecord(layouts[layout_id], json.loads(vals))
+            snapshots[stock_name] = (record, datetime.fromtimestamp(modified))
+        return snapshots
+
+    def put(self, stock_name, record, modification_date):
+        self.lock.acquire()
+        self.pending[stock_name] = (record, modification_date)
+        flush_due = len(self.pending) >= self.batch_size
+        self.lock.release()
+
+        if flush_due:
+            self.flush()
+
+    def flush(self):
+        self.lock.acquire()
+        pending, self.pending = self.pending, dict()
+        rows = []
+        for stock_name, (record, modification_date) in pending.items():
+            rows.append((stock_name, self._get_layout_id(record.fields), json.dumps(record.values),
+                         modification_date.timestamp()))
+        with metrics.REGISTRY.time('persist_snapshots'):
+            self.connection.executemany('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?)', rows)
+            self.connection.commit()
+        self.lock.release()
+
+    def _get_layout_id(self, fields):
+        layout_id = self.layout_ids.get(fields)
+        if layout_id is None:
+            cursor = self.connection.execute('INSERT INTO layouts (fields) VALUES (?)', (json.dumps(fields),))
+            layout_id = self.layout_ids[fields] = cursor.lastrowid
+        return layout_id
+
+    def migrate_csvs(self, stocks_dir):
+        """One time import of the per stock stock_last_entry_data.csv files"""
+        self.lock.acquire()
+        migrated = self.connection.execute("SELECT value FROM meta WHERE key = 'csvs_migrated'").fetchone()
+        self.lock.release()
+        if migrated or not os.path.exists(stocks_dir):
+            return
+
+        n_migrated = 0
+        for entry in os.scandir(stocks_dir):
+            csv_path = pjoin(entry.path, 'stock_last_entry_data.csv')
+            if entry.is_dir() and os.path.exists(csv_path):
+                record = utils.StockRecord.read_csv(csv_path)
+                if record is None:
+                    continue
+                self.put(entry.name, record, datetime.fromtimestamp(os.path.getmtime(csv_path)))
+                n_migrated += 1
+        self.flush()
+
+        self.lock.acquire()
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('csvs_migrated', ?)", (utils.get_time_str(),))
+        self.connection.commit()
+        self.lock.release()
+        print(f"Migrated {n_migrated} stock snapshots into the snapshot store")
+
+    def close(self):
+        self.flush()
+        self.connection.close()
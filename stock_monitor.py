@@ -1,22 +1,101 @@
 import os
 import sys
 import threading
-from collections import deque
-from pathlib import Path
-from time import sleep
 
-import pandas as pd
-
-from screen_shooter import ScreenShooter
+from alert_rules import AlertEngine, load_rules, make_file_sink, make_log_sink, make_sound_sink, make_webhook_sink
+from change_journal import ChangeJournal
+from cluster import Coordinator
+from cycle_checkpoint import CycleCheckpoint
+from endpoint_cache import EndpointCache
+from field_projection import FieldProjection
+from metrics import start_metrics_server
+from net_guard import RetryQueue
+from pipeline import CollectionPipeline
+from plot_renderer import PlotRenderer
+from price_table import PriceTable
+from scheduler import PollingScheduler
+from shard_pool import ShardPool
+from snapshot_store import SnapshotStore
+from universe_matrix import UniverseMatrix
+from screenshot_queue import ScreenshotQueue
+from screenshot_store import ScreenshotStore
 from os.path import join as pjoin
-from datetime import datetime
+from datetime import datetime, timedelta
+import metrics
+import net_guard
 import utils
 import heapq
 
 
+def add_monitor_arguments(parser):
+    """Adds the StockMonitor settings with their defaults to an argparse parser"""
+    parser.add_argument('--output_dir', default='outputs')
+    parser.add_argument('--stock_names_path', default=pjoin('csvs', 'stock_names.csv'))
+    parser.add_argument('--ignore_fields_path', default=pjoin('csvs', 'ignore_fields.csv'))
+    parser.add_argument('--plot_fields_path', default=pjoin('csvs', 'plot_fields.csv'))
+    parser.add_argument('--chrome_driver', default='chromedriver.exe')
+    parser.add_argument('--screenshot_wait_time', type=float, default=3)
+    parser.add_argument('--no_screenshots', dest='screenshots', action='store_false', help='Never start the browser')
+    parser.add_argument('--screenshot_browsers', type=int, default=2, help='Number of headless browsers taking screenshots')
+    parser.add_argument('--max_status_images', type=int, default=20, help='Distinct screenshots kept per stock tab')
+    parser.add_argument('--screenshot_hash_distance', type=int, default=None,
+                        help='Also drop screenshots whose perceptual hash is at most this many bits from the last one. '
+                             'By default only identical screenshots are dropped')
+    parser.add_argument('--screenshot_order', choices=['fifo', 'priority'], default='fifo',
+                        help='priority captures the stocks that were requested most times first')
+    parser.add_argument('--api_base_url', default=utils.OTC_API_URL)
+    parser.add_argument('--threads_fetch', dest='async_fetch', action='store_false',
+                        help='Collect with data collection threads instead of the asyncio collector')
+    parser.add_argument('--max_concurrency', type=int, default=20, help='Stocks in flight in the asyncio collector')
+    parser.add_argument('--profile_ttl_minutes', type=float, default=60)
+    parser.add_argument('--news_ttl_minutes', type=float, default=30)
+    parser.add_argument('--news_source_ttl_minutes', type=float, default=24 * 60)
+    parser.add_argument('--no_refresh_profile_on_tick', dest='refresh_profile_on_tick', action='store_false')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='Split the stocks between this many collector processes, 0 to collect in this process')
+    parser.add_argument('--threads_per_process', type=int, default=8)
+    parser.add_argument('--coordinator_port', type=int, default=0,
+                        help='Let cluster.py nodes collect the stocks through this port instead of collecting locally')
+    parser.add_argument('--coordinator_host', default='127.0.0.1', help='Use 0.0.0.0 to accept nodes from other hosts')
+    parser.add_argument('--coordinator_token', default=os.environ.get('COORDINATOR_TOKEN', ''),
+                        help='Nodes must send this token, required unless the coordinator host is loopback. '
+                             'COORDINATOR_TOKEN by default')
+    parser.add_argument('--lease_seconds', type=float, default=60,
+                        help='Stocks of a node that did not send a heartbeat for this long are given to other nodes')
+    parser.add_argument('--parse_workers', type=int, default=1, help='Threads parsing and diffing fetched stocks')
+    parser.add_argument('--persist_workers', type=int, default=1, help='Threads writing collected stocks to disk')
+    parser.add_argument('--notify_workers', type=int, default=1, help='Threads requesting plots and screenshots')
+    parser.add_argument('--stage_queue_size', type=int, default=100,
+                        help='Stocks waiting between two pipeline stages before the previous stage blocks')
+    parser.add_argument('--price_checkpoint_minutes', type=float, default=5)
+    parser.add_argument('--cycle_checkpoint_sync_seconds', type=float, default=1,
+                        help='Sync the progress of the running cycle to disk at most this often')
+    parser.add_argument('--plot_processes', type=int, default=2)
+    parser.add_argument('--lazy_plots', action='store_true', help='Only render plots when they are shown')
+    parser.add_argument('--change_retention_days', type=float, default=365)
+    parser.add_argument('--min_poll_minutes', type=float, default=1)
+    parser.add_argument('--max_poll_minutes', type=float, default=240)
+    parser.add_argument('--poll_budget_per_minute', type=float, default=200)
+    parser.add_argument('--retry_base_seconds', type=float, default=5)
+    parser.add_argument('--retry_max_seconds', type=float, default=300)
+    parser.add_argument('--requests_per_second', type=float, default=20)
+    parser.add_argument('--request_burst', type=int, default=40)
+    parser.add_argument('--breaker_threshold', type=int, default=10)
+    parser.add_argument('--breaker_cooldown_seconds', type=float, default=60)
+    parser.add_argument('--alert_rules_path', default=pjoin('csvs', 'alert_rules.csv'))
+    parser.add_argument('--alert_webhook_url', default='', help='POST alerts of the rules with a webhook sink to this url')
+    parser.add_argument('--report_startup', action='store_true', help='Print how long each startup phase took')
+    parser.add_argument('--metrics_port', type=int, default=0,
+                        help='Serve /metrics (Prometheus) and /metrics.json on this localhost port, 0 to disable')
+    return parser
+
+
+SCREENSHOT_TABS = ['profile', 'overview', 'security', 'news', 'disclosure']
+
+
 class TaskQueue:
     def __init__(self, starting_values):
-        self.lock = threading.Lock()
+        self.lock = metrics.InstrumentedLock('task_queue')
         self.heap = starting_values
         heapq.heapify(self.heap)
 
@@ -28,6 +107,7 @@ class TaskQueue:
     def pop(self):
         self.lock.acquire()
         if not self.heap:
+            self.lock.release()
             return None
         task = heapq.heappop(self.heap)
         self.lock.release()
@@ -39,42 +119,39 @@ class TaskQueue:
         self.lock.release()
         return res
 
+    def size(self):
+        return len(self.heap)
+
     def clear(self):
         self.lock.acquire()
         self.heap = []
         self.lock.release()
 
 class Stockdata:
-    def __init__(self, stock_name, outputs_dir):
+    def __init__(self, stock_name, outputs_dir, snapshot_store, data=None, data_last_modification_date=None):
         self.name = stock_name
         self.outputs_dir = outputs_dir
+        self.snapshot_store = snapshot_store
 
-        self.data = None
-        self.data_last_modification_date = None
-        self.cache_path = pjoin(self.outputs_dir, 'stock_last_entry_data.csv')
-        if os.path.exists(self.cache_path):
-            self.data = pd.read_csv(self.cache_path, dtype=str)
-            self.data_last_modification_date = datetime.fromtimestamp(Path(self.cache_path).stat().st_mtime)
+        self.data = data
+        self.data_last_modification_date = data_last_modification_date
 
         self.num_bad_data_reads = 0
 
-        self.logs_dir = pjoin(self.outputs_dir, 'change_logs')
         self.screen_shots_dir = pjoin(self.outputs_dir, 'status_images')
-        os.makedirs(self.logs_dir, exist_ok=True)
-        os.makedirs(self.screen_shots_dir, exist_ok=True)
-        self.special_fields_file = pjoin(self.outputs_dir, 'special_fields.csv')
 
     def set_data(self, data):
         self.data_last_modification_date = datetime.now()
         if data is not None:
             self.data = data
-            self.data.to_csv(self.cache_path, index=False, header=True)
 
-    def write_changes(self, diff):
-        diff.to_csv(pjoin(self.logs_dir, f'{utils.get_time_str(for_filename=True)}.csv'))
+    def persist(self):
+        self.snapshot_store.put(self.name, self.data, self.data_last_modification_date)
 
     def update_plot_fields(self, plot_fields):
-        utils.update_plot_fields(self.special_fields_file, self.data, plot_fields)
+        with metrics.REGISTRY.time('persist_plot_fields'):
+            os.makedirs(self.outputs_dir, exist_ok=True)
+            utils.update_plot_fields(self.outputs_dir, self.data, plot_fields)
 
     def report_bad_data_read(self):
         self.data_last_modification_date = datetime.now()
@@ -90,49 +167,203 @@ class Stockdata:
 
 class StockMonitor:
     def __init__(self, args):
-        self.query_freq_minutes = args.query_freq_minutes
-        self.ignore_fields = [x.strip() for x in open(args.ignore_fields_path, 'r').readlines()]
+        with metrics.REGISTRY.time('settings', metric='startup_seconds'):
+            self.load_settings(args)
+        with metrics.REGISTRY.time('snapshots', metric='startup_seconds'):
+            os.makedirs(self.output_dir, exist_ok=True)
+            self.snapshot_store = SnapshotStore(pjoin(self.output_dir, 'snapshots.db'))
+            self.snapshot_store.migrate_csvs(pjoin(self.output_dir, 'stocks'))
+            self.stocks = self.load_stocks()
+        with metrics.REGISTRY.time('change_journal', metric='startup_seconds'):
+            self.change_journal = ChangeJournal(pjoin(self.output_dir, 'changes.db'))
+            self.change_journal.import_logs(pjoin(self.output_dir, 'stocks'))
+            self.change_journal.compact(args.change_retention_days)
+        with metrics.REGISTRY.time('scheduler', metric='startup_seconds'):
+            self.scheduler = PollingScheduler(self.stock_names, args.min_poll_minutes, args.max_poll_minutes,
+                                              args.poll_budget_per_minute)
+            self.scheduler.seed(self.change_journal.change_counts(datetime.now() - timedelta(days=7)),
+                                {stock_name: task.data_last_modification_date.timestamp()
+                                 for stock_name, task in self.stocks.items() if task.data_last_modification_date})
+        with metrics.REGISTRY.time('checkpoint', metric='startup_seconds'):
+            self.checkpoint = CycleCheckpoint(pjoin(self.output_dir, 'cycle_checkpoint.jsonl'),
+                                              args.cycle_checkpoint_sync_seconds)
+            self.interrupted_cycle = self.replay_checkpoint()
+        with metrics.REGISTRY.time('workers', metric='startup_seconds'):
+            self.init_workers(args)
+        if args.report_startup:
+            print(metrics.startup_report())
+
+    def load_settings(self, args):
         self.plot_fields = [x.strip() for x in open(args.plot_fields_path, 'r').readlines()]
+        self.field_projection = FieldProjection([x.strip() for x in open(args.ignore_fields_path, 'r').readlines()],
+                                                self.plot_fields + utils.PRICE_FIELDS)
+        self.ignore_fields = self.field_projection.compare_ignore
         self.stock_names = [x.strip() for x in open(args.stock_names_path, 'r').readlines()]
         self.output_dir = args.output_dir
+        self.api_base_url = args.api_base_url
+        self.async_fetch = args.async_fetch
+        self.max_concurrency = args.max_concurrency
+        self.endpoint_cache = EndpointCache({'profile': args.profile_ttl_minutes * 60,
+                                             'news': args.news_ttl_minutes * 60,
+                                             'news_source': args.news_source_ttl_minutes * 60},
+                                            args.refresh_profile_on_tick)
+
+    def init_workers(self, args):
+        self.cycle_size = 0
 
         self.collecting_data = False
 
         self.data_threads_pool = []
         self.task_queue = TaskQueue([])
+        self.retry_queue = RetryQueue(args.retry_base_seconds, args.retry_max_seconds)
+        net_guard.configure(args.requests_per_second, args.request_burst, args.breaker_threshold,
+                            args.breaker_cooldown_seconds)
 
-        self.changes_list_lock = threading.Lock()
+        self.changes_list_lock = metrics.InstrumentedLock('changes_list')
         self.changes_list = []
         self.last_changes_list = []
 
-        self.file_lock = threading.Lock()
-
-        self.status_lock = threading.Lock()
+        self.plot_renderer = PlotRenderer(args.plot_processes, args.lazy_plots)
+        self.price_table = PriceTable(pjoin(self.output_dir, "price_status.csv"), args.price_checkpoint_minutes)
+        if self.interrupted_cycle:
+            for stock_name, _, _, _ in self.interrupted_cycle['done']:
+                self.update_price_status(stock_name, self.stocks[stock_name].data)
+        self.alerts = AlertEngine(load_rules(args.alert_rules_path), self.ignore_fields)
+        self.alerts.add_sink('log', make_log_sink())
+        self.alerts.add_sink('file', make_file_sink(pjoin(self.output_dir, 'alerts.jsonl')))
+        self.alerts.add_sink('sound', make_sound_sink(pjoin('icons', 'icq-uh-oh.mp3')), own_thread=True)
+        if args.alert_webhook_url:
+            self.alerts.add_sink('webhook', make_webhook_sink(args.alert_webhook_url), own_thread=True)
+        self.universe = UniverseMatrix(max(1024, len(self.stock_names)))
+        for stock_name, task in self.stocks.items():
+            if task.data is not None:
+                self.universe.update(stock_name, task.data)
+
+        self.status_lock = metrics.InstrumentedLock('status')
         self.progress = 0
         self.num_bad_data_reads = 0
-
-        self.screenshoter = ScreenShooter(10)
-        self.screen_shoting_queue = deque()
-        self.screenshoter_lock = threading.Lock()
-        self.max_status_images = 20
-        self.init_screenshoting_thread()
+        self.pipeline = CollectionPipeline(self, args.parse_workers, args.persist_workers, args.notify_workers,
+                                           args.stage_queue_size)
+        self.coordinator = None
+        if args.coordinator_port:
+            self.coordinator = Coordinator(self, args.coordinator_host, args.coordinator_port, args.lease_seconds,
+                                           args.coordinator_token)
+        self.shard_pool = None
+        if args.processes:
+            # The rate limits are per process, split them so the total stays the same
+            self.shard_pool = ShardPool(self, args.processes, args.threads_per_process, dict(
+                api_base_url=self.api_base_url, ignore_fields=self.ignore_fields, projection=self.field_projection,
+                ttls=self.endpoint_cache.ttls, refresh_profile_on_tick=args.refresh_profile_on_tick,
+                net_guard=dict(rate_per_second=args.requests_per_second / args.processes,
+                               burst=max(1, args.request_burst // args.processes),
+                               failure_threshold=args.breaker_threshold,
+                               cooldown_seconds=args.breaker_cooldown_seconds)))
+
+        self.screenshots = args.screenshots
+        self.chrome_driver = args.chrome_driver
+        self.screen_shoting_queue = ScreenshotQueue(args.screenshot_order)
+        self.screenshot_browsers = args.screenshot_browsers
+        self.screenshot_threads = []
+        self.screenshot_threads_lock = threading.Lock()
+        self.screenshot_store = ScreenshotStore(pjoin(self.output_dir, "stocks"), args.max_status_images,
+                                                args.screenshot_hash_distance)
+
+        metrics.REGISTRY.set_gauge('queue_depth', 'tasks', self.task_queue.size)
+        metrics.REGISTRY.set_gauge('queue_depth', 'retries', self.retry_queue.size)
+        metrics.REGISTRY.set_gauge('queue_depth', 'screenshots', self.screen_shoting_queue.size)
+        metrics.REGISTRY.set_gauge('queue_depth', 'plots', self.plot_renderer.queue_depth)
+        metrics.REGISTRY.set_gauge('queue_depth', 'alerts', self.alerts.queue_depth)
+        self.metrics_server = start_metrics_server(args.metrics_port) if args.metrics_port else None
+
+    def load_stocks(self):
+        """Creates the stocks state from the snapshot store in one bulk read"""
+        snapshots = self.snapshot_store.load_all()
+        stocks = dict()
+        for stock_name in self.stock_names:
+            data, modification_date = snapshots.get(stock_name, (None, None))
+            stocks[stock_name] = Stockdata(stock_name, pjoin(self.output_dir, 'stocks', stock_name),
+                                           self.snapshot_store, data, modification_date)
+        return stocks
+
+    def replay_checkpoint(self):
+        """Brings back what an interrupted cycle collected before it stopped: the records, changes and schedule of
+        the stocks it finished. Returns the interrupted cycle, or None if the last cycle was committed"""
+        cycle = self.checkpoint.load()
+        if cycle is None:
+            return None
+        cycle['stocks'] = [stock_name for stock_name in cycle['stocks'] if stock_name in self.stocks]
+        cycle['done'] = [entry for entry in cycle['done'] if entry[0] in self.stocks]
+        cycle['bad'] = [stock_name for stock_name in cycle['bad'] if stock_name in self.stocks]
+        for stock_name, record, modification_date, diff in cycle['done']:
+            task = self.stocks[stock_name]
+            if task.data_last_modification_date is None or task.data_last_modification_date < modification_date:
+                task.data, task.data_last_modification_date = record, modification_date
+                task.persist()
+            self.scheduler.record_result(stock_name, diff is not None, percent_change=record.get('percentChange'))
+        for stock_name in cycle['bad']:
+            self.scheduler.record_result(stock_name, bad_read=True)
+        n_changes = self.change_journal.replay([(stock_name, modification_date, diff)
+                                                for stock_name, _, modification_date, diff in cycle['done'] if diff])
+        self.snapshot_store.flush()
+        print(f"Resuming an interrupted cycle: {len(cycle['done']) + len(cycle['bad'])} of {len(cycle['stocks'])}"
+              f" stocks were collected, {n_changes} uncommitted changes were replayed")
+        return cycle
 
     def init_dc_threads(self, n_threads):
+        """Starts collecting the stocks that are due according to the scheduler, or the remaining stocks of an
+        interrupted cycle. Returns the number of stocks"""
+        cycle, self.interrupted_cycle = self.interrupted_cycle, None
+        if cycle:
+            finished = set(entry[0] for entry in cycle['done']) | set(cycle['bad'])
+            due_stocks = [stock_name for stock_name in cycle['stocks'] if stock_name not in finished]
+            self.changes_list = [entry[0] for entry in cycle['done'] if entry[3]]
+            self.progress = len(cycle['stocks']) - len(due_stocks)
+            self.num_bad_data_reads = len(cycle['bad'])
+            self.cycle_size = len(cycle['stocks'])
+            self.checkpoint.resume_cycle()
+        else:
+            due_stocks = self.scheduler.due_stocks()
+            if not due_stocks:
+                return 0
+            self.cycle_size = len(due_stocks)
+            self.checkpoint.start_cycle(due_stocks)
         self.collecting_data = True
 
         assert self.task_queue.is_empty()
-        for stock_name in self.stock_names:
-            task = Stockdata(stock_name, pjoin(self.output_dir, 'stocks', stock_name))
+        for stock_name in due_stocks:
+            task = self.stocks[stock_name]
+            task.num_bad_data_reads = 0
             self.task_queue.push(task)
 
+        if self.coordinator:
+            t = threading.Thread(name="Coordinator_Thread", target=self.coordinator.collect)
+            t.start()
+            self.data_threads_pool.append(t)
+            return self.cycle_size
+
+        if self.shard_pool:
+            t = threading.Thread(name="Shard_Dispatch_Thread", target=self.shard_pool.collect)
+            t.start()
+            self.data_threads_pool.append(t)
+            return self.cycle_size
+
+        if self.async_fetch:
+            from async_collector import AsyncCollector
+            collector = AsyncCollector(self, self.max_concurrency)
+            t = threading.Thread(name="Async_Data_Thread", target=collector.run)
+            t.start()
+            self.data_threads_pool.append(t)
+            return self.cycle_size
+
         for x in range(n_threads):
             name = "Data_Thread_" + str(x)
             t = threading.Thread(name=name, target=data_collection_worker, args=(self,))
             t.start()
             self.data_threads_pool.append(t)
+        return self.cycle_size
 
     def is_all_tasks_done(self):
-        return self.progress == len(self.stock_names)
+        return self.progress == self.cycle_size
 
     def join_dc_threads(self):
         for t in self.data_threads_pool:
@@ -149,7 +380,7 @@ class StockMonitor:
         self.init_dc_threads(n_threads)
         self.join_dc_threads()
 
-        self._update_changes_log()
+        self.finish_cycle()
         self.changes_list = self.last_changes_list = []
 
     def query_changes(self):
@@ -166,49 +397,108 @@ class StockMonitor:
         self.changes_list_lock.release()
 
     def update_price_status(self, stock_name, stock_data):
-        self.file_lock.acquire()
-        utils.update_price_status(pjoin(self.output_dir, "price_status.csv"), stock_name, stock_data)
-        self.file_lock.release()
-
-    def _update_changes_log(self):
-        if self.changes_list:
-            csv_path = pjoin(self.output_dir, 'change-log.csv')
-            df = pd.read_csv(csv_path) if os.path.exists(csv_path) else pd.DataFrame()
-            new_col = pd.DataFrame({utils.get_time_str(): self.changes_list})
-            df = pd.concat([new_col, df], axis=1)
-            if df.shape[1] > 5:
-                df = df.iloc[:, :-1]
-            df.to_csv(csv_path, header=True, index=False)
-
-    def screenshost_stock(self, stock_name):
-        """Take a screen shot from the three tabs of this stock page"""
-        self.screenshoter_lock.acquire()
-
-        ret_val = 0
-
-        for tab_name in ['profile', 'overview', 'security', 'news', 'disclosure']:
-            dirpath = pjoin(self.output_dir, "stocks", stock_name, "status_images", tab_name)
-            os.makedirs(dirpath, exist_ok=True)
-            time_str = utils.get_time_str(for_filename=True)
-            new_file_path = pjoin(dirpath, f"{time_str}.png")
-            ret_val += self.screenshoter.take_full_screen_screenshot(f"https://www.otcmarkets.com/stock/{stock_name}/{tab_name}", new_file_path)
-
-            if len(os.listdir(dirpath)) > self.max_status_images:
-                oldest_path = min(Path(dirpath).iterdir(), key=os.path.getmtime)
-                os.remove(oldest_path)
-
-        self.screenshoter_lock.release()
+        self.price_table.upsert(stock_name, stock_data)
+
+    def screen(self, expression, columns=(), sort_by=None, ascending=False, limit=None):
+        """Returns a DataFrame of the stocks whose latest data matches a screener expression, see UniverseMatrix"""
+        with metrics.REGISTRY.time('screen'):
+            return self.universe.query(expression, columns, sort_by, ascending, limit)
+
+    def finish_cycle(self):
+        """Writes everything gathered during the cycle to disk"""
+        self.change_journal.commit()
+        self.price_table.flush()
+        self.snapshot_store.flush()
+        self.checkpoint.clear()
+
+    def handle_bad_read(self, task, worker_name, paused_for=None):
+        """Schedules a retry of a stock that couldn't be read, or gives up on it after too many attempts.
+        Reads rejected while the host's breaker is open don't count as attempts, they are retried once it lets requests
+        through again. paused_for is how long it still is open where the read was made, this process by default"""
+        if paused_for is None:
+            paused_for = net_guard.paused_for(self.api_base_url)
+        if paused_for > 0:
+            metrics.REGISTRY.inc('deferred_reads')
+            self.retry_queue.push(task, 1, paused_for)
+            return
+        metrics.REGISTRY.inc('bad_reads')
+        task.report_bad_data_read()
+        if task.num_bad_data_reads > 3:
+            print(f"{worker_name}: Skipping {task.name}. It couldn't be read for {task.num_bad_data_reads} times")
+            self.scheduler.record_result(task.name, bad_read=True)
+            self.checkpoint.record_bad(task.name)
+            self.report_bad_data_read()
+            return
+        metrics.REGISTRY.inc('retries')
+        delay = self.retry_queue.push(task, task.num_bad_data_reads)
+        print(f"{worker_name}: {task.name}  couldn't be read for {task.num_bad_data_reads} times,"
+              f" retrying in {delay:.0f} seconds")
+
+    def diff_stock_data(self, task, new_data):
+        """Compares the new data to the last one and records the change.
+        Returns whether the stock's plots should be updated, which is when it changed or was seen for the first time"""
+        with metrics.REGISTRY.time('diff'):
+            diff = utils.compare_rows(task.data, new_data, self.ignore_fields)
+        return self.record_stock_diff(task, new_data, diff)
+
+    def record_stock_diff(self, task, new_data, diff):
+        cur_data = task.data
+        task.set_data(new_data)
+        self.alerts.evaluate(task.name, cur_data, new_data, diff)
+
+        stock_changed = diff is not None
+        self.checkpoint.record(task.name, new_data, task.data_last_modification_date, diff)
+        if stock_changed:
+            self.change_journal.append(task.name, diff, task.data_last_modification_date)
+            self.report_stock_changed(task.name)
+        self.scheduler.record_result(task.name, stock_changed, percent_change=new_data.get('percentChange'))
+        return stock_changed or cur_data is None
+
+    def persist_stock_data(self, task, new_data, update_plots):
+        task.persist()
+        if update_plots:
+            task.update_plot_fields(self.plot_fields)
+        self.update_price_status(task.name, new_data)
+        self.universe.update(task.name, new_data)
+
+    def notify_stock_data(self, task, update_plots, screenshot_sites=False):
+        if update_plots:
+            self.plot_renderer.request(task.outputs_dir)
+            if screenshot_sites:
+                self.add_screenshot_tasks([task.name])
+        self.report_dc_task_done()
+
+    def screenshot_tab(self, screenshoter, stock_name, tab_name):
+        """Take a screen shot of one tab of this stock page"""
+        capture_path = self.screenshot_store.get_capture_path(stock_name, tab_name)
+        with metrics.REGISTRY.time('screenshot'):
+            ret_val = screenshoter.take_full_screen_screenshot(f"https://www.otcmarkets.com/stock/{stock_name}/{tab_name}", capture_path)
+        if ret_val == 0 and os.path.exists(capture_path):
+            self.screenshot_store.add(stock_name, tab_name, capture_path)
 
         return ret_val
 
-    def init_screenshoting_thread(self):
-        self.screenshit_thread = threading.Thread(name="ScreenShot thread", target=screenshot_worker, args=(self,))
-        self.screenshit_thread.start()
+    def init_screenshoting_threads(self, n_browsers):
+        for x in range(n_browsers):
+            t = threading.Thread(name=f"ScreenShot_Thread_{x}", target=screenshot_worker, args=(self,))
+            t.start()
+            self.screenshot_threads.append(t)
 
     def add_screenshot_tasks(self, stock_names):
-        self.screenshoter_lock.acquire()
-        self.screen_shoting_queue.extend(stock_names)
-        self.screenshoter_lock.release()
+        """Queues the tabs of the given stocks, the tabs of one stock are captured in parallel by the browsers pool"""
+        if not self.screenshots:
+            return
+        # Called by the notify workers and the GUI at once, only one of them starts the browsers
+        self.screenshot_threads_lock.acquire()
+        closed = self.screen_shoting_queue.closed
+        if not closed and not self.screenshot_threads:
+            self.init_screenshoting_threads(self.screenshot_browsers)
+        self.screenshot_threads_lock.release()
+        if closed:
+            return
+        for stock_name in stock_names:
+            for tab_name in SCREENSHOT_TABS:
+                self.screen_shoting_queue.push((stock_name, tab_name))
 
     def report_bad_data_read(self):
         self.status_lock.acquire()
@@ -227,65 +517,83 @@ class StockMonitor:
         self.status_lock.release()
         return progress, bad_reads
 
-    def terminate(self):
-        self.screenshoter.terminate()
+    def get_metrics(self):
+        return metrics.REGISTRY.to_dict()
 
+    def terminate(self):
         self.task_queue.clear()
+        self.retry_queue.clear()
         self.join_dc_threads()
-
-        self.screenshoter_lock.acquire()
-        self.screen_shoting_queue = deque()
-        self.screenshoter_lock.release()
-        self.screenshit_thread.join()
+        if self.coordinator:
+            self.coordinator.terminate()
+        if self.shard_pool:
+            self.shard_pool.terminate()
+        self.pipeline.terminate()
+        self.price_table.flush()
+        self.snapshot_store.close()
+        self.change_journal.close()
+        self.checkpoint.close()
+        self.plot_renderer.terminate()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+
+        self.screenshot_threads_lock.acquire()
+        self.screen_shoting_queue.clear()
+        self.screen_shoting_queue.close()
+        threads = list(self.screenshot_threads)
+        self.screenshot_threads_lock.release()
+        for t in threads:
+            t.join()
 
 
 def data_collection_worker(monitor, screenshot_sites=False):
-    while not monitor.task_queue.is_empty():
-        task = monitor.task_queue.pop()
-
-        cur_data = task.data
-        new_data = utils.get_stock_data(task.name)
-        if new_data is None:
-            task.report_bad_data_read()
-            if task.num_bad_data_reads > 3:
-                print(f"{threading.currentThread().getName()}: Skipping {task.name}. It couldn't be read for {task.num_bad_data_reads} times")
-                monitor.report_bad_data_read()
-            else:
-                print(f"{threading.currentThread().getName()}: {task.name}  couldn't be read for {task.num_bad_data_reads} times,"
-                      f" sleeping for {5} seconds")
-                sleep(5)
-                monitor.task_queue.push(task)
+    while True:
+        task = monitor.retry_queue.pop_ready() or monitor.task_queue.pop()
+        if task is None:
+            # Only wait for retries when there is nothing else to collect, stocks still in the pipeline may be retried
+            wait = monitor.retry_queue.time_to_next()
+            if wait is None:
+                if monitor.pipeline.is_idle():
+                    break
+                wait = 1
+            monitor.retry_queue.wait(wait)
             continue
 
-        task.set_data(new_data)
-        diff = utils.compare_rows(cur_data, new_data, monitor.ignore_fields)
-
-        stock_changed = diff is not None
-        first_time = cur_data is None
-
-        if stock_changed:
-            task.write_changes(diff)
-            monitor.report_stock_changed(task.name)
-
-        if stock_changed or first_time:
-            task.update_plot_fields(monitor.plot_fields)
-            if screenshot_sites:
-                monitor.screenshost_stock(task.name)
-
-        monitor.update_price_status(task.name, new_data)
-
-        monitor.report_dc_task_done()
+        raw_data = utils.get_raw_stock_data(task.name, monitor.api_base_url, monitor.endpoint_cache)
+        monitor.pipeline.submit(task, raw_data, threading.currentThread().getName(), screenshot_sites)
 
     sys.exit()
 
 
 def screenshot_worker(monitor):
+    # The browser is only started once there is something to capture
+    screenshoter = None
     while True:
-        monitor.screenshoter_lock.acquire()
-        stock_name = monitor.screen_shoting_queue.pop() if monitor.screen_shoting_queue else None
-        monitor.screenshoter_lock.release()
-
-        if stock_name:
-            monitor.screenshost_stock(stock_name)
-        else:
-            sleep(5)
+        job = monitor.screen_shoting_queue.pop()
+        if job is None:
+            break
+        try:
+            if screenshoter is None:
+                from screen_shooter import ScreenShooter
+                with metrics.REGISTRY.time('start_browser'):
+                    screenshoter = ScreenShooter(10, monitor.chrome_driver)
+            monitor.screenshot_tab(screenshoter, *job)
+        except Exception as e:
+            print(f"{threading.current_thread().name}: Failed to screenshot {job[0]} {job[1]}: {e}")
+            metrics.REGISTRY.inc('screenshot_errors')
+            from screen_shooter import is_browser_error
+            if screenshoter is not None and is_browser_error(e):
+                # Started again on the next job
+                terminate_browser(screenshoter)
+                screenshoter = None
+        finally:
+            monitor.screen_shoting_queue.done(job)
+    if screenshoter is not None:
+        terminate_browser(screenshoter)
+
+
+def terminate_browser(screenshoter):
+    try:
+        screenshoter.terminate()
+    except Exception as e:
+        print(f"Failed to close the browser: {e}")
@@ -0,0 +1,73 @@
+import argparse
+import asyncio
+import os
+from os.path import join as pjoin
+
+import aiohttp
+import pytest
+
+import net_guard
+import utils
+from async_collector import get_stock_data_async
+from endpoint_cache import EndpointCache
+from field_projection import FieldProjection
+from mock_otc_server import MockOTCBackend, start_server
+from stock_monitor import StockMonitor, add_monitor_arguments
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STOCK_NAMES = [f"S{i}" for i in range(12)]
+
+
+@pytest.fixture
+def base_url():
+    net_guard.configure()
+    server, url = start_server(MockOTCBackend())
+    yield url
+    server.shutdown()
+    server.server_close()
+
+
+async def fetch_all(base_url, stock_names, cache=None, projection=None):
+    async with aiohttp.ClientSession() as session:
+        return await asyncio.gather(*[get_stock_data_async(session, stock_name, base_url, cache, projection)
+                                      for stock_name in stock_names])
+
+
+def test_async_fetch_matches_sync_fetch(base_url):
+    projection = FieldProjection(['estimatedMarketCapAsOfDate', 'officers*'], utils.PRICE_FIELDS)
+    records = asyncio.run(fetch_all(base_url, STOCK_NAMES, projection=projection))
+    for stock_name, record in zip(STOCK_NAMES, records):
+        expected = utils.get_stock_data(stock_name, base_url, projection=projection)
+        assert (record.fields, record.values) == (expected.fields, expected.values)
+        assert record.get('securities_0_symbol') == stock_name
+        assert record.get('last_news_entry') != utils.NOT_AVAILABLE_STR
+
+
+def test_async_fetch_with_cache(base_url):
+    cache = EndpointCache({'profile': 60, 'news': 60, 'news_source': 60}, refresh_profile_on_tick=False)
+    first = asyncio.run(fetch_all(base_url, STOCK_NAMES, cache))
+    second = asyncio.run(fetch_all(base_url, STOCK_NAMES, cache))
+    assert [(r.fields, r.values) for r in first] == [(r.fields, r.values) for r in second]
+    assert all(cache.get(stock_name, 'profile') for stock_name in STOCK_NAMES)
+
+
+def test_async_collector_cycle(base_url, tmp_path):
+    names_path = tmp_path / 'stock_names.csv'
+    names_path.write_text('\n'.join(STOCK_NAMES))
+    args = add_monitor_arguments(argparse.ArgumentParser()).parse_args([
+        '--output_dir', str(tmp_path / 'outputs'), '--stock_names_path', str(names_path), '--api_base_url', base_url,
+        '--ignore_fields_path', pjoin(REPO_DIR, 'csvs', 'ignore_fields.csv'),
+        '--plot_fields_path', pjoin(REPO_DIR, 'csvs', 'plot_fields.csv'),
+        '--alert_rules_path', str(tmp_path / 'no_alert_rules.csv'),
+        '--no_screenshots', '--requests_per_second', '0', '--max_concurrency', '4'])
+    monitor = StockMonitor(args)
+    try:
+        assert monitor.async_fetch
+        for _ in range(2):
+            monitor.scheduler.reset()
+            monitor.run_cycle()
+            assert monitor.get_status() == (len(STOCK_NAMES), 0)
+            monitor.reinit_state()
+    finally:
+        monitor.terminate()
+    assert sorted(os.listdir(tmp_path / 'outputs' / 'stocks')) == sorted(STOCK_NAMES)
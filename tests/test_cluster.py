@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+import socket
+import threading
+import urllib.error
+import urllib.request
+from os.path import join as pjoin
+
+import pytest
+
+import metrics
+import net_guard
+from cluster import ClusterWorker, Coordinator, TOKEN_HEADER
+from mock_otc_server import MockOTCBackend, start_server
+from stock_monitor import StockMonitor, add_monitor_arguments
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STOCK_NAMES = [f"S{i}" for i in range(30)]
+TOKEN = 'secret'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def servers():
+    net_guard.configure()
+    # A little latency so one node can't collect the whole cycle before the other takes its first lease
+    fast_server, fast_url = start_server(MockOTCBackend(latency_ms=20))
+    # Answers so slowly the nodes using it look stuck
+    slow_server, slow_url = start_server(MockOTCBackend(latency_ms=1000))
+    yield fast_url, slow_url
+    for server in (fast_server, slow_server):
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def monitor(servers, tmp_path):
+    names_path = tmp_path / 'stock_names.csv'
+    names_path.write_text('\n'.join(STOCK_NAMES))
+    port = free_port()
+    args = add_monitor_arguments(argparse.ArgumentParser()).parse_args([
+        '--output_dir', str(tmp_path / 'outputs'), '--stock_names_path', str(names_path), '--api_base_url', servers[0],
+        '--ignore_fields_path', pjoin(REPO_DIR, 'csvs', 'ignore_fields.csv'),
+        '--plot_fields_path', pjoin(REPO_DIR, 'csvs', 'plot_fields.csv'),
+        '--alert_rules_path', str(tmp_path / 'no_alert_rules.csv'), '--no_screenshots', '--requests_per_second', '0',
+        '--coordinator_port', str(port), '--coordinator_token', TOKEN, '--lease_seconds', '1'])
+    monitor = StockMonitor(args)
+    monitor.coordinator_url = f"http://127.0.0.1:{port}"
+    yield monitor
+    monitor.terminate()
+
+
+def run_cycle(monitor, workers):
+    threads = [threading.Thread(target=worker.run) for worker in workers]
+    for t in threads:
+        t.start()
+    try:
+        monitor.scheduler.reset()
+        monitor.run_cycle()
+        return monitor.get_status()
+    finally:
+        for worker in workers:
+            worker.stop()
+        for t in threads:
+            t.join()
+
+
+def test_nodes_share_the_cycle(monitor, servers):
+    workers = [ClusterWorker(monitor.coordinator_url, f"node{i}", n_threads=2, batch_size=3, api_base_url=servers[0],
+                             token=TOKEN) for i in range(2)]
+    assert run_cycle(monitor, workers) == (len(STOCK_NAMES), 0)
+    assert all(monitor.stocks[stock_name].data is not None for stock_name in STOCK_NAMES)
+    assert set(monitor.coordinator.get_status()['nodes']) == {'node0', 'node1'}
+    assert all(worker.n_collected > 0 for worker in workers)
+
+
+def test_stuck_node_loses_its_leases(monitor, servers):
+    # Keeps sending heartbeats, but takes longer than a lease for each stock
+    stuck = ClusterWorker(monitor.coordinator_url, 'stuck', n_threads=1, batch_size=2, api_base_url=servers[1],
+                          token=TOKEN)
+    healthy = ClusterWorker(monitor.coordinator_url, 'healthy', n_threads=2, batch_size=1, api_base_url=servers[0],
+                            token=TOKEN)
+    n_expired = metrics.REGISTRY.counters.get('leases_expired', 0)
+    assert run_cycle(monitor, [stuck, healthy]) == (len(STOCK_NAMES), 0)
+    assert metrics.REGISTRY.counters.get('leases_expired', 0) > n_expired
+    assert monitor.coordinator.is_idle()
+
+
+def test_requests_need_the_token(monitor):
+    request = urllib.request.Request(monitor.coordinator_url + '/lease', json.dumps(dict(node='x')).encode('utf-8'),
+                                     {TOKEN_HEADER: 'wrong'})
+    with pytest.raises(urllib.error.HTTPError) as e:
+        urllib.request.urlopen(request, timeout=5)
+    assert e.value.code == 403
+    assert not monitor.coordinator.leases
+
+
+def test_token_required_beyond_loopback(monitor):
+    with pytest.raises(ValueError):
+        Coordinator(monitor, '0.0.0.0', free_port())
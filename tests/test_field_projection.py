@@ -0,0 +1,76 @@
+import pickle
+
+import pytest
+
+import utils
+from field_projection import FieldProjection
+from mock_otc_server import MockOTCBackend
+
+
+def reference_flatten(d, ignore_patterns, keep_fields):
+    """flatten_dict, then drops the ignored fields that are not kept"""
+    exact = [p for p in ignore_patterns if p and not p.endswith('*')]
+    prefixes = tuple(p[:-1] for p in ignore_patterns if p.endswith('*'))
+    return [(k, v) for k, v in utils.flatten_dict(d).items()
+            if k in keep_fields or not (k in exact or k.startswith(prefixes))]
+
+
+def mock_payload(stock_name, version):
+    backend = MockOTCBackend()
+    return utils.merge_raw_stock_data(backend.get_profile(stock_name, version), backend.get_prices(stock_name, version),
+                                      backend.get_news(stock_name, 'dns', version) or dict())
+
+
+PAYLOADS = [
+    mock_payload('AAPL', 0),
+    mock_payload('MSFT', 5),
+    mock_payload('ZZZZ', 13),
+    {
+        'name': 'Nested Corp',
+        'empty_list': [],
+        'empty_dict': {},
+        'securities': [
+            {'symbol': 'NST', 'outstandingShares': 10, 'transferAgents': [{'name': 'A'}, {'name': 'B'}]},
+            {'symbol': 'NSTW', 'outstandingShares': None, 'transferAgents': []},
+        ],
+        'officers': [{'name': 'X', 'title': 'CEO', 'phones': ['1', '2']}],
+        'auditor': {'name': 'Audit Co', 'address': {'city': 'Town', 'zip': 12345}},
+        'isShell': False,
+        'lastSale': 0.0012,
+    },
+]
+
+PROJECTIONS = [
+    # The repo's settings
+    (['estimatedMarketCap', 'estimatedMarketCapAsOfDate', 'lastSale', 'change', 'percentChange', 'tickName'],
+     ['securities_0_authorizedShares', 'securities_0_outstandingShares', 'securities_0_restrictedShares',
+      'securities_0_unrestrictedShares'] + utils.PRICE_FIELDS),
+    # Prefixes pruning whole lists and sub dictionaries, with kept fields under some of them
+    (['securities*', 'officers_*', 'auditor_address*', 'website', 'lastSale'],
+     ['securities_0_outstandingShares', 'lastSale']),
+    # Prefixes ending in the middle of a key, and patterns that match nothing
+    (['securities_0_transfer*', 'is*', 'nothing_here', 'missing*', ''], []),
+    ([], []),
+]
+
+
+@pytest.mark.parametrize('ignore_patterns, keep_fields', PROJECTIONS)
+def test_flatten_matches_flatten_dict(ignore_patterns, keep_fields):
+    projection = FieldProjection(ignore_patterns, keep_fields)
+    # Twice, the second pass uses the cached decisions
+    for _ in range(2):
+        for payload in PAYLOADS:
+            assert projection.flatten(payload) == reference_flatten(payload, ignore_patterns, keep_fields)
+
+
+def test_pickled_projection_flattens_the_same():
+    ignore_patterns, keep_fields = PROJECTIONS[1]
+    projection = FieldProjection(ignore_patterns, keep_fields)
+    copy = pickle.loads(pickle.dumps(projection))
+    for payload in PAYLOADS:
+        assert copy.flatten(payload) == projection.flatten(payload)
+
+
+def test_compare_ignore():
+    projection = FieldProjection(['lastSale', 'securities*'], ['securities_0_outstandingShares', 'lastSale', 'name'])
+    assert projection.compare_ignore == {'lastSale', 'securities_0_outstandingShares'}
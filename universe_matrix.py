@@ -0,0 +1,314 @@
+import ast
+import operator
+import re
+import threading
+
+import utils
+
+MISSING_VALUES = frozenset(['', 'None', utils.NOT_AVAILABLE_STR])
+
+
+# Plain decimal numbers only, without leading zeros, '+', spaces or thousands separators, so identifiers like '00123'
+# stay text and keep their leading zeros
+NUMBER = r'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?'
+NUMBER_PATTERN = re.compile(NUMBER)
+NUMBERS_PATTERN = re.compile(f'(?:{NUMBER}\n)*{NUMBER}')
+
+
+def parse_numbers(values):
+    """Returns the values as float64 with NaN for missing ones, or None if some value is not a number"""
+    import numpy as np
+    try:
+        # Plain numbers are converted and checked in one go
+        numbers = values.astype(np.float64)
+        plain = NUMBERS_PATTERN.fullmatch('\n'.join(values)) is not None
+    except (TypeError, ValueError):
+        pass
+    else:
+        return numbers if plain else None
+    numbers = np.empty(len(values))
+    for i, value in enumerate(values):
+        if value is None or value in MISSING_VALUES:
+            numbers[i] = np.nan
+            continue
+        if not NUMBER_PATTERN.fullmatch(value):
+            return None
+        numbers[i] = float(value)
+    return numbers
+
+
+def format_number(x):
+    if x != x:
+        return None
+    return str(int(x)) if x.is_integer() else repr(x)
+
+
+class UniverseMatrix:
+    """The latest record of every stock as a stocks by fields matrix, kept one column per field. Fields whose values
+    are all numbers are float64 columns with NaN where not available, other fields are object columns with None.
+    Each column has the value the field had before its last change next to it, and whether the stock's last update
+    changed it. Updates are queued and applied in vectorized batches grouped by record layout when the matrix is read,
+    so updating is cheap for the collectors."""
+    def __init__(self, capacity=1024):
+        self.lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.pending = dict()
+        self.capacity = capacity
+        self.n_rows = 0
+        self.rows = dict()
+        self.names = None
+        self.columns = dict()
+        self.previous = dict()
+        self.changed = dict()
+        self.expressions = dict()
+
+    def update(self, stock_name, record):
+        self.pending_lock.acquire()
+        self.pending[stock_name] = record
+        self.pending_lock.release()
+
+    def size(self):
+        self.pending_lock.acquire()
+        n_pending = len([stock_name for stock_name in self.pending if stock_name not in self.rows])
+        self.pending_lock.release()
+        return self.n_rows + n_pending
+
+    def get_fields(self):
+        """Returns a dictionary of field name to 'number' or 'text'"""
+        self.lock.acquire()
+        self._apply_pending()
+        fields = {field: 'text' if column.dtype == object else 'number' for field, column in self.columns.items()}
+        self.lock.release()
+        return fields
+
+    def query(self, expression, columns=(), sort_by=None, ascending=False, limit=None):
+        """Returns a DataFrame of the stocks matching the expression, with their name, the fields the expression uses
+        and the given columns. See compile_expression for the expression syntax"""
+        import numpy as np
+        import pandas as pd
+        evaluate, fields = self.compile(expression)
+        self.lock.acquire()
+        try:
+            self._apply_pending()
+            mask = np.broadcast_to(np.asarray(evaluate(self), dtype=bool), (self.n_rows,))
+            rows = np.flatnonzero(mask)
+            data = {'stock': self.names[rows]}
+            for field in fields + [c for c in list(columns) + [sort_by] if c is not None and c not in fields]:
+                if field != 'stock':
+                    data[field] = self.get_column(field)[rows]
+        finally:
+            self.lock.release()
+        df = pd.DataFrame(data)
+        if sort_by is not None:
+            df = df.sort_values(sort_by, ascending=ascending, kind='stable', na_position='last', ignore_index=True)
+        return df if limit is None else df.iloc[:limit]
+
+    def compile(self, expression):
+        """Returns the compiled (evaluate, fields) of an expression, compiled once"""
+        compiled = self.expressions.get(expression)
+        if compiled is None:
+            compiled = self.expressions[expression] = compile_expression(expression)
+        return compiled
+
+    def get_column(self, field, kind='value'):
+        """A view of the column's value, previous value or changed flag of the rows in use"""
+        if field == 'stock' and kind == 'value':
+            return self.names[:self.n_rows]
+        column = {'value': self.columns, 'previous': self.previous, 'changed': self.changed}[kind].get(field)
+        if column is None:
+            raise ValueError(f"Unknown field {field}")
+        return column[:self.n_rows]
+
+    def _apply_pending(self):
+        import numpy as np
+        self.pending_lock.acquire()
+        pending, self.pending = self.pending, dict()
+        self.pending_lock.release()
+        if not pending:
+            return
+
+        new_stocks = [stock_name for stock_name in pending if stock_name not in self.rows]
+        self._reserve(self.n_rows + len(new_stocks))
+        for stock_name in new_stocks:
+            self.rows[stock_name] = self.n_rows
+            self.names[self.n_rows] = stock_name
+            self.n_rows += 1
+
+        layouts = dict()
+        for stock_name, record in pending.items():
+            rows, values = layouts.setdefault(record.fields, ([], []))
+            rows.append(self.rows[stock_name])
+            values.append(record.values)
+        for fields, (rows, values) in layouts.items():
+            rows = np.array(rows)
+            values = np.array(values, dtype=object).reshape(len(rows), len(fields))
+            for i, field in enumerate(fields):
+                self._set_values(field, rows, values[:, i])
+            for field in set(self.columns) - set(fields):
+                self._set_values(field, rows, np.full(len(rows), None, dtype=object))
+
+    def _set_values(self, field, rows, values):
+        import numpy as np
+        column = self.columns.get(field)
+        numbers = parse_numbers(values) if column is None or column.dtype != object else None
+        if column is None:
+            dtype = object if numbers is None else np.float64
+            column = self.columns[field] = np.full(self.capacity, None if numbers is None else np.nan, dtype=dtype)
+            self.previous[field] = column.copy()
+            self.changed[field] = np.zeros(self.capacity, dtype=bool)
+        elif numbers is None and column.dtype != object:
+            column = self._to_text(field)
+
+        if column.dtype == object:
+            new_values = np.array([None if value in MISSING_VALUES else value for value in values], dtype=object)
+            old_values = column[rows]
+            changed = old_values != new_values
+            first_seen = np.equal(old_values, None)
+        else:
+            new_values = numbers
+            old_values = column[rows]
+            changed = (old_values != new_values) & ~(np.isnan(old_values) & np.isnan(new_values))
+            first_seen = np.isnan(old_values)
+        self.previous[field][rows[changed]] = old_values[changed]
+        self.changed[field][rows] = changed & ~first_seen
+        column[rows] = new_values
+
+    def _to_text(self, field):
+        """Turns a numeric column into a text column once a value that is not a number shows up"""
+        import numpy as np
+        for columns in (self.columns, self.previous):
+            columns[field] = np.array([format_number(x) for x in columns[field]], dtype=object)
+        return self.columns[field]
+
+    def _reserve(self, n_rows):
+        import numpy as np
+        if self.names is None:
+            self.names = np.full(self.capacity, None, dtype=object)
+        if n_rows <= self.capacity:
+            return
+        extra = max(n_rows, 2 * self.capacity) - self.capacity
+        self.names = np.concatenate([self.names, np.full(extra, None, dtype=object)])
+        for columns in (self.columns, self.previous):
+            for field, column in columns.items():
+                fill = None if column.dtype == object else np.nan
+                columns[field] = np.concatenate([column, np.full(extra, fill, dtype=column.dtype)])
+        for field, column in self.changed.items():
+            self.changed[field] = np.concatenate([column, np.zeros(extra, dtype=bool)])
+        self.capacity += extra
+
+
+COMPARISONS = {ast.Lt: operator.lt, ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge,
+               ast.Eq: operator.eq, ast.NotEq: operator.ne}
+ARITHMETIC = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv}
+
+
+def compile_expression(expression):
+    """Compiles a screener expression into a function of a UniverseMatrix returning a mask of the matching stocks.
+    Expressions are python-like: field names, numbers and 'strings', + - * /, comparisons, and/or/not and:
+        prev(field)             the value the field had before its last change
+        changed(field)          the stock's last update changed the field
+        grew(field), fell(field) the field's last change was an increase / decrease
+        abs(x)
+        contains(field, 'text') case insensitive
+        matches(field, 'regex')
+    For example: grew(securities_0_outstandingShares) and percentChange > 20
+    'stock' is the stock name. Returns (evaluate, names of the fields used)"""
+    import numpy as np
+    fields = []
+
+    def field_name(node):
+        if not isinstance(node, ast.Name):
+            raise ValueError(f"Expected a field name in {expression}")
+        if node.id not in fields:
+            fields.append(node.id)
+        return node.id
+
+    def text_argument(node):
+        if not isinstance(node, ast.Constant) or not isinstance(node.value, str):
+            raise ValueError(f"Expected a 'string' in {expression}")
+        return node.value
+
+    def text_match(field, match):
+        def evaluate(m):
+            column = m.get_column(field)
+            return np.fromiter((value is not None and match(str(value)) for value in column), bool, len(column))
+        return evaluate
+
+    def build(node):
+        if isinstance(node, ast.Expression):
+            return build(node.body)
+        if isinstance(node, ast.BoolOp):
+            parts = [build(value) for value in node.values]
+            combine = np.logical_and if isinstance(node.op, ast.And) else np.logical_or
+            # A constant part is a single value, the others have one per row
+            return lambda m: combine.reduce([np.broadcast_to(np.asarray(part(m), dtype=bool), (m.n_rows,))
+                                             for part in parts])
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            operand = build(node.operand)
+            return lambda m: np.logical_not(operand(m))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            operand = build(node.operand)
+            return lambda m: -operand(m)
+        if isinstance(node, ast.Compare):
+            operands = [build(node.left)] + [build(c) for c in node.comparators]
+            ops = [COMPARISONS[type(op)] for op in node.ops if type(op) in COMPARISONS]
+            if len(ops) != len(node.ops):
+                raise ValueError(f"Unsupported comparison in {expression}")
+
+            def compare(m):
+                values = [operand(m) for operand in operands]
+                try:
+                    return np.logical_and.reduce([op(a, b) for op, a, b in zip(ops, values, values[1:])])
+                except TypeError:
+                    raise ValueError(f"Can't compare text with numbers in {expression}")
+            return compare
+        if isinstance(node, ast.BinOp) and type(node.op) in ARITHMETIC:
+            op, left, right = ARITHMETIC[type(node.op)], build(node.left), build(node.right)
+
+            def arithmetic(m):
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    try:
+                        return op(left(m), right(m))
+                    except TypeError:
+                        raise ValueError(f"Can't do arithmetic on text in {expression}")
+            return arithmetic
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float, str)):
+            return lambda m: node.value
+        if isinstance(node, ast.Name):
+            field = field_name(node)
+            return lambda m: m.get_column(field)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            name, args = node.func.id, node.args
+            if name == 'abs' and len(args) == 1:
+                operand = build(args[0])
+                return lambda m: np.abs(operand(m))
+            if name in ('prev', 'changed', 'grew', 'fell') and len(args) == 1:
+                field = field_name(args[0])
+                if name == 'prev':
+                    return lambda m: m.get_column(field, 'previous')
+                if name == 'changed':
+                    return lambda m: m.get_column(field, 'changed')
+                op = operator.gt if name == 'grew' else operator.lt
+
+                def moved(m):
+                    column = m.get_column(field)
+                    if column.dtype == object:
+                        raise ValueError(f"{field} is not a number in {expression}")
+                    return op(column, m.get_column(field, 'previous'))
+                return moved
+            if name == 'contains' and len(args) == 2:
+                text = text_argument(args[1]).lower()
+                return text_match(field_name(args[0]), lambda value: text in value.lower())
+            if name == 'matches' and len(args) == 2:
+                try:
+                    pattern = re.compile(text_argument(args[1]))
+                except re.error as e:
+                    raise ValueError(f"Bad regex in {expression}: {e}")
+                return text_match(field_name(args[0]), lambda value: pattern.search(value) is not None)
+        raise ValueError(f"Unsupported expression {expression}")
+
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError as e:
+        raise ValueError(f"Bad expression {expression}: {e.msg}")
+    return build(tree), fields
@@ -1,74 +1,191 @@
+import csv
+import hashlib
 import json
 import os
 import threading
+import urllib.error
 import urllib.request
 from datetime import datetime
+from time import sleep
 
-from multiprocessing import Process
+import metrics
+import net_guard
 
-import numpy as np
-import pandas as pd
+try:
+    # Optional faster JSON parser
+    import orjson
+    loads_json = orjson.loads
+except ImportError:
+    loads_json = json.loads
 
 NOT_AVAILABLE_STR = 'Not available'
+OTC_API_URL = "https://backend.otcmarkets.com/otcapi"
+PRICE_FIELDS = ["lastSale", "change", "percentChange", "tickName"]
+
+# Most stocks share the same fields, so records keep a reference to one shared (fields, index) layout
+_record_layouts = dict()
+
+
+class StockRecord:
+    """Compact record of a stock's flattened data. Values are kept as strings in a tuple alongside a shared fields
+    layout, with a fingerprint of the compared fields so unchanged stocks are detected with a single comparison."""
+    __slots__ = ('fields', 'values', 'index', '_fingerprint', '_fingerprint_ignored')
+
+    def __init__(self, fields, values):
+        fields = tuple(fields)
+        layout = _record_layouts.get(fields)
+        if layout is None:
+            layout = _record_layouts.setdefault(fields, (fields, {f: i for i, f in enumerate(fields)}))
+        self.fields, self.index = layout
+        self.values = tuple(values)
+        self._fingerprint = None
+        self._fingerprint_ignored = None
+
+    def __reduce__(self):
+        # Records sent to other processes are attached to that process's shared layouts
+        return StockRecord, (self.fields, self.values)
+
+    def __contains__(self, field):
+        return field in self.index
+
+    def __getitem__(self, field):
+        return self.values[self.index[field]]
+
+    def get(self, field, default=None):
+        i = self.index.get(field)
+        return default if i is None else self.values[i]
+
+    def items(self):
+        return zip(self.fields, self.values)
+
+    def fingerprint(self, ignore_fields):
+        """Stable hash of the fields that are not ignored and are available. Computed once per record and ignore_fields
+        object, a different ignore_fields computes it again"""
+        if self._fingerprint is None or self._fingerprint_ignored is not ignore_fields:
+            h = hashlib.blake2b(digest_size=16)
+            for field, value in sorted(self.items()):
+                if value != NOT_AVAILABLE_STR and field not in ignore_fields:
+                    h.update(f"{field}\x1e{value}\x1f".encode('utf-8'))
+            self._fingerprint, self._fingerprint_ignored = h.digest(), ignore_fields
+        return self._fingerprint
+
+    def to_csv(self, path):
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.fields)
+            writer.writerow(self.values)
+
+    @staticmethod
+    def read_csv(path):
+        """Returns None if the csv has no values row, like a file cut short while being written"""
+        with open(path, 'r', newline='', encoding='utf-8') as f:
+            rows = list(csv.reader(f))
+        if len(rows) < 2:
+            return None
+        return StockRecord(rows[0], [v if v else NOT_AVAILABLE_STR for v in rows[1]])
+
+
+def get_plot_series(dir_path, name='special_fields'):
+    """Returns the plot fields series of a stock. Only reads, an old csv history is moved into it on the next write"""
+    from series_store import SeriesFile
+    return SeriesFile(os.path.join(dir_path, f"{name}.series"))
+
+
+# Appends to a stock's series, and the one time migration of its csv, are done by one thread at a time
+_series_locks = dict()
+_series_locks_lock = threading.Lock()
+
+
+def append_plot_series(dir_path, timestamp, fields, values, name='special_fields'):
+    from series_store import migrate_csv
+    _series_locks_lock.acquire()
+    lock = _series_locks.setdefault(dir_path, threading.Lock())
+    _series_locks_lock.release()
+    lock.acquire()
+    try:
+        series = get_plot_series(dir_path, name)
+        csv_path = os.path.join(dir_path, f"{name}.csv")
+        if os.path.exists(csv_path):
+            migrate_csv(csv_path, series)
+        series.append(timestamp, fields, values)
+    finally:
+        lock.release()
 
 
-def plot_csv(dir_path, name='special_fields'):
-    import pandas as pd
+def plot_series(dir_path, name='special_fields', max_points=500, method='lttb', start=None, end=None):
+    """Plots the plot fields of a stock between start and end, each downsampled to at most max_points points"""
     import matplotlib.pyplot as plt
-    p = os.path.join(dir_path, f"{name}.csv")
-    if not os.path.exists(p):
+    from series_store import DOWNSAMPLERS
+    times, fields, values = get_plot_series(dir_path, name).query(start, end)
+    if len(times) == 0:
         return
-    df = pd.read_csv(p)
     plt.figure(figsize=(10, 10))
-    headers = [x for x in df.head()][1:]
-    for c in headers:
-        plt.plot(df['date'], df[c], label=c)
+    for i, field in enumerate(fields):
+        field_times, field_values = DOWNSAMPLERS[method](times, values[:, i], max_points)
+        plt.plot([datetime.fromtimestamp(t) for t in field_times], field_values, label=field)
         plt.grid()
     plt.xticks(rotation=45)
-    # ax.yaxis.set_major_formatter(ScalarFormatter())
     plt.legend()
-    plt.legend(loc='lower left', bbox_to_anchor=(0.0, 1.0),fancybox=True, shadow=True, ncol=len(headers))
-    # plt.tight_layout()
+    plt.legend(loc='lower left', bbox_to_anchor=(0.0, 1.0),fancybox=True, shadow=True, ncol=len(fields))
     plt.savefig(os.path.join(dir_path, f"{name}.png"))
-    plt.clf()
-
-
-def plot_csv_process(dir_path):
-    p = Process(target=plot_csv, args=(dir_path,))
-    p.start()
-    p.join()
+    plt.close()
 
 
 def get_dict_from_url(url):
+    guard = net_guard.get_guard(url)
+    if not guard.breaker.allow():
+        return dict()
+    sleep(guard.bucket.reserve())
     try:
-        req = urllib.request.Request(url)
-        page = urllib.request.urlopen(req)
-        d = json.loads(page.read().decode('utf-8'))
+        with metrics.REGISTRY.time(f"fetch_{get_endpoint_name(url)}"):
+            req = urllib.request.Request(url)
+            page = urllib.request.urlopen(req)
+            d = loads_json(page.read())
+    except urllib.error.HTTPError as e:
+        if net_guard.is_host_failure(e.code):
+            guard.breaker.record_failure()
+        return dict()
+    except (urllib.error.URLError, OSError) as e:
+        guard.breaker.record_failure()
+        return dict()
     except Exception as e:
         # print(f"{threading.currentThread().getName()}: Failed to decode data from {url}.. ")
         return dict()
+    guard.breaker.record_success()
     return d
 
 
-def get_raw_stock_data(stock_name):
-    url = f"https://backend.otcmarkets.com/otcapi/company/profile/full/{stock_name}?symbol={stock_name}"
-    company_dict = get_dict_from_url(url)
-    if not company_dict:
-        return dict()
+def get_endpoint_name(url):
+    if '/company/profile/full/' in url:
+        return 'profile'
+    if '/stock/trade/inside/' in url:
+        return 'prices'
+    if '/dns/news' in url:
+        return 'news_dns'
+    if '/external/news' in url:
+        return 'news_external'
+    return 'other'
+
+
+def get_profile_url(stock_name, base_url=OTC_API_URL):
+    return f"{base_url}/company/profile/full/{stock_name}?symbol={stock_name}"
+
 
-    url = f"https://backend.otcmarkets.com/otcapi/stock/trade/inside/{stock_name}?symbol={stock_name}"
-    prices_dict = get_dict_from_url(url)
+def get_prices_url(stock_name, base_url=OTC_API_URL):
+    return f"{base_url}/stock/trade/inside/{stock_name}?symbol={stock_name}"
+
+
+def get_news_url(stock_name, source='dns', base_url=OTC_API_URL):
+    return f'{base_url}/company/{stock_name}/{source}/news?symbol={stock_name}&page=1&pageSize=1&sortOn=releaseDate&sortDir=DESC'
+
+
+def merge_raw_stock_data(company_dict, prices_dict, news_dict):
+    """Merges the profile, inside-trade and news responses of a stock into one dictionary"""
     if prices_dict:
-        company_dict.update({k:prices_dict[k] for k in ["lastSale", "change", "percentChange", "tickName"]})
+        company_dict.update({k:prices_dict[k] for k in PRICE_FIELDS})
     else:
-        company_dict.update({k:NOT_AVAILABLE_STR for k in ["lastSale", "change", "percentChange", "tickName"]})
-
+        company_dict.update({k:NOT_AVAILABLE_STR for k in PRICE_FIELDS})
 
-    url = f'https://backend.otcmarkets.com/otcapi/company/{stock_name}/dns/news?symbol={stock_name}&page=1&pageSize=1&sortOn=releaseDate&sortDir=DESC'
-    news_dict = get_dict_from_url(url)
-    if not news_dict:
-        url = url.replace('dns', 'external')
-        news_dict = get_dict_from_url(url)
     if 'records' in news_dict:
         company_dict['last_news_entry'] = news_dict['records'][0]['title']
     else:
@@ -77,16 +194,66 @@ def get_raw_stock_data(stock_name):
     return company_dict
 
 
-def get_stock_data(stock_name):
+def get_other_news_source(source):
+    return 'external' if source == 'dns' else 'dns'
+
+
+def get_news_dict(stock_name, base_url=OTC_API_URL, source='dns'):
+    """Queries the news of a stock from the given source first and falls back to the other one.
+    Returns the news dictionary and the source that answered"""
+    news_dict = get_dict_from_url(get_news_url(stock_name, source, base_url))
+    if not news_dict:
+        source = get_other_news_source(source)
+        news_dict = get_dict_from_url(get_news_url(stock_name, source, base_url))
+    return news_dict, source if news_dict else None
+
+
+def get_raw_stock_data(stock_name, base_url=OTC_API_URL, cache=None):
+    if cache is None:
+        company_dict = get_dict_from_url(get_profile_url(stock_name, base_url))
+        if not company_dict:
+            return dict()
+        prices_dict = get_dict_from_url(get_prices_url(stock_name, base_url))
+        news_dict, _ = get_news_dict(stock_name, base_url)
+        return merge_raw_stock_data(company_dict, prices_dict, news_dict)
+
+    prices_dict = get_dict_from_url(get_prices_url(stock_name, base_url))
+
+    tick_changed = cache.tick_changed(stock_name, prices_dict)
+    company_dict = cache.get(stock_name, 'profile')
+    if company_dict is None or tick_changed:
+        company_dict = get_dict_from_url(get_profile_url(stock_name, base_url))
+        if not company_dict:
+            return dict()
+        cache.put(stock_name, 'profile', company_dict)
+
+    news_dict = cache.get(stock_name, 'news')
+    if news_dict is None:
+        news_dict, source = get_news_dict(stock_name, base_url, cache.get(stock_name, 'news_source') or 'dns')
+        # No answer from either source is usually a passing failure, it is asked again next time
+        if news_dict:
+            cache.put(stock_name, 'news', news_dict)
+        if source:
+            cache.put(stock_name, 'news_source', source)
+
+    return merge_raw_stock_data(company_dict, prices_dict, news_dict)
+
+
+def parse_raw_stock_data(data, projection=None):
+    """Turns a raw stock dictionary into a StockRecord of strings. With a FieldProjection only its fields are kept"""
+    with metrics.REGISTRY.time('parse'):
+        items = projection.flatten(data) if projection else flatten_dict(data).items()
+        fields = [k for k, v in items]
+        values = [str(v) for k, v in items]
+        return StockRecord(fields, [v if v else NOT_AVAILABLE_STR for v in values])
+
+
+def get_stock_data(stock_name, base_url=OTC_API_URL, cache=None, projection=None):
     """Returns a current data dicctionary for each stock loaded from the website servers"""
-    data = get_raw_stock_data(stock_name)
+    data = get_raw_stock_data(stock_name, base_url, cache)
     if not data:
         return None
-    data = flatten_dict(data)
-    df = pd.DataFrame.from_dict([data])
-    df = df.applymap(str)
-    df.replace('', NOT_AVAILABLE_STR, inplace=True)
-    return df
+    return parse_raw_stock_data(data, projection)
 
     # manager_names = ['Kevin Booker', 'Kevin durant', 'Micheal Jordan', 'Kobi Bryant', 'Chris Paul', 'R Donoven JR']
     # import random
@@ -146,97 +313,27 @@ def get_time_str(for_filename=True):
     return time_str
 
 
-def dump_stocks_plot(output_dir, stock_name_list):
-    # fields = ["lastSale", "change", "percentChange"]
-    df = pd.read_csv(os.path.join(output_dir, "price_status.csv"))
-    df = df.loc[df['stock'].isin(stock_name_list)]
-    from matplotlib import pyplot as plt
-
-    plt.figure(figsize=(min(len(stock_name_list),20), 5))
-
-    pos_ind, neg_ind = df["percentChange"] > 0, df["percentChange"] <= 0
-    pos_rects = plt.bar(df['stock'][pos_ind], df["percentChange"][pos_ind], color='g')
-    neg_rects = plt.bar(df['stock'][neg_ind], df["percentChange"][neg_ind], color='r')
-
-    for i, rect in enumerate(pos_rects):
-        height = rect.get_height()
-        plt.text(rect.get_x() + rect.get_width() / 2., 0.99 * height,
-                f"{df['lastSale'][pos_ind].tolist()[i]}$", ha='center', va='bottom')
-
-    for i, rect in enumerate(neg_rects):
-        height = rect.get_height()
-        plt.text(rect.get_x() + rect.get_width() / 2., 0.99 * height,
-                f"{df['lastSale'][neg_ind].tolist()[i]:.4f}$", ha='center', va='top')
-
-    lim = max(abs(df["percentChange"])) * 1.2
-    plt.ylim(-lim,lim)
-
-    locs, labels = plt.yticks()
-    plt.yticks(ticks=locs, labels=[f'{x:.0f}%' for x in locs])
-
-    plt.xticks(rotation=45)
-    plt.grid()
-    plot_path = os.path.join(output_dir,"stock_bars.png")
-    plt.savefig(plot_path)
-    plt.clf()
-    return plot_path
-
-
-def update_plot_fields(csv_path, data_dict, plot_fields):
-    if data_dict is None:
-        return
-    plot_fields_dict = dict()
-    for field in plot_fields:
-        plot_fields_dict[field] = data_dict[field].values[0] if field in data_dict else NOT_AVAILABLE_STR
-    new_row = pd.DataFrame.from_dict([plot_fields_dict])
-    new_row.insert(0, 'date', [get_time_str()])
-    new_row.to_csv(csv_path, index=False, header=not os.path.exists(csv_path), mode='a')
-    plot_csv_process(os.path.dirname(csv_path))
-
-
-def update_price_status(log_path, stock_name, stock_data):
-    """Updates/adds a row for a given stock in a global file of stocks"""
-    header = ["stock", "lastSale", "change", "percentChange"]
-    if stock_data is None:
+def update_plot_fields(dir_path, record, plot_fields):
+    if record is None:
         return
-    new_row = [[stock_name] + stock_data[header[1:]].values[0].tolist()]
-    if not os.path.exists(log_path):
-        new_row = pd.DataFrame(new_row, columns=header)
-        new_row.to_csv(log_path, columns=header, index=False)
-    else:
-        df = pd.read_csv(log_path)
-        if any(df['stock'] == stock_name):
-            df.loc[df['stock'] == stock_name] = new_row
-        else:
-            new_row = pd.DataFrame(new_row, columns=header)
-            df = df.append(new_row, ignore_index=True)
-
-        df.to_csv(log_path, columns=header, index=False)
-
-
-def filter_rows(row1, row2, ignore_row_names):
-    ignore_columns = [x for x in ignore_row_names if x in row1]
-    not_available_columns = (row1 == NOT_AVAILABLE_STR).any() | (row2 == NOT_AVAILABLE_STR).any()
-    not_available_columns = row2.columns[not_available_columns].tolist()
-
-    filtered_row1 = row1.drop(ignore_columns + not_available_columns, axis=1)
-    filtered_row2 = row2.drop(ignore_columns + not_available_columns, axis=1)
-
-    return filtered_row1, filtered_row2
+    append_plot_series(dir_path, datetime.now().timestamp(), plot_fields,
+                       [record.get(field, NOT_AVAILABLE_STR) for field in plot_fields])
 
 
 def compare_rows(row1, row2, ignore_row_names):
+    """Returns a list of (field, from, to) of the compared fields that differ between the two records, or None"""
     if row1 is None or row2 is None:
         return None
 
-    filtered_row1, filtered_row2 = filter_rows(row1, row2, ignore_row_names)
-
-    diff = filtered_row1 != filtered_row2
-    diff = diff.drop([x for x in ignore_row_names if x in diff], axis=1)
-    diff = diff.drop(columns=diff.columns[(diff == NOT_AVAILABLE_STR).any()])
-    diff_where = np.where(diff)
-    index = diff.stack()[diff.stack()].index
-    if np.any(diff_where):
-        diff = pd.DataFrame({'from': filtered_row1.values[diff_where], 'to': filtered_row2.values[diff_where]}, index=index)
-        return diff
-    return None
\ No newline at end of file
+    if row1.fingerprint(ignore_row_names) == row2.fingerprint(ignore_row_names):
+        return None
+
+    diff = []
+    for field, new_value in row2.items():
+        if field in ignore_row_names or new_value == NOT_AVAILABLE_STR:
+            continue
+        old_value = row1.get(field, NOT_AVAILABLE_STR)
+        if old_value != NOT_AVAILABLE_STR and old_value != new_value:
+            diff.append((field, old_value, new_value))
+
+    return diff if diff else None